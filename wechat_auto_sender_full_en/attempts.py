@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+attempts.py
+发送尝试历史（task_attempts）的查询：
+- latency：按小时/日/月的 p50/p95 耗时（整次尝试，或 --stage 指定的单个阶段），分位数在 SQL 里用窗口函数求
+- failures：各期间的尝试数、失败率，以及按错误类型拆分的失败数
+- history：某个任务的全部尝试
+调整配置（节奏、账号、后端）前后各跑一次 latency，即可对比发送是否变快/变慢。
+
+用法：
+    python attempts.py latency [--since 2026-10-01] [--until 2026-10-31] [--by hour|day|month] [--stage send]
+    python attempts.py failures [--since ...] [--until ...] [--by ...]
+    python attempts.py history 123
+"""
+
+import argparse
+import json
+import sys
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, func, select
+
+from models import TaskAttempt
+
+_PERIOD_LEN = {"hour": 13, "day": 10, "month": 7}
+
+
+def _period(by: str):
+    if by not in _PERIOD_LEN:
+        raise ValueError(f"by 只能是 {'/'.join(_PERIOD_LEN)}：{by!r}")
+    return func.substr(TaskAttempt.started_at, 1, _PERIOD_LEN[by])
+
+
+def _window(q, since: datetime = None, until: datetime = None):
+    if since:
+        q = q.where(TaskAttempt.started_at >= since)
+    if until:
+        q = q.where(TaskAttempt.started_at < until)
+    return q
+
+
+def latency(s, since: datetime = None, until: datetime = None, by: str = "day",
+            stage: str = None, outcome: str = "sent"):
+    """
+    [(期间, 样本数, p50 毫秒, p95 毫秒, 最大毫秒)]，分位数取最近秩（nearest-rank）。
+    stage 为空时统计整次尝试的 duration_ms，否则统计 stages_json 中该阶段的耗时。
+    """
+    A = TaskAttempt
+    period = _period(by)
+    value = A.duration_ms if stage is None else func.json_extract(A.stages_json, f"$.{stage}")
+    ranked = _window(
+        select(
+            period.label("period"),
+            value.label("v"),
+            func.row_number().over(partition_by=period, order_by=value).label("rn"),
+            func.count().over(partition_by=period).label("n"),
+        ).where(value.isnot(None)),
+        since, until,
+    )
+    if outcome:
+        ranked = ranked.where(A.outcome == outcome)
+    r = ranked.subquery()
+    q = (
+        select(
+            r.c.period,
+            func.max(r.c.n),
+            func.min(case((r.c.rn >= r.c.n * 0.5, r.c.v))),
+            func.min(case((r.c.rn >= r.c.n * 0.95, r.c.v))),
+            func.max(r.c.v),
+        )
+        .group_by(r.c.period)
+        .order_by(r.c.period)
+    )
+    return [tuple(x) for x in s.execute(q)]
+
+
+def failures(s, since: datetime = None, until: datetime = None, by: str = "day"):
+    """
+    {期间: {"attempts": 尝试数, "failed": 失败数, "rate": 失败率, "by_class": [(错误类型, 次数, 占尝试比例)]}}
+    """
+    A = TaskAttempt
+    period = _period(by)
+    totals = _window(
+        select(period, func.count(), func.sum(case((A.outcome == "failed", 1), else_=0)))
+        .group_by(period)
+        .order_by(period),
+        since, until,
+    )
+    out = {}
+    for p, n, failed in s.execute(totals):
+        failed = failed or 0
+        out[p] = {"attempts": n, "failed": failed, "rate": failed / n if n else 0.0, "by_class": []}
+    per_class = _window(
+        select(period, func.coalesce(A.error_class, "?"), func.count())
+        .where(A.outcome == "failed")
+        .group_by(period, A.error_class)
+        .order_by(period, func.count().desc()),
+        since, until,
+    )
+    for p, cls, n in s.execute(per_class):
+        out[p]["by_class"].append((cls, n, n / out[p]["attempts"]))
+    return out
+
+
+def history(s, task_id: int):
+    return (
+        s.execute(
+            select(TaskAttempt).where(TaskAttempt.task_id == task_id).order_by(TaskAttempt.attempt_no)
+        )
+        .scalars()
+        .all()
+    )
+
+
+def _fmt_ms(v) -> str:
+    return "-" if v is None else f"{v:.0f}"
+
+
+def main(argv=None) -> int:
+    from db_utils import init_db, session_scope
+
+    ap = argparse.ArgumentParser(description="发送尝试历史：耗时分位数与失败率")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    for name, help_ in (("latency", "p50/p95 发送耗时"), ("failures", "按错误类型的失败率")):
+        p = sub.add_parser(name, help=help_)
+        p.add_argument("--since", help="YYYY-MM-DD（含）")
+        p.add_argument("--until", help="YYYY-MM-DD（含）")
+        p.add_argument("--by", choices=list(_PERIOD_LEN), default="day")
+        if name == "latency":
+            p.add_argument("--stage", help="只看某个阶段，如 send / render / balance / paste")
+    p = sub.add_parser("history", help="某个任务的全部尝试")
+    p.add_argument("task_id", type=int)
+    args = ap.parse_args(argv)
+
+    init_db()
+    with session_scope() as s:
+        if args.cmd == "history":
+            for a in history(s, args.task_id):
+                err = f"  {a.error_class}: {a.error_message}" if a.error_class else ""
+                print(
+                    f"#{a.attempt_no} {a.started_at:%Y-%m-%d %H:%M:%S} {a.outcome:<6} {_fmt_ms(a.duration_ms):>7}ms"
+                    f"  {a.backend or '-'}/{a.account or '-'}  {a.worker_id or '-'}{err}"
+                )
+                if a.stages_json:
+                    print(f"    {json.loads(a.stages_json)}")
+            return 0
+
+        since = datetime.fromisoformat(args.since) if args.since else None
+        until = datetime.fromisoformat(args.until) + timedelta(days=1) if args.until else None
+        if args.cmd == "latency":
+            print(f"期间            样本数    p50(ms)    p95(ms)    max(ms)   {args.stage or '整次尝试'}")
+            for period, n, p50, p95, top in latency(s, since, until, args.by, args.stage):
+                print(f"{period:<14} {n:>6} {_fmt_ms(p50):>10} {_fmt_ms(p95):>10} {_fmt_ms(top):>10}")
+        else:
+            for period, row in failures(s, since, until, args.by).items():
+                print(f"{period:<14} 尝试 {row['attempts']:>6}  失败 {row['failed']:>5}  失败率 {row['rate']:.1%}")
+                for cls, n, share in row["by_class"]:
+                    print(f"    {cls:<24} {n:>5}  {share:.1%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
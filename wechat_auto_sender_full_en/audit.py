@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+audit.py
+发送截图审计流水线：
+- 发送路径只负责截图并 submit() 入队（不编码、不写盘）
+- 后台线程：感知哈希去重（只在同一任务内，每个任务的第一张总会保存）-> 压缩为 WebP/JPEG -> 按日期分目录保存 -> 写 audit_images 索引
+- 按 AUDIT_RETENTION_DAYS 清理过期目录与索引
+"""
+
+import atexit
+import os
+import queue
+import shutil
+import threading
+from datetime import datetime, timedelta
+
+try:
+    from config import (
+        AUDIT_DIR,
+        AUDIT_FORMAT,
+        AUDIT_QUALITY,
+        AUDIT_RETENTION_DAYS,
+        AUDIT_DUP_THRESHOLD,
+        AUDIT_QUEUE_SIZE,
+    )
+except Exception:
+    AUDIT_DIR = "audit"
+    AUDIT_FORMAT = "WEBP"
+    AUDIT_QUALITY = 60
+    AUDIT_RETENTION_DAYS = 30
+    AUDIT_DUP_THRESHOLD = 4
+    AUDIT_QUEUE_SIZE = 64
+
+import metrics
+from log_utils import get_logger
+
+logger = get_logger(__name__)
+
+_EXT = {"WEBP": "webp", "JPEG": "jpg"}
+
+_queue: "queue.Queue" = queue.Queue(maxsize=AUDIT_QUEUE_SIZE)
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def dhash(img, size: int = 8) -> int:
+    """差值哈希：缩成 (size+1)*size 灰度图，比较相邻像素明暗，得到 64 位指纹"""
+    small = img.convert("L").resize((size + 1, size))
+    px = list(small.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = px[row * (size + 1) + col]
+            right = px[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (1 if left > right else 0)
+    return bits
+
+
+def _hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def prune(now: datetime = None, retention_days: int = AUDIT_RETENTION_DAYS):
+    """删除超过保留期的日期目录及其索引行"""
+    if retention_days is None or retention_days <= 0 or not os.path.isdir(AUDIT_DIR):
+        return
+    now = now or datetime.now()
+    cutoff = (now - timedelta(days=retention_days)).strftime("%Y-%m-%d")
+    for name in os.listdir(AUDIT_DIR):
+        path = os.path.join(AUDIT_DIR, name)
+        # 只处理 YYYY-MM-DD 形式的分区目录
+        if os.path.isdir(path) and len(name) == 10 and name < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+
+    from db_utils import session_scope
+    from models import AuditImage
+
+    with session_scope() as s:
+        s.query(AuditImage).filter(AuditImage.day < cutoff).delete(synchronize_session=False)
+
+
+class _Encoder(threading.Thread):
+    def __init__(self):
+        super().__init__(name="audit-encoder", daemon=True)
+        self._last_hash = {}   # contact -> (task_id, 上一张图的哈希)
+        self._pruned_day = None
+
+    def run(self):
+        while True:
+            item = _queue.get()
+            try:
+                self._handle(*item)
+            except Exception as e:
+                logger.warning(f"audit image failed: {e}")
+                metrics.inc("audit_images_total", outcome="error")
+            finally:
+                _queue.task_done()
+
+    def _handle(self, img, taken_at: datetime, task_id, contact):
+        h = dhash(img)
+        # 只和同一任务的上一张比：同一联系人下一次送货的画面可能几乎一样，但那是另一次发送的凭证
+        prev = self._last_hash.get(contact)
+        if prev is not None and prev[0] == task_id and _hamming(prev[1], h) <= AUDIT_DUP_THRESHOLD:
+            metrics.inc("audit_images_total", outcome="duplicate")
+            return
+        self._last_hash[contact] = (task_id, h)
+
+        day = taken_at.strftime("%Y-%m-%d")
+        folder = os.path.join(AUDIT_DIR, day)
+        os.makedirs(folder, exist_ok=True)
+        fmt = AUDIT_FORMAT.upper()
+        if fmt not in _EXT:
+            fmt = "JPEG"
+        fname = f"send_{taken_at.strftime('%H%M%S_%f')}_{task_id or 0}.{_EXT[fmt]}"
+        path = os.path.join(folder, fname)
+        img = img.convert("RGB")
+        img.save(path, fmt, quality=int(AUDIT_QUALITY), optimize=True)
+
+        from db_utils import session_scope
+        from models import AuditImage
+
+        with session_scope() as s:
+            s.add(AuditImage(
+                task_id=task_id,
+                contact=contact,
+                ts=taken_at,
+                day=day,
+                path=path,
+                phash=f"{h:016x}",
+                size_bytes=os.path.getsize(path),
+            ))
+        metrics.inc("audit_images_total", outcome="saved")
+
+        # 每天第一张图时顺便清理一次过期数据
+        if self._pruned_day != day:
+            self._pruned_day = day
+            prune(taken_at)
+
+
+def _ensure_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = _Encoder()
+            _worker.start()
+
+
+def submit(img, task_id: int = None, contact: str = None):
+    """发送路径调用：只入队，队列满则丢弃（审计不能拖慢发送）"""
+    if img is None:
+        return
+    _ensure_worker()
+    try:
+        _queue.put_nowait((img, datetime.now(), task_id, contact))
+    except queue.Full:
+        metrics.inc("audit_images_total", outcome="dropped")
+
+
+def flush(timeout: float = None):
+    """等待队列中的截图处理完（退出前/测试用）"""
+    if _worker is None or not _worker.is_alive():
+        return
+    if timeout is None:
+        _queue.join()
+        return
+    done = threading.Event()
+    threading.Thread(target=lambda: (_queue.join(), done.set()), daemon=True).start()
+    done.wait(timeout)
+
+
+atexit.register(flush, 10.0)
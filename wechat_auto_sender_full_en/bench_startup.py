@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+启动耗时基准：用 `python -X importtime` 逐个导入入口模块，
+统计总导入耗时并检查是否误把重量级依赖（pyautogui、APScheduler、jinja2…）提前导入。
+超出预算或出现提前导入时返回非 0，可放进发布前检查。
+
+用法：python bench_startup.py [--budget-ms 500] [--top 8]
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+# 入口模块 -> 导入时不应出现的重量级模块
+ENTRY_MODULES = {
+    "db_utils": ["pyautogui", "apscheduler", "jinja2", "PIL"],
+    "log_utils": ["sqlalchemy", "pyautogui", "apscheduler", "jinja2"],
+    "metrics": ["sqlalchemy", "pyautogui", "apscheduler", "jinja2"],
+    "hook": ["pyautogui", "pyperclip", "apscheduler", "jinja2"],
+    "sender": ["pyautogui", "pyperclip", "pygetwindow", "apscheduler", "jinja2"],
+    "scheduler": ["pyautogui", "pyperclip", "apscheduler", "jinja2"],
+    "main": ["sqlalchemy", "pyautogui", "pyperclip", "apscheduler", "jinja2"],
+}
+
+DEFAULT_BUDGET_MS = 500
+
+
+def measure(module: str, forbidden: list) -> dict:
+    code = (
+        "import sys, threading\n"
+        f"import {module}\n"
+        f"print('eager=' + ','.join(m for m in {forbidden!r} if m in sys.modules))\n"
+        "print('threads=%d' % threading.active_count())\n"
+    )
+    t0 = time.perf_counter()
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        encoding="utf-8",
+    )
+    wall_ms = (time.perf_counter() - t0) * 1000
+    if p.returncode != 0:
+        return {"module": module, "error": p.stderr.strip().splitlines()[-1:]}
+
+    # importtime 输出：import time: self [us] | cumulative | imported package
+    entries = []
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        try:
+            self_us, cum_us, raw = int(parts[0]), int(parts[1]), parts[2]
+        except (ValueError, IndexError):
+            continue
+        # 名称前的缩进表示嵌套层级
+        depth = len(raw) - len(raw.lstrip())
+        entries.append((cum_us, self_us, raw.strip(), depth))
+    out = dict(line.split("=", 1) for line in p.stdout.splitlines() if "=" in line)
+    return {
+        "module": module,
+        "import_ms": sum(e[1] for e in entries) / 1000,
+        "wall_ms": wall_ms,
+        "eager": [m for m in out.get("eager", "").split(",") if m],
+        "threads": int(out.get("threads", 0)),
+        # 入口模块直接导入的依赖（比入口多缩进一级），按累计耗时排序
+        "top": sorted((e for e in entries if e[3] == 3), reverse=True),
+    }
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    ap.add_argument("--top", type=int, default=8)
+    args = ap.parse_args(argv)
+
+    failed = False
+    for module, forbidden in ENTRY_MODULES.items():
+        r = measure(module, forbidden)
+        if "error" in r:
+            print(f"✗ {module}: 导入失败 {r['error']}")
+            failed = True
+            continue
+        ok = r["import_ms"] <= args.budget_ms and not r["eager"] and r["threads"] == 1
+        failed |= not ok
+        print(
+            f"{'✓' if ok else '✗'} {module:<10} import={r['import_ms']:.1f}ms "
+            f"process={r['wall_ms']:.1f}ms threads={r['threads']}"
+            + (f" 提前导入: {', '.join(r['eager'])}" if r["eager"] else "")
+        )
+        for cum_us, _, name, _ in r["top"][: args.top]:
+            print(f"      {cum_us / 1000:8.1f}ms  {name}")
+    print(f"预算：每个入口模块导入 ≤ {args.budget_ms:.0f}ms，且导入时不启动线程")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
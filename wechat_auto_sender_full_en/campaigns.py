@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+campaigns.py
+群发活动（涨价通知、节假日配送安排等）：
+- create：模板 + 客户筛选条件（segment）+ 公共变量 + 按客户的变量覆盖，收件人一次性批量写入
+- start：按模板实际引用到的变量的取值给收件人分组（variant），每种组合只渲染一次，存入 campaign_variants；
+  模板里不引用 customer_name 之类的个人变量时，一万个客户也只渲染一次
+- 发送：调度器每个 tick 在配送确认之后按优先级规则取一小批（见 quota / interleave），
+  与确认任务在同一账号分片里串行发送，配送确认永远优先
+- pause / resume / cancel / progress：暂停后正在进行的 tick 里剩余的收件人也会跳过
+- 发送前写发送日志 intent（journal.py），中途崩溃的收件人改为 unconfirmed 而不是重发；
+  核对后 retry ID --unconfirmed 放回 pending
+
+segment 可用的条件（都可省略，省略即全部在用客户）：
+    {"sub_type": "by_bottle", "account": "shop2", "customer_ids": [1, 2, 3]}
+
+用法：
+    python campaigns.py create --name 十一配送安排 --template campaign_notice --vars '{"content": "..."}'
+                               [--segment '{"sub_type": "by_amount"}'] [--overrides overrides.json] [--start]
+    python campaigns.py start|pause|resume|cancel|retry ID
+    python campaigns.py retry ID --unconfirmed
+    python campaigns.py status [ID]
+"""
+
+import argparse
+import hashlib
+import json
+import sys
+
+from sqlalchemy import bindparam, func, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+import clock
+import journal
+import metrics
+from db_utils import session_scope
+from log_utils import get_logger, log_context
+from models import Campaign, CampaignRecipient, CampaignVariant, Customer, Subscription
+
+try:
+    from config import CAMPAIGN_MAX_PER_TICK, CAMPAIGN_INTERLEAVE
+except Exception:
+    CAMPAIGN_MAX_PER_TICK = 10
+    CAMPAIGN_INTERLEAVE = 0
+
+logger = get_logger(__name__)
+
+
+class CampaignError(ValueError):
+    pass
+
+
+# ---------------------- 创建与渲染 ----------------------
+def segment_query(spec: dict):
+    """筛选条件 -> 客户 id 查询"""
+    spec = spec or {}
+    q = select(Customer.id).where(func.coalesce(Customer.active, 1) == 1)
+    if spec.get("customer_ids"):
+        q = q.where(Customer.id.in_(spec["customer_ids"]))
+    if spec.get("account"):
+        q = q.where(Customer.account == spec["account"])
+    if spec.get("sub_type"):
+        q = q.where(
+            Customer.id.in_(
+                select(Subscription.customer_id).where(
+                    Subscription.type == spec["sub_type"], Subscription.status == "active"
+                )
+            )
+        )
+    return q.order_by(Customer.id)
+
+
+def create(s, name: str, template_key: str, segment: dict = None, variables: dict = None,
+           overrides: dict = None) -> Campaign:
+    """新建活动（draft）并写入收件人；overrides 为 {customer_id: {变量: 值}}"""
+    from hook import template_variables
+
+    try:
+        template_variables(template_key)
+    except Exception as e:
+        raise CampaignError(f"模板不可用：{template_key}（{e}）")
+    now = clock.now()
+    c = Campaign(
+        name=name, template_key=template_key,
+        segment_json=json.dumps(segment or {}, ensure_ascii=False),
+        variables_json=json.dumps(variables or {}, ensure_ascii=False),
+        status="draft", created_at=now, updated_at=now,
+    )
+    s.add(c)
+    s.flush()
+    overrides = {int(k): v for k, v in (overrides or {}).items()}
+    ids = list(s.execute(segment_query(segment)).scalars())
+    missing = set(overrides) - set(ids)
+    if missing:
+        logger.warning(f"campaign#{c.id}: {len(missing)} 个覆盖变量的客户不在筛选结果中，已忽略")
+    rows = [
+        {
+            "campaign_id": c.id, "customer_id": cid, "status": "pending", "try_count": 0, "updated_at": now,
+            "overrides_json": json.dumps(overrides[cid], ensure_ascii=False) if cid in overrides else None,
+        }
+        for cid in ids
+    ]
+    if rows:
+        s.execute(sqlite_insert(CampaignRecipient.__table__).on_conflict_do_nothing(), rows)
+    logger.info(f"campaign#{c.id} {name}: {len(rows)} 个收件人")
+    return c
+
+
+def _variant_key(values: dict) -> str:
+    raw = json.dumps(values, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def render_variants(s, c: Campaign) -> int:
+    """给尚未分组的收件人分配 variant，并渲染新出现的组合；返回新渲染的 variant 数"""
+    from hook import render_template, template_variables
+
+    used = template_variables(c.template_key)
+    shared = json.loads(c.variables_json or "{}")
+    rows = s.execute(
+        select(CampaignRecipient.id, CampaignRecipient.overrides_json, Customer.name, Customer.wx_display_name)
+        .join(Customer, Customer.id == CampaignRecipient.customer_id)
+        .where(CampaignRecipient.campaign_id == c.id, CampaignRecipient.variant_key.is_(None))
+    ).all()
+    have = set(
+        s.execute(select(CampaignVariant.variant_key).where(CampaignVariant.campaign_id == c.id)).scalars()
+    )
+    assign, counts, new = [], {}, {}
+    for rid, ov, name, wx_name in rows:
+        values = {"customer_name": name or wx_name, **shared, **(json.loads(ov) if ov else {})}
+        values = {k: v for k, v in values.items() if k in used}
+        key = _variant_key(values)
+        if key not in have and key not in new:
+            new[key] = render_template(c.template_key, values)
+        counts[key] = counts.get(key, 0) + 1
+        assign.append({"rid": rid, "vk": key})
+    if new:
+        s.execute(
+            CampaignVariant.__table__.insert(),
+            [{"campaign_id": c.id, "variant_key": k, "text": text, "recipients": 0} for k, text in new.items()],
+        )
+    if assign:
+        t = CampaignRecipient.__table__
+        s.execute(update(t).where(t.c.id == bindparam("rid")).values(variant_key=bindparam("vk")), assign)
+        v = CampaignVariant.__table__
+        s.execute(
+            update(v)
+            .where(v.c.campaign_id == c.id, v.c.variant_key == bindparam("vk"))
+            .values(recipients=v.c.recipients + bindparam("n")),
+            [{"vk": k, "n": n} for k, n in counts.items()],
+        )
+    logger.info(f"campaign#{c.id}: {len(assign)} 个收件人，新渲染 {len(new)} 个 variant")
+    return len(new)
+
+
+# ---------------------- 状态控制 ----------------------
+_TRANSITIONS = {
+    "start": ({"draft"}, "running"),
+    "pause": ({"running"}, "paused"),
+    "resume": ({"paused"}, "running"),
+    "cancel": ({"draft", "running", "paused"}, "canceled"),
+}
+
+
+def _get(s, campaign_id: int) -> Campaign:
+    c = s.get(Campaign, campaign_id)
+    if c is None:
+        raise CampaignError(f"活动不存在：#{campaign_id}")
+    return c
+
+
+def transition(s, campaign_id: int, action: str) -> Campaign:
+    c = _get(s, campaign_id)
+    allowed, target = _TRANSITIONS[action]
+    if c.status not in allowed:
+        raise CampaignError(f"活动 #{c.id} 当前为 {c.status}，不能 {action}")
+    now = clock.now()
+    if action == "start":
+        render_variants(s, c)
+        c.started_at = now
+    c.status = target
+    c.updated_at = now
+    logger.info(f"campaign#{c.id} -> {target}")
+    return c
+
+
+def start(s, campaign_id: int) -> Campaign:
+    return transition(s, campaign_id, "start")
+
+
+def pause(s, campaign_id: int) -> Campaign:
+    return transition(s, campaign_id, "pause")
+
+
+def resume(s, campaign_id: int) -> Campaign:
+    return transition(s, campaign_id, "resume")
+
+
+def cancel(s, campaign_id: int) -> Campaign:
+    return transition(s, campaign_id, "cancel")
+
+
+def retry_failed(s, campaign_id: int, unconfirmed: bool = False) -> int:
+    """
+    失败的收件人放回 pending；已完成的活动重新进入 running。
+    unconfirmed=True 时改为放回发送中断（journal.UNCONFIRMED）的收件人，确认对方没收到后再用
+    """
+    c = _get(s, campaign_id)
+    status = journal.UNCONFIRMED if unconfirmed else "failed"
+    n = s.execute(
+        update(CampaignRecipient)
+        .where(CampaignRecipient.campaign_id == c.id, CampaignRecipient.status == status)
+        .values(status="pending", updated_at=clock.now())
+    ).rowcount
+    if n and c.status == "done":
+        c.status, c.finished_at, c.updated_at = "running", None, clock.now()
+    return n
+
+
+def progress(s, campaign_id: int) -> dict:
+    c = _get(s, campaign_id)
+    counts = dict(
+        s.execute(
+            select(CampaignRecipient.status, func.count())
+            .where(CampaignRecipient.campaign_id == c.id)
+            .group_by(CampaignRecipient.status)
+        ).all()
+    )
+    total = sum(counts.values())
+    done = total - counts.get("pending", 0)
+    variants = s.execute(
+        select(func.count()).where(CampaignVariant.campaign_id == c.id)
+    ).scalar()
+    return {
+        "id": c.id, "name": c.name, "status": c.status, "template_key": c.template_key,
+        "total": total, "counts": counts, "variants": variants,
+        "percent": (done / total * 100) if total else 100.0,
+        "started_at": c.started_at, "finished_at": c.finished_at,
+    }
+
+
+def _finish_if_done(s, c: Campaign):
+    left = s.execute(
+        select(func.count())
+        .where(CampaignRecipient.campaign_id == c.id, CampaignRecipient.status == "pending")
+    ).scalar()
+    if not left and c.status == "running":
+        c.status, c.finished_at, c.updated_at = "done", clock.now(), clock.now()
+        logger.info(f"campaign#{c.id} 已全部发送")
+
+
+# ---------------------- 调度：优先级与发送 ----------------------
+def has_running(s) -> bool:
+    return s.execute(select(Campaign.id).where(Campaign.status == "running").limit(1)).first() is not None
+
+
+def quota(n_confirmations: int) -> int:
+    """本 tick 某账号可发的群发条数：没有确认任务时发满，有确认时按 CAMPAIGN_INTERLEAVE 让路"""
+    if n_confirmations == 0:
+        return CAMPAIGN_MAX_PER_TICK
+    if CAMPAIGN_INTERLEAVE > 0:
+        return min(CAMPAIGN_MAX_PER_TICK, n_confirmations // CAMPAIGN_INTERLEAVE)
+    return 0
+
+
+def interleave(confirmations: list, broadcasts: list) -> list:
+    """确认任务保持原顺序；每 CAMPAIGN_INTERLEAVE 条确认后插入一条群发，剩余的群发排在最后"""
+    if not broadcasts:
+        return list(confirmations)
+    if CAMPAIGN_INTERLEAVE <= 0:
+        return list(confirmations) + list(broadcasts)
+    out, rest = [], list(broadcasts)
+    for i, job in enumerate(confirmations, 1):
+        out.append(job)
+        if i % CAMPAIGN_INTERLEAVE == 0 and rest:
+            out.append(rest.pop(0))
+    return out + rest
+
+
+def fetch_due(s, limit: int, account: str = None, include_unassigned: bool = False, exclude=()) -> list:
+    """
+    进行中活动的待发收件人 id（按活动、收件人顺序），账号过滤规则同 fetch_due_tasks。
+    exclude：intent 尚未关闭的收件人（journal.pending_recipient_ids），库里仍是 pending 也不能再发
+    """
+    if limit <= 0:
+        return []
+    R = CampaignRecipient
+    q = (
+        select(R.id)
+        .join(Campaign, Campaign.id == R.campaign_id)
+        .where(Campaign.status == "running", R.status == "pending")
+    )
+    if exclude:
+        q = q.where(R.id.not_in(list(exclude)))
+    if account is not None:
+        cond = Customer.account == account
+        if include_unassigned:
+            cond = cond | Customer.account.is_(None)
+        q = q.join(Customer, Customer.id == R.customer_id).where(cond)
+    return list(s.execute(q.order_by(R.campaign_id, R.id).limit(limit)).scalars())
+
+
+_lines_cache = {}
+
+
+def _variant_lines(s, campaign_id: int, variant_key: str) -> list:
+    k = (campaign_id, variant_key)
+    if k not in _lines_cache:
+        text = s.execute(
+            select(CampaignVariant.text)
+            .where(CampaignVariant.campaign_id == campaign_id, CampaignVariant.variant_key == variant_key)
+        ).scalar()
+        if text is None:
+            raise CampaignError(f"campaign#{campaign_id} 缺少 variant {variant_key}")
+        if len(_lines_cache) > 256:
+            _lines_cache.clear()
+        _lines_cache[k] = text.splitlines()
+    return _lines_cache[k]
+
+
+def send_recipient(recipient_id: int):
+    """
+    发送一条群发消息（调度器分片线程里调用，与 hook.process_one_task 同一节奏）。
+    发送前写 intent（fsync），状态提交后关闭；提交失败时转为遗留 intent，由下个 tick 标记为 unconfirmed
+    """
+    import sender
+
+    opened = committed = False
+    try:
+        with log_context(campaign_recipient=recipient_id), session_scope() as s:
+            r = s.get(CampaignRecipient, recipient_id)
+            if r is None or r.status != "pending":
+                return
+            c = s.get(Campaign, r.campaign_id)
+            if c.status != "running":  # tick 中途被暂停/取消
+                return
+            cust = s.get(Customer, r.customer_id)
+            try:
+                if r.variant_key is None:
+                    render_variants(s, c)
+                    s.refresh(r)
+                lines = _variant_lines(s, c.id, r.variant_key)
+                journal.intent(recipient_id=recipient_id)
+                opened = True
+                with metrics.span("send"):
+                    sender.send_text_lines(
+                        cust.wx_display_name or cust.name, lines, mode=sender.message_mode(c.template_key)
+                    )
+                r.status, r.result_log = "sent", "ok"
+            except Exception as e:
+                logger.exception(e)
+                r.status, r.result_log = "failed", str(e)[:1000]
+            r.try_count = (r.try_count or 0) + 1
+            r.updated_at = clock.now()
+            metrics.inc("campaign_messages_total", outcome=r.status)
+            s.flush()
+            _finish_if_done(s, c)
+        committed = True
+    finally:
+        if opened and committed:
+            journal.abort(recipient_id=recipient_id)
+        elif opened:
+            journal.orphan(recipient_id=recipient_id)
+
+
+# ---------------------- 命令行 ----------------------
+def _print_progress(p: dict):
+    counts = "，".join(f"{k} {v}" for k, v in sorted(p["counts"].items())) or "无收件人"
+    print(
+        f"#{p['id']} {p['name']} [{p['status']}] 模板 {p['template_key']}：{p['total']} 人，"
+        f"{p['variants']} 个 variant，进度 {p['percent']:.1f}%（{counts}）"
+    )
+
+
+def main(argv=None) -> int:
+    from db_utils import init_db
+
+    ap = argparse.ArgumentParser(description="群发活动")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("create", help="新建活动")
+    p.add_argument("--name", required=True)
+    p.add_argument("--template", required=True, help="模板键（templates/<键>.j2）")
+    p.add_argument("--segment", help="筛选条件 JSON")
+    p.add_argument("--vars", help="公共变量 JSON")
+    p.add_argument("--overrides", help="按客户覆盖变量的 JSON 文件：{客户ID: {变量: 值}}")
+    p.add_argument("--start", action="store_true", help="创建后立即开始")
+    for name in ("start", "pause", "resume", "cancel"):
+        sub.add_parser(name).add_argument("id", type=int)
+    p = sub.add_parser("retry", help="失败的收件人重新排队")
+    p.add_argument("id", type=int)
+    p.add_argument("--unconfirmed", action="store_true", help="改为放回发送中断、已核对未收到的收件人")
+    sub.add_parser("status").add_argument("id", type=int, nargs="?")
+    args = ap.parse_args(argv)
+
+    init_db()
+    try:
+        with session_scope() as s:
+            if args.cmd == "create":
+                overrides = None
+                if args.overrides:
+                    with open(args.overrides, encoding="utf-8") as f:
+                        overrides = json.load(f)
+                c = create(
+                    s, args.name, args.template,
+                    segment=json.loads(args.segment) if args.segment else None,
+                    variables=json.loads(args.vars) if args.vars else None,
+                    overrides=overrides,
+                )
+                if args.start:
+                    start(s, c.id)
+                s.flush()
+                _print_progress(progress(s, c.id))
+            elif args.cmd == "retry":
+                what = "发送中断" if args.unconfirmed else "失败"
+                print(f"已放回 {retry_failed(s, args.id, unconfirmed=args.unconfirmed)} 个{what}的收件人")
+            elif args.cmd == "status":
+                ids = [args.id] if args.id else list(
+                    s.execute(select(Campaign.id).order_by(Campaign.id.desc()).limit(20)).scalars()
+                )
+                for cid in ids:
+                    _print_progress(progress(s, cid))
+            else:
+                transition(s, args.id, args.cmd)
+                _print_progress(progress(s, args.id))
+    except (CampaignError, json.JSONDecodeError) as e:
+        print(f"❌ {e}")
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+capacity.py
+积压清空时间（ETA）与容量预估：
+- 理论模型：按 sender/scheduler 的实际停顿参数估算每条任务耗时
+  （全局间隔 + 激活窗口 + 打开联系人 + 消息耗时；逐行发送时为 每行粘贴/安全间隔 × 模板行数，
+  合成一条消息时只有一次安全间隔，见 sender.message_mode）
+- 经验修正：最近已发送任务 updated_at 的相邻间隔与理论值之比（剔除空闲间隔）
+- 按 send_time 顺序推演今天到期的待发队列（多账号时每个账号一条并行的时间线），给出全部发完的时间，
+  并标出会迟到超过阈值的任务；发送时间或配送日在明天及以后的任务不计入积压，只单独报告条数
+"""
+
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import clock
+from sender import message_mode
+from config import (
+    GLOBAL_MIN_INTERVAL,
+    SAFE_GAP_PER_MSG,
+    JITTER_SECONDS,
+    TEMPLATE_DIR,
+    NIGHT_SILENT,
+    NIGHT_START,
+    NIGHT_END,
+)
+
+try:
+    from config import CAPACITY_LATE_THRESHOLD_MINUTES, CAPACITY_HISTORY_SIZE
+except Exception:
+    CAPACITY_LATE_THRESHOLD_MINUTES = 30
+    CAPACITY_HISTORY_SIZE = 200
+
+# 两条已发送任务间隔超过该值视为中间有空闲，不计入经验耗时
+_IDLE_GAP_SECONDS = 300
+# 经验样本少于该数时只用理论模型
+_MIN_SAMPLES = 10
+
+
+def _mean(a: float, b: float) -> float:
+    return (a + b) / 2
+
+
+def contact_open_seconds() -> float:
+    """激活窗口 + 搜索并打开联系人的平均耗时（与 sender.py 中的停顿一一对应）"""
+    focus = 0.5
+    open_search = _mean(*JITTER_SECONDS)
+    paste_name = _mean(0.2, 0.5)
+    wait_result = _mean(0.5, 0.8)
+    enter_pause = 0.6 + 0.3
+    click_pause = 0.3 + 0.3
+    return focus + open_search + paste_name + wait_result + enter_pause + click_pause
+
+
+def per_line_seconds() -> float:
+    """每行消息：粘贴 + 粘贴后抖动 + 安全间隔（含随机部分）"""
+    return _mean(0.2, 0.5) + _mean(0.4, 0.9) + float(SAFE_GAP_PER_MSG) + 0.3
+
+
+_line_cache = {}
+
+
+def template_lines(key: str) -> int:
+    """模板中的非空行数（即每条任务要粘贴几次）"""
+    if key not in _line_cache:
+        p = Path(TEMPLATE_DIR) / f"{key}.j2"
+        try:
+            n = sum(1 for line in p.read_text(encoding="utf-8").splitlines() if line.strip())
+        except OSError:
+            n = 1
+        _line_cache[key] = max(1, n)
+    return _line_cache[key]
+
+
+def message_seconds(template_key: str) -> float:
+    """发送一条任务的消息部分：逐行时每行一次完整的粘贴+安全间隔；合成时只回车一次"""
+    n = template_lines(template_key)
+    mode = message_mode(template_key)
+    if mode == "per_line" or n == 1:
+        return per_line_seconds() * n
+    if mode == "paste":
+        return per_line_seconds()
+    return per_line_seconds() + (n - 1) * _mean(0.2, 0.5)  # shift_enter：每多一行多一次粘贴
+
+
+def model_task_seconds(template_key: str) -> float:
+    return float(GLOBAL_MIN_INTERVAL) + contact_open_seconds() + message_seconds(template_key)
+
+
+def observed_scale(s, limit: int = CAPACITY_HISTORY_SIZE):
+    """
+    实测耗时 / 理论耗时 的比值（取中位数）：用最近已发送任务 updated_at 的相邻间隔，
+    与同一批任务按模板算出的理论耗时对比。样本不足返回 None。
+    """
+    from models import Task
+
+    rows = (
+        s.query(Task.updated_at, Task.template_key)
+        .filter(Task.status == "sent", Task.updated_at.isnot(None))
+        .order_by(Task.updated_at.desc())
+        .limit(limit)
+        .all()
+    )
+    rows.sort(key=lambda r: r[0])
+    ratios = []
+    for (a, _), (b, key) in zip(rows, rows[1:]):
+        gap = (b - a).total_seconds()
+        if 0 < gap <= _IDLE_GAP_SECONDS:
+            ratios.append(gap / model_task_seconds(key))
+    if len(ratios) < _MIN_SAMPLES:
+        return None
+    ratios.sort()
+    return ratios[len(ratios) // 2]
+
+
+def _skip_night(dt: datetime) -> datetime:
+    """若处于夜间静默时段，推到静默结束时刻"""
+    if not NIGHT_SILENT:
+        return dt
+    h = dt.hour
+    if NIGHT_START <= NIGHT_END:
+        silent = NIGHT_START <= h < NIGHT_END
+    else:
+        silent = h >= NIGHT_START or h < NIGHT_END
+    if not silent:
+        return dt
+    resume = dt.replace(hour=NIGHT_END, minute=0, second=0, microsecond=0)
+    if resume <= dt:
+        resume += timedelta(days=1)
+    return resume
+
+
+def estimate_drain(s, now: datetime = None, late_threshold_minutes: float = CAPACITY_LATE_THRESHOLD_MINUTES):
+    """
+    推演今天到期的 pending 队列（send_time 早于明天零点且配送日不晚于今天）的发送时间线。
+    返回：pending、per_task_seconds（各模板，已乘经验修正）、source（model/observed）、
+         drain_seconds、eta、late（[(task_id, send_time, 预计完成, 迟到分钟)]）、
+         shards（参与发送的账号数）、unrouted（客户账号未配置、不会被发送的任务数）、
+         future / future_first（明天及以后的 pending 任务数与其中最早的 send_time，不参与推演）
+    """
+    from sqlalchemy import and_, func, not_, or_
+
+    from models import Customer, Task
+    from sender import account_names
+
+    now = now or clock.now()
+    observed = observed_scale(s)
+    scale = observed or 1.0
+    accounts = account_names()
+
+    horizon = datetime(now.year, now.month, now.day) + timedelta(days=1)
+    due_today = and_(
+        Task.send_time < horizon,
+        or_(Task.delivery_date.is_(None), Task.delivery_date <= now.strftime("%Y-%m-%d")),
+    )
+    rows = (
+        s.query(Task.id, Task.send_time, Task.template_key, Customer.account)
+        .join(Customer, Customer.id == Task.customer_id)
+        .filter(Task.status == "pending", due_today)
+        .order_by(Task.send_time.asc(), Task.id.asc())
+        .all()
+    )
+    future, future_first = (
+        s.query(func.count(Task.id), func.min(Task.send_time))
+        .filter(Task.status == "pending", not_(due_today))
+        .one()
+    )
+    costs = {}
+    lanes = {}  # 账号 -> 该账号时间线上的当前时刻
+    late = []
+    unrouted = 0
+    threshold = timedelta(minutes=late_threshold_minutes)
+    for tid, send_time, key, account in rows:
+        lane = account or accounts[0]
+        if lane not in accounts:
+            unrouted += 1
+            continue
+        if key not in costs:
+            costs[key] = model_task_seconds(key) * scale
+        start = _skip_night(max(lanes.get(lane, now), send_time))
+        t = lanes[lane] = start + timedelta(seconds=costs[key])
+        if t - send_time > threshold:
+            late.append((tid, send_time, t, (t - send_time).total_seconds() / 60))
+    eta = max(lanes.values()) if lanes else now
+    return {
+        "now": now,
+        "pending": len(rows) - unrouted,
+        "per_task_seconds": costs,
+        "source": "observed" if observed else "model",
+        "drain_seconds": (eta - now).total_seconds(),
+        "eta": eta,
+        "late": late,
+        "late_threshold_minutes": late_threshold_minutes,
+        "shards": len(lanes),
+        "unrouted": unrouted,
+        "future": future,
+        "future_first": future_first,
+    }
+
+
+def describe(est: dict) -> str:
+    """一段给操作员看的中文摘要（GUI 面板与命令行共用）"""
+    future = ""
+    if est.get("future"):
+        future = f"另有 {est['future']} 条明天及以后的任务（最早 {est['future_first']:%m-%d %H:%M}），未计入积压"
+    if not est["pending"]:
+        return "\n".join(x for x in ("今天没有待发任务。", future) if x)
+    avg = sum(est["per_task_seconds"].values()) / max(1, len(est["per_task_seconds"]))
+    src = "近期实测" if est["source"] == "observed" else "参数推算"
+    shards = f"，{est['shards']} 个账号并行" if est.get("shards", 1) > 1 else ""
+    lines = [
+        f"今天待发 {est['pending']} 条；每条约 {avg:.1f} 秒（{src}）{shards}",
+        f"预计 {est['eta']:%m-%d %H:%M} 全部发完（还需 {est['drain_seconds'] / 60:.0f} 分钟）",
+    ]
+    if est["late"]:
+        ids = ", ".join(f"#{x[0]}" for x in est["late"][:8])
+        more = " 等" if len(est["late"]) > 8 else ""
+        lines.append(
+            f"⚠ {len(est['late'])} 条将迟到超过 {est['late_threshold_minutes']:.0f} 分钟：{ids}{more}"
+        )
+    else:
+        lines.append(f"无任务迟到超过 {est['late_threshold_minutes']:.0f} 分钟")
+    if est.get("unrouted"):
+        lines.append(f"⚠ {est['unrouted']} 条任务的客户账号未在 SENDER_ACCOUNTS 中配置，不会发送")
+    if future:
+        lines.append(future)
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    from db_utils import session_scope
+
+    with session_scope() as s:
+        print(describe(estimate_drain(s)))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+changefeed.py
+变更流水（change_feed）的读取与清理：
+- 写入由 SQLite 触发器完成（migrations 005），调用方无需关心
+- GUI 记住读到的最大 id，定时 read(after=该 id)：一条主键范围查询，没有变更时几乎零开销
+- updates 把一批变更归并成“哪些任务变了、哪些客户的余额变了、有哪些新流水”，供 GUI 就地更新
+- prune：删除超过 CHANGE_FEED_RETENTION_HOURS 的旧行（调度器定时调用）
+"""
+
+from datetime import timedelta
+
+from sqlalchemy import delete, func, select
+
+import clock
+from log_utils import get_logger
+from models import ChangeFeed
+
+try:
+    from config import CHANGE_FEED_RETENTION_HOURS
+except Exception:
+    CHANGE_FEED_RETENTION_HOURS = 48
+
+logger = get_logger(__name__)
+
+
+def latest(s) -> int:
+    """当前最大序号（GUI 启动时从这里开始读）"""
+    return s.execute(select(func.max(ChangeFeed.id))).scalar() or 0
+
+
+def read(s, after: int, limit: int = 1000) -> list:
+    """序号大于 after 的变更：[(id, kind, entity_id, customer_id, subscription_id, status)]"""
+    F = ChangeFeed
+    return [
+        tuple(r)
+        for r in s.execute(
+            select(F.id, F.kind, F.entity_id, F.customer_id, F.subscription_id, F.status)
+            .where(F.id > after)
+            .order_by(F.id)
+            .limit(limit)
+        )
+    ]
+
+
+def updates(changes: list) -> dict:
+    """
+    归并一批变更：last（最大序号）、tasks（变更的任务 id → 最新状态）、
+    ledger（新流水 id → 客户 id）、customers（余额可能变化的客户 id）
+    """
+    out = {"last": 0, "tasks": {}, "ledger": {}, "customers": set()}
+    for seq, kind, entity_id, customer_id, _sub_id, status in changes:
+        out["last"] = max(out["last"], seq)
+        if kind == "task":
+            out["tasks"][entity_id] = status
+        elif kind == "ledger":
+            out["ledger"][entity_id] = customer_id
+            out["customers"].add(customer_id)
+    return out
+
+
+def prune(s, hours: float = CHANGE_FEED_RETENTION_HOURS) -> int:
+    before = clock.now() - timedelta(hours=hours)
+    n = s.execute(delete(ChangeFeed).where(ChangeFeed.ts < before)).rowcount
+    if n:
+        logger.info(f"change_feed: 清理 {n} 行（{hours} 小时前）")
+    return n
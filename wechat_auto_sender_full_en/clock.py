@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+clock.py
+可替换的时钟：调度器/发送器/数据库工具统一通过这里取时间和休眠。
+- 默认 RealClock：datetime.now() / time.sleep()
+- VirtualClock：sleep() 只推进虚拟时间（可选按倍速真实等待），用于 simulate.py 快速回放一天
+- timeline()：并行分片（scheduler._run_shard）各自的时间线。VirtualClock 下块内的 sleep 只推进本线程，
+  块结束时全局时间推进到各时间线中最晚的一条，多个分片的休眠因此是重叠而不是相加
+  （同一桌面上界面锁造成的串行部分不建模）；RealClock 下没有作用
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+
+class RealClock:
+    def now(self) -> datetime:
+        return datetime.now()
+
+    def sleep(self, seconds: float):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def monotonic(self) -> float:
+        return time.perf_counter()
+
+
+class VirtualClock:
+    """虚拟时钟：speed=0 表示不真实等待；speed=1000 表示虚拟 1000 秒对应真实 1 秒"""
+
+    def __init__(self, start: datetime, speed: float = 0):
+        self._now = start
+        self._elapsed = 0.0
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._local = threading.local()  # 本线程的时间线：(起点时刻, 起点 elapsed, 已推进秒数)
+
+    def now(self) -> datetime:
+        lane = getattr(self._local, "lane", None)
+        if lane is not None:
+            return lane[0] + timedelta(seconds=lane[2])
+        with self._lock:
+            return self._now
+
+    def sleep(self, seconds: float):
+        if seconds <= 0:
+            return
+        if self.speed:
+            time.sleep(seconds / self.speed)
+        lane = getattr(self._local, "lane", None)
+        if lane is not None:
+            self._local.lane = (lane[0], lane[1], lane[2] + seconds)
+        else:
+            self.advance(seconds)
+
+    @contextmanager
+    def timeline(self, at: datetime = None):
+        with self._lock:
+            at = at or self._now
+            self._local.lane = (at, self._elapsed - (self._now - at).total_seconds(), 0.0)
+        try:
+            yield
+        finally:
+            start, _, spent = self._local.lane
+            self._local.lane = None
+            self.advance_to(start + timedelta(seconds=spent))
+
+    def advance(self, seconds: float):
+        with self._lock:
+            self._now += timedelta(seconds=seconds)
+            self._elapsed += seconds
+
+    def advance_to(self, when: datetime):
+        # 判断与推进在同一把锁内：多个分片的时间线同时结束时不会重复推进
+        with self._lock:
+            delta = (when - self._now).total_seconds()
+            if delta > 0:
+                self._now = when
+                self._elapsed += delta
+
+    def monotonic(self) -> float:
+        lane = getattr(self._local, "lane", None)
+        if lane is not None:
+            return lane[1] + lane[2]
+        with self._lock:
+            return self._elapsed
+
+
+_clock = RealClock()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(c):
+    """替换全局时钟，返回旧时钟（便于恢复）"""
+    global _clock
+    old, _clock = _clock, c
+    return old
+
+
+def now() -> datetime:
+    return _clock.now()
+
+
+def sleep(seconds: float):
+    _clock.sleep(seconds)
+
+
+def monotonic() -> float:
+    return _clock.monotonic()
+
+
+@contextmanager
+def timeline(at: datetime = None):
+    """
+    在块内使用本线程自己的时间线，从 at（默认当前时刻）开始（只对 VirtualClock 生效，见模块说明）。
+    并行分片应传入同一个 at（tick 开始的时刻）：线程启动的先后不影响各自的起点
+    """
+    c = _clock
+    if not hasattr(c, "timeline"):
+        yield
+        return
+    with c.timeline(at):
+        yield
@@ -22,6 +22,9 @@ TEMPLATE_DIR = "templates"
 # 日志文件路径
 LOG_PATH = "wechat_run.log"
 
+# 任务处理器（见 scheduler.PROCESSORS）："hook"=真正渲染/发送/记账，"placeholder"=仅标记 sent
+TASK_PROCESSOR = "hook"
+
 # 调度器每次扫描任务的间隔（秒）
 SCAN_INTERVAL_SECONDS = 20
 
@@ -42,3 +45,110 @@ NIGHT_END = 7      # 早上 7 点前不发
 
 # 微信输入框的点击位置 (x, y)，需根据屏幕实际情况测量
 INPUT_BOX_POS = (1275, 850)
+
+# 消息发送方式：
+# - per_line：每行单独粘贴并回车，每行一个气泡，每行都有安全间隔（原有方式）
+# - paste：所有行合成一段多行文本，一次粘贴、只回车一次，对方收到一条消息
+# - shift_enter：逐行粘贴、行间 Shift+Enter 换行，最后只回车一次
+# TEMPLATE_MESSAGE_MODES 按模板键单独指定，未列出的模板用 MESSAGE_MODE；合成失败时自动退回 per_line
+MESSAGE_MODE = "per_line"
+TEMPLATE_MESSAGE_MODES = {
+    # "statement": "paste",
+}
+
+# 余额预检：每个 tick 在发送前批量推算余额（同一订阅多条任务累计扣减），会透支的任务：
+# - hold：置为 held，不占发送名额；余额补足（充值入账）后自动放回 pending
+# - notice：照常发送，并在消息末尾附加 LOW_BALANCE_TEMPLATE 提醒
+# - fail：直接置为 failed
+OVERDRAW_POLICY = "hold"
+LOW_BALANCE_TEMPLATE = "low_balance_notice"
+
+# 续费提醒（forecast.py）：预计 REMINDER_DAYS_AHEAD 天内余额用完的订阅生成一条提醒任务，
+# 同一订阅 REMINDER_COOLDOWN_DAYS 天内只提醒一次；发送时间取客户的 preferred_send_time，没有则 REMINDER_SEND_TIME
+# 日均消耗取最近 FORECAST_HISTORY_DAYS 天的配送流水；FORECAST_AT 为调度器每天运行预测的时间，None=不自动运行
+REMINDER_TEMPLATE = "low_balance_reminder"
+REMINDER_DAYS_AHEAD = 3
+REMINDER_COOLDOWN_DAYS = 7
+REMINDER_SEND_TIME = "09:00"
+FORECAST_HISTORY_DAYS = 28
+FORECAST_AT = "08:00"
+
+# 发送时间排期（sendplan.py）：按账号把一天切成 SEND_PLAN_SLOT_MINUTES 分钟的时段，每个时段最多排满
+# SEND_PLAN_SLOT_LOAD（0~1）的发送耗时；有 preferred_send_time 的客户最早提前 SEND_PLAN_EARLY_MINUTES 分钟发送
+# SEND_PLAN_AT 为调度器每天为次日排期的时间，None=不自动排期（可手动 python sendplan.py）
+SEND_PLAN_SLOT_MINUTES = 5
+SEND_PLAN_SLOT_LOAD = 0.8
+SEND_PLAN_EARLY_MINUTES = 20
+SEND_PLAN_AT = None
+
+# 群发活动（campaigns.py）与配送确认的优先级：
+# - 本 tick 没有到期的配送确认时，每个账号最多发 CAMPAIGN_MAX_PER_TICK 条群发
+# - 有到期确认时：CAMPAIGN_INTERLEAVE=0 则群发完全让路；=N 则每 N 条确认后穿插 1 条群发
+CAMPAIGN_MAX_PER_TICK = 10
+CAMPAIGN_INTERLEAVE = 0
+
+# 发送结果分组提交（journal.py）：发送成功后结果先追加到本地日志并 fsync 即确认，
+# 数据库写入攒到 COMMIT_BATCH_SIZE 条或最早一条等待超过 COMMIT_MAX_DELAY_SECONDS 秒时一次事务提交，
+# 每个 tick 结束也会提交；进程崩溃后下次启动从日志补写（幂等），不丢流水、不重发。
+# 发送前还会记一条 intent：发送中途崩溃的任务重启后标记为 unconfirmed，核对后用 python journal.py resolve 处理
+COMMIT_BATCH_SIZE = 20
+COMMIT_MAX_DELAY_SECONDS = 5
+SEND_JOURNAL_PATH = "send_journal.jsonl"
+
+# 指标采集：阶段耗时/计数器，导出到 Prometheus 文本文件 + metrics 表
+METRICS_ENABLED = True
+METRICS_PROM_PATH = "metrics.prom"
+METRICS_WINDOW = 1024   # 滚动分位数使用最近 N 个样本
+METRICS_DB_INTERVAL_SECONDS = 300  # metrics 表最多每隔多少秒写一次，且只写有变化的指标（textfile 仍每个 tick 更新）
+METRICS_RETENTION_DAYS = 14        # metrics 表保留天数（调度器每小时清理一次更旧的行）
+
+# 性能剖析（默认关闭；也可设置环境变量 WECHAT_PROFILE=1 开启）
+PROFILE_ENABLED = False
+PROFILE_DIR = "profiles"
+PROFILE_THRESHOLD_MS = 500      # 只保留耗时超过该值的调用
+PROFILE_KEEP = 200              # 目录内最多保留的调用记录数
+PROFILE_SAMPLE_INTERVAL = 0.005  # 调用栈采样间隔（秒）
+
+# 发送时截图留存（只截微信窗口，后台线程压缩保存到 AUDIT_DIR/日期/）
+SCREENSHOT_ON_SEND = False
+AUDIT_FORMAT = "WEBP"        # WEBP 或 JPEG
+AUDIT_QUALITY = 60
+AUDIT_RETENTION_DAYS = 30    # 超过天数的截图与索引自动清理；0=不清理
+AUDIT_DUP_THRESHOLD = 4      # 与同一任务上一张的感知哈希距离 ≤ 该值视为重复，不保存
+AUDIT_QUEUE_SIZE = 64        # 待编码队列上限，满了直接丢弃
+
+# 日志：LOG_PATH 为 JSON 行格式，按大小/时间轮转并 gzip 压缩
+LOG_FILE_LEVEL = "DEBUG"
+LOG_CONSOLE_LEVEL = "INFO"
+LOG_MAX_BYTES = 20 * 1024 * 1024
+LOG_ROTATE_WHEN_SECONDS = 24 * 3600
+LOG_BACKUP_COUNT = 14
+
+# 积压预估：预计迟到超过该分钟数的任务会被标出；经验修正使用最近 N 条已发送任务
+CAPACITY_LATE_THRESHOLD_MINUTES = 30
+CAPACITY_HISTORY_SIZE = 200
+
+# 批量导入：每个事务写入的行数
+IMPORT_CHUNK_SIZE = 5000
+
+# 导出：每批从数据库取的行数；SQLite 使用 WAL 模式，导出等长查询不阻塞调度器写入
+EXPORT_BATCH_SIZE = 2000
+SQLITE_WAL = True
+
+# 台账日汇总：调度器每隔多少秒增量汇总一次新流水；0=不自动汇总（可手动 python rollups.py refresh）
+ROLLUP_INTERVAL_SECONDS = 300
+
+# 变更流水（changefeed.py）：GUI 每隔多少毫秒读一次新变更并就地更新打开的列表；0=不自动刷新
+CHANGE_FEED_POLL_MS = 2000
+# 变更流水保留多少小时（调度器每小时清理一次更旧的行）
+CHANGE_FEED_RETENTION_HOURS = 48
+
+# 多账号分片发送：账号名 -> 该账号的微信窗口与节奏（可选项见 sender.WeChatSender）
+# - window_index：多开时按窗口位置从左到右第几个；input_box_pos：该窗口输入框坐标
+# - min_interval / safe_gap：该账号自己的任务间隔 / 每行间隔；maximize：多开并排时设为 False
+# 客户的 account 列为空时走第一个账号；账号之间并行发送（同一桌面共用键鼠，界面操作互斥）
+# 多个桌面各跑一个进程时，用环境变量 WECHAT_ACCOUNTS=账号1,账号2 指定本进程负责的账号
+SENDER_ACCOUNTS = {
+    "default": {},
+    # "shop2": {"window_index": 1, "input_box_pos": (1900, 850), "maximize": False},
+}
@@ -1,19 +1,54 @@
 # -*- coding: utf-8 -*-
+import json
+import os
+import socket
+import threading
 from contextlib import contextmanager
-from decimal import Decimal
-from datetime import datetime
+from datetime import timedelta
 
-from sqlalchemy import create_engine, func
+from sqlalchemy import create_engine, event, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker
 
+import clock
+import rows
 from config import DB_URL
-from models import Base, Customer, Subscription, LedgerTransaction, Task
+from money import Money, ZERO
+from models import Base, Subscription, LedgerTransaction, Task, TaskAttempt, DEFAULT_SLOT
 
-_engine = create_engine(DB_URL, pool_pre_ping=True, future=True)
+try:
+    from config import SQLITE_WAL
+except Exception:
+    SQLITE_WAL = True
+
+def _make_engine(db_url: str):
+    engine = create_engine(db_url, pool_pre_ping=True, future=True)
+    if SQLITE_WAL and engine.dialect.name == "sqlite":
+        # WAL：长时间的只读查询（导出/报表）不会挡住调度器的写入
+        @event.listens_for(engine, "connect")
+        def _set_wal(dbapi_conn, _):
+            cur = dbapi_conn.cursor()
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.close()
+    return engine
+
+_engine = _make_engine(DB_URL)
 _SessionLocal = sessionmaker(bind=_engine, future=True)
 
-def init_db():
-    Base.metadata.create_all(_engine)
+def configure(db_url: str):
+    """切换到另一个数据库（模拟/离线工具用，避免碰生产库）"""
+    global _engine
+    _engine.dispose()
+    _engine = _make_engine(db_url)
+    _SessionLocal.configure(bind=_engine)
+
+def init_db(engine=None):
+    """建表并执行未完成的数据迁移；独立脚本可传入自己的 engine"""
+    import migrations
+
+    engine = engine or _engine
+    Base.metadata.create_all(engine)
+    migrations.upgrade(engine)
 
 @contextmanager
 def session_scope():
@@ -27,37 +62,148 @@ def session_scope():
     finally:
         s.close()
 
-def fetch_due_tasks(s, now=None, limit=50):
-    now = now or datetime.now()
+def fetch_due_tasks(s, now=None, limit=50, account=None, include_unassigned=False):
+    """
+    到期待发任务（只读的 rows.TaskRow；要修改时按 id 取 ORM 对象）。指定 account 时只取该发送账号的客户；
+    include_unassigned=True 时同时包含未分配账号（customers.account 为空）的客户。
+    """
+    return rows.due_tasks(s, now or clock.now(), limit, account, include_unassigned)
+
+def count_due_tasks(s, now=None) -> int:
+    """到期未发送的任务总数（队列深度），不受 fetch_due_tasks 的 limit 限制"""
+    now = now or clock.now()
     return (
-        s.query(Task)
+        s.query(func.count(Task.id))
         .filter(Task.status == "pending", Task.send_time <= now)
-        .order_by(Task.send_time.asc())
-        .limit(limit)
-        .all()
+        .scalar()
+    ) or 0
+
+def queue_stats(s, now=None, window_minutes: int = 60) -> dict:
+    """
+    队列概况（main.py stats 用，只读几条聚合查询）：
+    due 到期未发数、oldest_lag 最早一条到期任务已延迟的秒数、by_status 各状态任务数、
+    sent_in_window / per_hour 最近 window_minutes 分钟发送成功数与折算的每小时吞吐、
+    next_send_time 下一条未到期任务的发送时间
+    """
+    now = now or clock.now()
+    due, oldest = s.execute(
+        select(func.count(Task.id), func.min(Task.send_time))
+        .where(Task.status == "pending", Task.send_time <= now)
+    ).one()
+    since = now - timedelta(minutes=window_minutes)
+    sent = s.execute(
+        select(func.count(TaskAttempt.id))
+        .where(TaskAttempt.outcome == "sent", TaskAttempt.started_at >= since)
+    ).scalar() or 0
+    return {
+        "due": due or 0,
+        "oldest_lag": max(0.0, (now - oldest).total_seconds()) if oldest else 0.0,
+        "by_status": dict(s.execute(select(Task.status, func.count(Task.id)).group_by(Task.status)).all()),
+        "sent_in_window": sent,
+        "per_hour": sent * 60 / window_minutes,
+        "next_send_time": s.execute(
+            select(func.min(Task.send_time)).where(Task.status == "pending", Task.send_time > now)
+        ).scalar(),
+    }
+
+_TASK_KEY = ["subscription_id", "delivery_date", "slot"]
+_TASK_UPSERT_FIELDS = ["customer_id", "send_time", "template_key", "delivered_bottles", "remark", "payload_json"]
+
+def _task_row(row: dict, now) -> dict:
+    r = {k: row.get(k) for k in ["subscription_id", *_TASK_UPSERT_FIELDS]}
+    if r["subscription_id"] is None:
+        # 唯一索引不约束 NULL：没有订阅的任务每次重跑都会再插一条
+        raise ValueError("任务必须关联订阅：subscription_id 为空时自然键不生效")
+    r["delivery_date"] = row.get("delivery_date") or r["send_time"].strftime("%Y-%m-%d")
+    r["slot"] = row.get("slot") or DEFAULT_SLOT
+    r["created_at"] = r["updated_at"] = now
+    return r
+
+def _task_upsert_stmt():
+    t = Task.__table__
+    stmt = sqlite_insert(t)
+    return stmt.on_conflict_do_update(
+        index_elements=_TASK_KEY,
+        set_={**{k: stmt.excluded[k] for k in _TASK_UPSERT_FIELDS}, "updated_at": stmt.excluded.updated_at},
+        where=t.c.status == "pending",  # 已发送/失败/取消的任务不被覆盖
     )
 
+def upsert_tasks(s, rows: list) -> int:
+    """
+    按自然键 (subscription_id, delivery_date, slot) 幂等写入任务：INSERT … ON CONFLICT DO UPDATE。
+    冲突且仍为 pending 时更新 send_time/模板/内容，否则保持原样；生成脚本可以放心重跑。
+    rows：customer_id, subscription_id, send_time, template_key, delivered_bottles, [remark],
+          [payload_json（扩展字段）], [delivery_date], [slot]
+    返回插入或更新的行数。
+    """
+    if not rows:
+        return 0
+    now = clock.now()
+    return s.execute(_task_upsert_stmt(), [_task_row(r, now) for r in rows]).rowcount
+
+def upsert_task(s, **fields) -> int:
+    """写入一条任务并返回其 id（冲突时返回已有任务的 id）"""
+    row = _task_row(fields, clock.now())
+    tid = s.execute(_task_upsert_stmt().values(row).returning(Task.__table__.c.id)).scalar()
+    if tid is None:
+        tid = s.execute(
+            select(Task.id).where(*(getattr(Task, k) == row[k] for k in _TASK_KEY))
+        ).scalar()
+    return tid
+
 def mark_task_status(s, task: Task, status: str, result_log: str = None, increment_try=True):
     task.status = status
     if result_log is not None:
         task.result_log = (result_log or "")[:1000]
     if increment_try:
         task.try_count = (task.try_count or 0) + 1
-    task.updated_at = datetime.now()
+    task.updated_at = clock.now()
     s.add(task)
 
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+def attempt_row(task: Task, outcome: str, started_at, duration_ms: float, stages: dict = None,
+                error: BaseException = None, backend: str = None, account: str = None) -> dict:
+    """一条处理尝试的列值；attempt_no 取自尚未递增的 try_count"""
+    return {
+        "task_id": task.id,
+        "attempt_no": (task.try_count or 0) + 1,
+        "started_at": started_at,
+        "finished_at": clock.now(),
+        "duration_ms": round(duration_ms, 2),
+        "stages_json": json.dumps(stages, ensure_ascii=False) if stages else None,
+        "outcome": outcome,
+        "error_class": type(error).__name__ if error is not None else None,
+        "error_message": str(error)[:2000] if error is not None else None,
+        "worker_id": worker_id(),
+        "backend": backend,
+        "account": account,
+    }
+
+def record_attempt(s, task: Task, outcome: str, started_at, duration_ms: float, stages: dict = None,
+                   error: BaseException = None, backend: str = None, account: str = None) -> TaskAttempt:
+    """
+    记一条处理尝试。应在 mark_task_status 之前调用，并与状态变更一起提交，保证 task_attempts 与 tasks 一致。
+    （发送成功的结果走 journal 分组提交，见 attempt_row）
+    """
+    a = TaskAttempt(**attempt_row(task, outcome, started_at, duration_ms, stages, error, backend, account))
+    s.add(a)
+    return a
+
 def add_transaction(
     s,
     subscription_id: int,
     customer_id: int,
     kind: str,
     bottle_delta: int = 0,
-    amount_delta: Decimal = Decimal("0.00"),
+    amount_delta: Money = ZERO,
     ref_task_id: int = None,
     memo: str = None,
 ):
     """新增一条台账流水（正数=入账，负数=扣减）"""
     t = LedgerTransaction(
+        ts=clock.now(),
         subscription_id=subscription_id,
         customer_id=customer_id,
         kind=kind,
@@ -73,24 +219,22 @@ def recalc_subscription_balance(s, subscription_id: int):
     sub = s.get(Subscription, subscription_id)
     if not sub:
         return None
-    bottle_sum = (
-        s.query(func.coalesce(func.sum(LedgerTransaction.bottle_delta), 0))
+    # 金额列为整数分，SUM 在 SQL 中精确完成，结果直接是 Money
+    bottle_sum, amount_sum = (
+        s.query(
+            func.coalesce(func.sum(LedgerTransaction.bottle_delta), 0),
+            func.coalesce(func.sum(LedgerTransaction.amount_delta), 0),
+        )
         .filter(LedgerTransaction.subscription_id == subscription_id)
-        .scalar()
-    )
-    amount_sum = (
-        s.query(func.coalesce(func.sum(LedgerTransaction.amount_delta), 0))
-        .filter(LedgerTransaction.subscription_id == subscription_id)
-        .scalar()
+        .one()
     )
     return {
         "subscription_id": subscription_id,
         "type": sub.type,
-        "unit_price": float(sub.unit_price) if sub.unit_price is not None else None,
+        "unit_price": sub.unit_price,
         "bottle_balance": int(bottle_sum or 0),
-        "amount_balance": float(amount_sum or 0.0),
+        "amount_balance": amount_sum or ZERO,
     }
 
 def recalc_customer_balances(s, customer_id: int):
-    subs = s.query(Subscription).filter(Subscription.customer_id == customer_id).all()
-    return [recalc_subscription_balance(s, x.id) for x in subs]
+    return [b._asdict() for b in rows.customer_balances(s, customer_id)]
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+dedupe.py
+重复任务报告：
+- 确定重复：迁移建唯一索引前已存在、订阅/send_time/模板完全相同的任务，被标记为 slot=dup-<id>；
+  与原任务一起列出，并标出两条都已发送（重复扣费）的情况
+- 可能重复：同一订阅同一配送日有多个不同时段（slot）的任务（含迁移时改为 legacy-<id> 的旧任务），供人工确认
+
+用法：
+    python dedupe.py            # 只出报告
+    python dedupe.py --cancel   # 另外把仍为 pending 的确定重复任务置为 canceled
+"""
+
+import argparse
+import sys
+
+from sqlalchemy import func, select, update
+
+import clock
+from models import LedgerTransaction, Task, REMINDER_SLOT
+
+
+def duplicates(s):
+    """确定重复：[(重复任务, 原任务 id 或 None, 重复任务是否有扣费流水)]"""
+    dups = s.execute(
+        select(Task.id, Task.subscription_id, Task.delivery_date, Task.send_time, Task.template_key, Task.status)
+        .where(Task.slot.like("dup-%"))
+        .order_by(Task.subscription_id, Task.delivery_date, Task.id)
+    ).all()
+    out = []
+    for tid, sub_id, day, send_time, key, status in dups:
+        orig = s.execute(
+            select(Task.id, Task.status)
+            .where(
+                Task.subscription_id == sub_id, Task.send_time == send_time, Task.template_key == key,
+                ~Task.slot.like("dup-%"),
+            )
+            .order_by(Task.id)
+            .limit(1)
+        ).first()
+        charged = s.execute(
+            select(func.count()).where(
+                LedgerTransaction.kind == "delivery", LedgerTransaction.ref_task_id == tid
+            )
+        ).scalar()
+        out.append({
+            "task_id": tid, "subscription_id": sub_id, "delivery_date": day, "status": status,
+            "original_id": orig[0] if orig else None, "original_status": orig[1] if orig else None,
+            "charged": bool(charged),
+        })
+    return out
+
+
+def multi_slot(s):
+    """可能重复：[(subscription_id, delivery_date, [(id, slot, status)])]"""
+    groups = s.execute(
+        select(Task.subscription_id, Task.delivery_date)
+        .where(Task.subscription_id.isnot(None), ~Task.slot.like("dup-%"), Task.slot != REMINDER_SLOT)
+        .group_by(Task.subscription_id, Task.delivery_date)
+        .having(func.count() > 1)
+    ).all()
+    out = []
+    for sub_id, day in groups:
+        rows = s.execute(
+            select(Task.id, Task.slot, Task.status)
+            .where(Task.subscription_id == sub_id, Task.delivery_date == day, Task.slot != REMINDER_SLOT)
+            .order_by(Task.id)
+        ).all()
+        out.append((sub_id, day, [tuple(r) for r in rows]))
+    return out
+
+
+def cancel_pending_duplicates(s) -> int:
+    return s.execute(
+        update(Task)
+        .where(Task.slot.like("dup-%"), Task.status == "pending")
+        .values(status="canceled", result_log="duplicate (dedupe.py)", updated_at=clock.now())
+    ).rowcount
+
+
+def main(argv=None) -> int:
+    from db_utils import init_db, session_scope
+
+    ap = argparse.ArgumentParser(description="重复任务报告")
+    ap.add_argument("--cancel", action="store_true", help="把仍为 pending 的确定重复任务置为 canceled")
+    args = ap.parse_args(argv)
+
+    init_db()
+    with session_scope() as s:
+        dups = duplicates(s)
+        print(f"=== 确定重复：{len(dups)} 条 ===")
+        for d in dups:
+            warn = "  ⚠ 重复扣费" if d["charged"] and d["original_status"] == "sent" else ""
+            print(
+                f"task#{d['task_id']}（{d['status']}）与 task#{d['original_id']}（{d['original_status']}）"
+                f" 订阅#{d['subscription_id']} {d['delivery_date']}{warn}"
+            )
+        groups = multi_slot(s)
+        print(f"\n=== 同日多时段（请确认是否重复）：{len(groups)} 组 ===")
+        for sub_id, day, rows in groups:
+            desc = "，".join(f"#{tid} {slot}/{status}" for tid, slot, status in rows)
+            print(f"订阅#{sub_id} {day}：{desc}")
+        if args.cancel:
+            print(f"\n已取消 {cancel_pending_duplicates(s)} 条待发的重复任务")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
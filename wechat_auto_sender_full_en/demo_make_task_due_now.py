@@ -12,10 +12,10 @@ from sqlalchemy.orm import sessionmaker
 
 from config import DB_URL
 from models import Base, Customer, Subscription, Task
-from db_utils import add_transaction
+from db_utils import add_transaction, init_db, upsert_task
 
 engine = create_engine(DB_URL, future=True)
-Base.metadata.create_all(engine)
+init_db(engine)
 Session = sessionmaker(bind=engine, future=True)
 
 with Session() as s:
@@ -33,12 +33,13 @@ with Session() as s:
         add_transaction(s, subscription_id=sub.id, customer_id=cust.id,
                         kind="purchase", bottle_delta=10, amount_delta=Decimal("0.00"), memo="demo init 10 bottles")
 
-    # 10 秒后到点的任务
+    # 10 秒后到点的任务；每次运行用独立的演练时段（slot），便于反复演练
     now = datetime.now()
-    task = Task(customer_id=cust.id, subscription_id=sub.id,
-                send_time=now + timedelta(seconds=2),
-                template_key="confirm_by_bottle",
-                payload_json='{"delivered_bottles": 2, "remark": "【演练】不回车，仅粘贴"}')
-    s.add(task); s.commit()
-    print(f"✅ 已创建演示任务：task#{task.id}，10 秒后到点。")
+    task_id = upsert_task(s, customer_id=cust.id, subscription_id=sub.id,
+                          send_time=now + timedelta(seconds=2),
+                          template_key="confirm_by_bottle",
+                          delivered_bottles=2, remark="【演练】不回车，仅粘贴",
+                          slot=f"demo-{now:%H%M%S}")
+    s.commit()
+    print(f"✅ 已创建演示任务：task#{task_id}，10 秒后到点。")
     print("   下一步：运行 Start_Scheduler.bat（或看下方脚本二的“立即执行”）。")
@@ -9,10 +9,11 @@ from sqlalchemy.orm import sessionmaker
 
 from config import DB_URL
 from models import Base, Task
+from db_utils import init_db
 from hook import process_one_task
 
 engine = create_engine(DB_URL, future=True)
-Base.metadata.create_all(engine)
+init_db(engine)
 Session = sessionmaker(bind=engine, future=True)
 
 with Session() as s:
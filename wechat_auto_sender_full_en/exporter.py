@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+exporter.py
+流式导出：台账流水 / 任务 / 客户对账单 -> CSV、XLSX、Parquet
+- 查询用 yield_per 分批取数，边读边写，内存占用与总行数无关
+- 台账与对账单按 订阅 -> 客户 -> 时间 排序，在流中累加得到每行之后的余额；
+  指定起始日期时，期初余额用同样排序的分组汇总流做归并，不额外逐订阅查询。
+  余额总是按全部流水类型累计，--kind 只筛选输出的行
+- 对账单从客户的订阅出发左连接期间内的流水：期间内没有流水的订阅也有期初/期末余额行
+- daily 先在单独的短事务里刷新日汇总表，导出本身只读
+- 只读，不持有写锁（SQLite 建议开启 WAL，见 config.SQLITE_WAL），不影响调度器写入
+
+用法：
+    python exporter.py ledger --out ledger.csv --since 2026-10-01 --until 2026-11-01 --kind delivery
+    python exporter.py tasks --out tasks.xlsx --status sent
+    python exporter.py statement --customer 张三 --out zhangsan.csv
+    python exporter.py daily --out october.csv --since 2026-10-01 --until 2026-10-31   # 读日汇总表
+"""
+
+import argparse
+import csv
+import importlib
+import os
+import sys
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import and_, func, select, union_all
+
+from db_utils import session_scope
+from log_utils import get_logger
+from models import Customer, LedgerTransaction, Subscription, Task
+from money import Money, ZERO
+
+try:
+    from config import EXPORT_BATCH_SIZE
+except Exception:
+    EXPORT_BATCH_SIZE = 2000
+
+logger = get_logger(__name__)
+
+LEDGER_COLUMNS = [
+    "id", "ts", "customer_id", "wx_display_name", "subscription_id", "kind",
+    "bottle_delta", "amount_delta", "bottle_balance", "amount_balance", "ref_task_id", "memo",
+]
+DAILY_COLUMNS = ["day", "sub_type", "kind", "tx_count", "bottle_sum", "amount_sum"]
+TASK_COLUMNS = [
+    "id", "customer_id", "wx_display_name", "subscription_id", "delivery_date", "slot", "send_time",
+    "template_key", "delivered_bottles", "remark", "status", "try_count", "payload_json", "result_log",
+    "created_at", "updated_at",
+]
+
+
+def _stream(s, stmt, batch: int = EXPORT_BATCH_SIZE):
+    return s.execute(stmt.execution_options(yield_per=batch, stream_results=True))
+
+
+def _resolve_customer(s, customer):
+    """客户可传 id 或 姓名/微信备注"""
+    if customer is None:
+        return None
+    if isinstance(customer, int) or str(customer).isdigit():
+        return int(customer)
+    cid = s.execute(
+        select(Customer.id).where((Customer.name == customer) | (Customer.wx_display_name == customer))
+    ).scalar()
+    if cid is None:
+        raise ValueError(f"未找到客户：{customer}")
+    return cid
+
+
+# ---------------------- 数据集 ----------------------
+def _opening_balances(s, since, customer_id=None):
+    """since 之前的各订阅余额（全部流水类型），按 (subscription_id, customer_id) 升序流式返回"""
+    LT = LedgerTransaction
+    stmt = (
+        select(
+            LT.subscription_id,
+            LT.customer_id,
+            func.coalesce(func.sum(LT.bottle_delta), 0),
+            func.coalesce(func.sum(LT.amount_delta), 0),
+        )
+        .where(LT.ts < since)
+        .group_by(LT.subscription_id, LT.customer_id)
+        .order_by(LT.subscription_id, LT.customer_id)
+    )
+    if customer_id is not None:
+        stmt = stmt.where(LT.customer_id == customer_id)
+    return _stream(s, stmt)
+
+
+def _merge_key(sub_id, customer_id) -> tuple:
+    """与 SQLite 的 ORDER BY 一致：NULL 排在所有订阅之前（未关联订阅的流水按客户各算一组）"""
+    return (sub_id is not None, sub_id or 0, customer_id)
+
+
+def _window(since, until) -> list:
+    LT = LedgerTransaction
+    return ([LT.ts >= since] if since else []) + ([LT.ts < until] if until else [])
+
+
+def _statement_query(since, until, customer_id):
+    """
+    对账单的行：从客户的订阅出发左连接期间内的流水（没有流水的订阅得到一行流水列为空的占位），
+    并上未关联订阅的流水；排序与台账相同
+    """
+    LT = LedgerTransaction
+    window = _window(since, until)
+    by_sub = (
+        select(
+            LT.id, LT.ts, Subscription.customer_id, Customer.wx_display_name,
+            Subscription.id.label("subscription_id"), LT.kind,
+            LT.bottle_delta, LT.amount_delta, LT.ref_task_id, LT.memo,
+        )
+        .select_from(Subscription)
+        .join(Customer, Customer.id == Subscription.customer_id)
+        .outerjoin(LT, and_(LT.subscription_id == Subscription.id, LT.customer_id == Subscription.customer_id, *window))
+        .where(Subscription.customer_id == customer_id)
+    )
+    loose = (
+        select(
+            LT.id, LT.ts, LT.customer_id, Customer.wx_display_name, LT.subscription_id, LT.kind,
+            LT.bottle_delta, LT.amount_delta, LT.ref_task_id, LT.memo,
+        )
+        .join(Customer, Customer.id == LT.customer_id)
+        .where(LT.customer_id == customer_id, LT.subscription_id.is_(None), *window)
+    )
+    u = union_all(by_sub, loose).subquery()
+    return select(*u.c).order_by(u.c.subscription_id, u.c.customer_id, u.c.ts, u.c.id)
+
+
+def iter_ledger(s, since=None, until=None, customer_id=None, kinds=None, opening_rows=False):
+    """
+    台账流水（带累计余额），按 订阅、时间 排序逐行产出 dict。
+    opening_rows=True 时（对账单，需指定客户），客户的每个订阅先输出一行“期初余额”、最后一行“期末余额”，
+    期间内没有流水的订阅也输出这两行。
+    余额按全部流水类型累计；kinds 只决定输出哪些行。
+    """
+    LT = LedgerTransaction
+    if opening_rows:
+        stmt = _statement_query(since, until, customer_id)
+    else:
+        stmt = (
+            select(
+                LT.id, LT.ts, LT.customer_id, Customer.wx_display_name, LT.subscription_id, LT.kind,
+                LT.bottle_delta, LT.amount_delta, LT.ref_task_id, LT.memo,
+            )
+            .join(Customer, Customer.id == LT.customer_id)
+            .where(*_window(since, until))
+            .order_by(LT.subscription_id, LT.customer_id, LT.ts, LT.id)
+        )
+        if customer_id is not None:
+            stmt = stmt.where(LT.customer_id == customer_id)
+    kinds = set(kinds or ())
+
+    def balance_row(kind, ts, memo):
+        return {
+            "id": "", "ts": ts or "", "customer_id": head[0], "wx_display_name": head[1],
+            "subscription_id": head[2], "kind": kind, "bottle_delta": "",
+            "amount_delta": "", "bottle_balance": bottle, "amount_balance": amount,
+            "ref_task_id": "", "memo": memo,
+        }
+
+    # 期初余额流与明细流同序，做归并
+    opening = iter(_opening_balances(s, since, customer_id)) if since else iter(())
+    pending_open = next(opening, None)
+
+    cur, head, bottle, amount = None, None, 0, ZERO
+    for (tid, ts, cid, wx, sub_id, kind, b, a, ref, memo) in _stream(s, stmt):
+        key = _merge_key(sub_id, cid)
+        if key != cur:
+            if opening_rows and cur is not None:
+                yield balance_row("closing", until, "期末余额")
+            cur, head, bottle, amount = key, (cid, wx, sub_id), 0, ZERO
+            while pending_open is not None and _merge_key(pending_open[0], pending_open[1]) < key:
+                pending_open = next(opening, None)
+            if pending_open is not None and _merge_key(pending_open[0], pending_open[1]) == key:
+                bottle, amount = int(pending_open[2]), pending_open[3] or ZERO
+                pending_open = next(opening, None)
+            if opening_rows:
+                yield balance_row("opening", since, "期初余额")
+        if tid is None:  # 期间内没有流水的订阅
+            continue
+        bottle += int(b or 0)
+        amount += a or ZERO
+        if kinds and kind not in kinds:
+            continue
+        yield {
+            "id": tid, "ts": ts, "customer_id": cid, "wx_display_name": wx,
+            "subscription_id": sub_id, "kind": kind, "bottle_delta": b,
+            "amount_delta": a, "bottle_balance": bottle, "amount_balance": amount,
+            "ref_task_id": ref, "memo": memo,
+        }
+    if opening_rows and cur is not None:
+        yield balance_row("closing", until, "期末余额")
+
+
+def iter_tasks(s, since=None, until=None, customer_id=None, statuses=None):
+    stmt = (
+        select(
+            Task.id, Task.customer_id, Customer.wx_display_name, Task.subscription_id, Task.delivery_date,
+            Task.slot, Task.send_time, Task.template_key, Task.delivered_bottles, Task.remark, Task.status,
+            Task.try_count, Task.payload_json, Task.result_log, Task.created_at, Task.updated_at,
+        )
+        .join(Customer, Customer.id == Task.customer_id)
+        .order_by(Task.send_time, Task.id)
+    )
+    if since:
+        stmt = stmt.where(Task.send_time >= since)
+    if until:
+        stmt = stmt.where(Task.send_time < until)
+    if customer_id is not None:
+        stmt = stmt.where(Task.customer_id == customer_id)
+    if statuses:
+        stmt = stmt.where(Task.status.in_(statuses))
+    for row in _stream(s, stmt):
+        yield dict(zip(TASK_COLUMNS, row))
+
+
+# ---------------------- 写出 ----------------------
+def _cell(v):
+    if isinstance(v, datetime):
+        return v.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(v, (Money, Decimal)):
+        return f"{v:.2f}"
+    return "" if v is None else v
+
+
+def _write_csv(path, columns, rows):
+    n = 0
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        w = csv.writer(f)
+        w.writerow(columns)
+        for r in rows:
+            w.writerow([_cell(r[c]) for c in columns])
+            n += 1
+    return n
+
+
+# 可选依赖（见 requirements.txt）：格式 -> (模块, 名称, pip 包)
+OPTIONAL_LIBS = {"xlsx": ("openpyxl", "XLSX", "openpyxl"), "parquet": ("pyarrow.parquet", "Parquet", "pyarrow")}
+
+
+def _require(fmt: str):
+    """缺库时在打开会话、创建输出文件之前报错"""
+    if fmt not in OPTIONAL_LIBS:
+        return
+    module, label, package = OPTIONAL_LIBS[fmt]
+    try:
+        importlib.import_module(module)
+    except ImportError:
+        raise RuntimeError(f"导出 {label} 需要 {package}：pip install {package}")
+
+
+def _write_xlsx(path, columns, rows):
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)  # write_only 模式逐行落盘，不在内存里保留整张表
+    ws = wb.create_sheet()
+    ws.append(columns)
+    n = 0
+    for r in rows:
+        ws.append([_cell(r[c]) for c in columns])
+        n += 1
+    wb.save(path)
+    return n
+
+
+def _write_parquet(path, columns, rows, batch: int = EXPORT_BATCH_SIZE):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(c, pa.string()) for c in columns])
+    n = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        buf = {c: [] for c in columns}
+        for r in rows:
+            for c in columns:
+                v = _cell(r[c])
+                buf[c].append(None if v == "" else str(v))
+            n += 1
+            if n % batch == 0:
+                writer.write_table(pa.table(buf, schema=schema))
+                buf = {c: [] for c in columns}
+        if buf[columns[0]]:
+            writer.write_table(pa.table(buf, schema=schema))
+    return n
+
+
+WRITERS = {"csv": _write_csv, "xlsx": _write_xlsx, "parquet": _write_parquet}
+
+
+def export(dataset: str, out: str, fmt: str = None, since=None, until=None,
+           customer=None, kinds=None, statuses=None) -> int:
+    """导出一个数据集，返回行数。dataset: ledger / tasks / statement / daily"""
+    fmt = (fmt or os.path.splitext(out)[1].lstrip(".") or "csv").lower()
+    if fmt not in WRITERS:
+        raise ValueError(f"不支持的格式：{fmt}（可选 {', '.join(WRITERS)}）")
+    _require(fmt)
+    if dataset == "daily":
+        import rollups
+
+        # 刷新要写汇总表：单独一个短事务，提交后再开只读会话流式导出
+        with session_scope() as s:
+            rollups.refresh(s)
+    with session_scope() as s:
+        customer_id = _resolve_customer(s, customer)
+        if dataset == "ledger":
+            columns, rows = LEDGER_COLUMNS, iter_ledger(s, since, until, customer_id, kinds)
+        elif dataset == "statement":
+            if customer_id is None:
+                raise ValueError("对账单需要指定客户")
+            columns = LEDGER_COLUMNS
+            rows = iter_ledger(s, since, until, customer_id, kinds, opening_rows=True)
+        elif dataset == "tasks":
+            columns, rows = TASK_COLUMNS, iter_tasks(s, since, until, customer_id, statuses)
+        elif dataset == "daily":
+            columns = DAILY_COLUMNS
+            rows = (
+                dict(zip(DAILY_COLUMNS, r))
+                for r in rollups.summary(
+                    s,
+                    since.strftime("%Y-%m-%d") if since else None,
+                    (until - timedelta(days=1)).strftime("%Y-%m-%d") if until else None,
+                )
+            )
+        else:
+            raise ValueError(f"未知数据集：{dataset}")
+        n = WRITERS[fmt](out, columns, rows)
+    logger.info(f"导出 {dataset} -> {out}：{n} 行")
+    return n
+
+
+def _date(v: str):
+    return datetime.fromisoformat(v) if v else None
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="流式导出台账/任务/对账单")
+    ap.add_argument("dataset", choices=["ledger", "tasks", "statement", "daily"])
+    ap.add_argument("--out", required=True, help="输出文件（扩展名决定格式：.csv/.xlsx/.parquet）")
+    ap.add_argument("--format", choices=list(WRITERS))
+    ap.add_argument("--since", help="起始日期（含），YYYY-MM-DD")
+    ap.add_argument("--until", help="截止日期（含），YYYY-MM-DD")
+    ap.add_argument("--customer", help="客户 ID、姓名或微信备注")
+    ap.add_argument("--kind", action="append", help="只输出这些流水类型，可重复：purchase/delivery/refund/manual_adjust（余额仍按全部类型累计）")
+    ap.add_argument("--status", action="append", help="任务状态，可重复")
+    args = ap.parse_args(argv)
+    until = _date(args.until)
+    try:
+        n = export(
+            args.dataset, args.out, args.format,
+            since=_date(args.since),
+            until=until + timedelta(days=1) if until else None,
+            customer=args.customer, kinds=args.kind, statuses=args.status,
+        )
+    except (ValueError, RuntimeError) as e:
+        print(f"❌ {e}")
+        return 2
+    print(f"✅ 已导出 {n} 行 -> {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+forecast.py
+余额用完预测与续费提醒：
+- 一次载入所有在用订阅的当前余额、近 FORECAST_HISTORY_DAYS 天的日均消耗和已排期的待发配送（各一条 SQL），
+  按“单位”统一计算：按瓶订阅的单位是瓶，按金额订阅的单位是分（一次配送消耗 = 瓶数 × 单价）
+- 用完日期：已排期的配送按日期累计，第一次超出余额的那天；排期内用不完则按日均消耗外推；没有消耗的不预测
+- 装了 NumPy 时整批向量化计算，否则退回逐条的纯 Python 实现（结果相同）
+- 预计 REMINDER_DAYS_AHEAD 天内用完、且 REMINDER_COOLDOWN_DAYS 天内没有提醒过的订阅，批量 upsert 提醒任务
+  （slot=reminder，模板 REMINDER_TEMPLATE；hook 对提醒任务只发送、不扣费）
+
+用法：
+    python forecast.py [--dry-run] [--days 3] [--no-numpy]
+"""
+
+import argparse
+import json
+import sys
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import Integer, func, select, type_coerce
+
+import clock
+import metrics
+from log_utils import get_logger
+from models import Customer, LedgerTransaction, Subscription, Task, REMINDER_SLOT
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from config import (
+        REMINDER_TEMPLATE,
+        REMINDER_DAYS_AHEAD,
+        REMINDER_COOLDOWN_DAYS,
+        REMINDER_SEND_TIME,
+        FORECAST_HISTORY_DAYS,
+    )
+except Exception:
+    REMINDER_TEMPLATE = "low_balance_reminder"
+    REMINDER_DAYS_AHEAD = 3
+    REMINDER_COOLDOWN_DAYS = 7
+    REMINDER_SEND_TIME = "09:00"
+    FORECAST_HISTORY_DAYS = 28
+
+logger = get_logger(__name__)
+
+_UNITS = {"by_bottle": 0, "by_amount": 1}
+
+
+def load(s, today: date, history_days: int = FORECAST_HISTORY_DAYS) -> dict:
+    """
+    按列载入预测所需数据：
+    subs：sid / cid / balance（单位）/ unit（每瓶消耗几个单位）/ rate（单位/天）/ send_at（HH:MM 或 None）
+    sched：idx（在 subs 中的下标）/ day（date.toordinal）/ bottles
+    """
+    LT = LedgerTransaction
+    amount = type_coerce(LT.amount_delta, Integer)  # 直接取整数分，不逐行构造 Money
+    bal = (
+        select(
+            LT.subscription_id.label("sid"),
+            func.sum(LT.bottle_delta).label("b"),
+            func.sum(amount).label("a"),
+        )
+        .group_by(LT.subscription_id)
+        .subquery()
+    )
+    since = datetime.combine(today - timedelta(days=history_days), datetime.min.time())
+    hist = (
+        select(
+            LT.subscription_id.label("sid"),
+            func.sum(LT.bottle_delta).label("b"),
+            func.sum(amount).label("a"),
+        )
+        .where(LT.kind == "delivery", LT.ts >= since)
+        .group_by(LT.subscription_id)
+        .subquery()
+    )
+    rows = s.execute(
+        select(
+            Subscription.id, Subscription.customer_id, Subscription.type,
+            type_coerce(Subscription.unit_price, Integer),
+            bal.c.b, bal.c.a, hist.c.b, hist.c.a, Customer.preferred_send_time,
+        )
+        .join(Customer, Customer.id == Subscription.customer_id)
+        .outerjoin(bal, bal.c.sid == Subscription.id)
+        .outerjoin(hist, hist.c.sid == Subscription.id)
+        .where(Subscription.status == "active", func.coalesce(Customer.active, 1) == 1)
+        .order_by(Subscription.id)
+    )
+    subs = {"sid": [], "cid": [], "balance": [], "unit": [], "rate": [], "send_at": []}
+    for sid, cid, typ, price, b, a, hb, ha, send_at in rows:
+        kind = _UNITS.get(typ)
+        if kind is None:
+            continue
+        subs["sid"].append(sid)
+        subs["cid"].append(cid)
+        subs["balance"].append(int((b if kind == 0 else a) or 0))
+        subs["unit"].append(1 if kind == 0 else int(price or 0))
+        subs["rate"].append(-float((hb if kind == 0 else ha) or 0) / history_days)
+        subs["send_at"].append(send_at)
+
+    pos = {sid: i for i, sid in enumerate(subs["sid"])}
+    sched = {"idx": [], "day": [], "bottles": []}
+    for sid, day, n in s.execute(
+        select(Task.subscription_id, Task.delivery_date, Task.delivered_bottles)
+        .where(
+            Task.status.in_(("pending", "held")),
+            Task.delivery_date >= today.isoformat(),
+            Task.delivered_bottles.isnot(None),
+            Task.slot != REMINDER_SLOT,
+        )
+        .order_by(Task.subscription_id, Task.delivery_date)
+    ):
+        i = pos.get(sid)
+        if i is None:
+            continue
+        sched["idx"].append(i)
+        sched["day"].append(date.fromisoformat(day).toordinal())
+        sched["bottles"].append(n)
+    return {"subs": subs, "sched": sched}
+
+
+def _run_out_numpy(balance, unit, rate, t_idx, t_day, t_bottles, today: int):
+    n = len(balance)
+    bal = np.asarray(balance, dtype=np.int64)
+    unit = np.asarray(unit, dtype=np.int64)
+    rate = np.asarray(rate, dtype=np.float64)
+    out = np.full(n, -1, dtype=np.int64)
+    total = np.zeros(n, dtype=np.int64)
+    last = np.full(n, today, dtype=np.int64)
+    if len(t_idx):
+        idx = np.asarray(t_idx, dtype=np.int64)
+        day = np.asarray(t_day, dtype=np.int64)
+        order = np.lexsort((day, idx))
+        idx, day = idx[order], day[order]
+        cost = np.asarray(t_bottles, dtype=np.int64)[order] * unit[idx]
+        # 组内累计：全局 cumsum 减去本组第一行之前的累计
+        first = np.r_[True, idx[1:] != idx[:-1]]
+        start = np.maximum.accumulate(np.where(first, np.arange(len(idx)), 0))
+        c = np.cumsum(cost)
+        cum = c - (c[start] - cost[start])
+        over = cum > bal[idx]
+        hit, at = np.unique(idx[over], return_index=True)
+        out[hit] = day[over][at]
+        total = np.bincount(idx, weights=cost, minlength=n).astype(np.int64)
+        tail = np.r_[np.nonzero(first)[0][1:] - 1, len(idx) - 1]
+        last[idx[tail]] = np.maximum(day[tail], today)
+    ext = (out < 0) & (rate > 0)
+    out[ext] = last[ext] + np.floor((bal[ext] - total[ext]) / rate[ext]).astype(np.int64) + 1
+    return np.where(out >= 0, np.maximum(out, today), -1).tolist()
+
+
+def _run_out_py(balance, unit, rate, t_idx, t_day, t_bottles, today: int):
+    n = len(balance)
+    out, total, last = [-1] * n, [0] * n, [today] * n
+    for k in sorted(range(len(t_idx)), key=lambda k: (t_idx[k], t_day[k])):
+        j = t_idx[k]
+        total[j] += t_bottles[k] * unit[j]
+        last[j] = max(last[j], t_day[k])
+        if out[j] < 0 and total[j] > balance[j]:
+            out[j] = t_day[k]
+    for j in range(n):
+        if out[j] < 0 and rate[j] > 0:
+            out[j] = last[j] + int((balance[j] - total[j]) // rate[j]) + 1
+        if out[j] >= 0:
+            out[j] = max(out[j], today)
+    return out
+
+
+def run_out_dates(data: dict, today: date, use_numpy: bool = True) -> list:
+    """每个订阅预计用完的日期（date.toordinal），-1 表示预测期内不会用完/无消耗"""
+    subs, sched = data["subs"], data["sched"]
+    fn = _run_out_numpy if (use_numpy and np is not None) else _run_out_py
+    return fn(
+        subs["balance"], subs["unit"], subs["rate"],
+        sched["idx"], sched["day"], sched["bottles"], today.toordinal(),
+    )
+
+
+def _recently_reminded(s, today: date, cooldown_days: int) -> set:
+    since = (today - timedelta(days=cooldown_days)).isoformat()
+    return set(
+        s.execute(
+            select(Task.subscription_id)
+            .where(Task.slot == REMINDER_SLOT, Task.delivery_date >= since)
+            .distinct()
+        ).scalars()
+    )
+
+
+def _send_time(today: date, hhmm: str):
+    try:
+        h, m = (int(x) for x in (hhmm or REMINDER_SEND_TIME).split(":"))
+    except ValueError:
+        h, m = (int(x) for x in REMINDER_SEND_TIME.split(":"))
+    return datetime(today.year, today.month, today.day, h, m)
+
+
+def generate(s, today: date = None, days_ahead: int = REMINDER_DAYS_AHEAD,
+             cooldown_days: int = REMINDER_COOLDOWN_DAYS, use_numpy: bool = True, dry_run: bool = False) -> dict:
+    """预测并生成提醒任务；返回统计信息与待提醒列表 [(subscription_id, 用完日期, 剩余天数)]"""
+    from db_utils import upsert_tasks
+
+    today = today or clock.now().date()
+    data = load(s, today)
+    t0 = clock.monotonic()
+    run_out = run_out_dates(data, today, use_numpy)
+    compute_ms = (clock.monotonic() - t0) * 1000
+    metrics.observe("forecast_compute_seconds", compute_ms / 1000)
+
+    subs, base = data["subs"], today.toordinal()
+    skip = _recently_reminded(s, today, cooldown_days)
+    due, rows = [], []
+    for i, ro in enumerate(run_out):
+        if ro < 0 or ro - base > days_ahead or subs["sid"][i] in skip:
+            continue
+        run_out_date = date.fromordinal(ro)
+        due.append((subs["sid"][i], run_out_date, ro - base))
+        rows.append({
+            "customer_id": subs["cid"][i],
+            "subscription_id": subs["sid"][i],
+            "delivery_date": today.isoformat(),
+            "slot": REMINDER_SLOT,
+            "send_time": _send_time(today, subs["send_at"][i]),
+            "template_key": REMINDER_TEMPLATE,
+            "payload_json": json.dumps(
+                {"run_out_date": run_out_date.isoformat(), "days_left": ro - base}, ensure_ascii=False
+            ),
+        })
+    if rows and not dry_run:
+        upsert_tasks(s, rows)
+    logger.info(
+        f"forecast: {len(subs['sid'])} 个订阅，{len(data['sched']['idx'])} 条排期，"
+        f"计算 {compute_ms:.1f}ms（{'numpy' if use_numpy and np is not None else 'python'}），"
+        f"{'预计' if dry_run else '生成'} {len(rows)} 条提醒"
+    )
+    return {
+        "subscriptions": len(subs["sid"]),
+        "scheduled": len(data["sched"]["idx"]),
+        "compute_ms": compute_ms,
+        "reminders": due,
+    }
+
+
+def main(argv=None) -> int:
+    from db_utils import init_db, session_scope
+
+    ap = argparse.ArgumentParser(description="余额用完预测与续费提醒")
+    ap.add_argument("--days", type=int, default=REMINDER_DAYS_AHEAD, help="预计多少天内用完就提醒")
+    ap.add_argument("--dry-run", action="store_true", help="只列出，不生成提醒任务")
+    ap.add_argument("--no-numpy", action="store_true", help="强制使用纯 Python 实现")
+    args = ap.parse_args(argv)
+
+    init_db()
+    with session_scope() as s:
+        res = generate(s, days_ahead=args.days, use_numpy=not args.no_numpy, dry_run=args.dry_run)
+    for sid, run_out_date, days_left in res["reminders"]:
+        print(f"订阅#{sid}  预计 {run_out_date} 用完（{days_left} 天）")
+    print(
+        f"{res['subscriptions']} 个订阅，计算 {res['compute_ms']:.1f}ms；"
+        f"{'需提醒' if args.dry_run else '已生成提醒'} {len(res['reminders'])} 条"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,28 +2,46 @@
 """
 中文界面 GUI（Tkinter）
 标签页：客户与余额 / 任务队列
-功能：查询客户、查看余额与流水、手动调整；查看/筛选/编辑/取消任务
+功能：查询客户、查看余额与流水、手动调整、导出流水与对账单；查看/筛选/编辑/取消任务
+打开的列表按变更流水（changefeed.py）每 CHANGE_FEED_POLL_MS 毫秒就地更新，不必反复点“查询”
 """
 
 import json
+import threading
 from datetime import datetime
-from decimal import Decimal
 
 import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext
+from tkinter import ttk, messagebox, scrolledtext, filedialog
 
 from sqlalchemy import create_engine, desc
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker
 
 from config import DB_URL
-from models import Base, Customer, Subscription, LedgerTransaction, Task
-from db_utils import recalc_customer_balances, add_transaction
-
-# ---------- 数据库初始化 ----------
+try:
+    from config import CHANGE_FEED_POLL_MS
+except Exception:
+    CHANGE_FEED_POLL_MS = 2000
+from models import Base, Subscription, Task, REMINDER_SLOT
+from db_utils import add_transaction, init_db
+from money import Money
+from capacity import estimate_drain, describe
+import changefeed
+import exporter
+import rows
+from profiling import profile_handlers
+
+# ---------- 数据库初始化（建表放到 App 启动时） ----------
 engine = create_engine(DB_URL, future=True)
-Base.metadata.create_all(engine)
 Session = sessionmaker(bind=engine, future=True)
 
+# 任务列表的排序方式（配送日/瓶数走 ix_tasks_status_delivery_date 与列上的排序）
+TASK_ORDERS = {
+    "发送时间": (Task.send_time.asc(),),
+    "配送日": (Task.delivery_date.asc(), Task.send_time.asc()),
+    "瓶数（多→少）": (desc(Task.delivered_bottles), Task.send_time.asc()),
+}
+
 
 def fmt_dt(dt):
     if not dt:
@@ -36,9 +54,11 @@ def fmt_dt(dt):
     return dt.strftime("%Y-%m-%d %H:%M:%S")
 
 
+@profile_handlers
 class App(tk.Tk):
     def __init__(self):
         super().__init__()
+        init_db(engine)
         self.title("自动发送控制台")
         self.geometry("980x680")
 
@@ -52,6 +72,51 @@ class App(tk.Tk):
         self._build_customer_tab()
         self._build_tasks_tab()
 
+        with Session() as s:
+            self._feed_seq = changefeed.latest(s)
+        if CHANGE_FEED_POLL_MS:
+            self.after(CHANGE_FEED_POLL_MS, self.on_feed_tick)
+
+    # ---------------------- 变更流水：就地更新 ----------------------
+    def on_feed_tick(self):
+        """读取上次之后的变更（一条主键范围查询），只更新受影响的任务行、余额与流水"""
+        try:
+            with Session() as s:
+                changes = changefeed.read(s, self._feed_seq)
+                if changes:
+                    self._apply_changes(s, changefeed.updates(changes))
+        finally:
+            self.after(CHANGE_FEED_POLL_MS, self.on_feed_tick)
+
+    def _apply_changes(self, s, up: dict):
+        self._feed_seq = up["last"]
+        f = self._task_filter
+        if up["tasks"] and f is not None:
+            fresh = {t.id: t for t in rows.tasks_by_ids(s, up["tasks"])}
+            for tid in up["tasks"]:
+                t = fresh.get(tid)
+                keep = (
+                    t is not None
+                    and (not f["status"] or t.status == f["status"])
+                    and (f["customer_id"] is None or t.customer_id == f["customer_id"])
+                )
+                iid = str(tid)
+                if self.tree_tasks.exists(iid):
+                    if keep:
+                        self.tree_tasks.item(iid, values=self._task_values(t))
+                    else:
+                        self.tree_tasks.delete(iid)
+                elif keep:
+                    self.tree_tasks.insert("", "end", iid=iid, values=self._task_values(t))
+        cust = self._current_customer
+        if cust and cust.id in up["customers"]:
+            self._fill_balances(s, cust.id)
+            new = [i for i, c in up["ledger"].items() if c == cust.id]
+            for t in rows.ledger_by_ids(s, new):
+                self.tree_tx.insert("", 0, values=self._tx_values(t))
+            for iid in self.tree_tx.get_children()[50:]:
+                self.tree_tx.delete(iid)
+
     # ---------------------- 客户与余额页 ----------------------
     def _build_customer_tab(self):
         frm = ttk.Frame(self.tab_customer, padding=12)
@@ -64,6 +129,10 @@ class App(tk.Tk):
         self.entry_cust = ttk.Entry(top, width=28)
         self.entry_cust.pack(side="left", padx=6)
         ttk.Button(top, text="查询", command=self.on_search_customer).pack(side="left")
+        ttk.Button(top, text="导出全部流水", command=self.on_export_ledger).pack(side="right")
+        ttk.Button(top, text="导出对账单", command=self.on_export_statement).pack(
+            side="right", padx=6
+        )
 
         body = ttk.Frame(frm)
         body.pack(fill="both", expand=True, pady=10)
@@ -143,6 +212,7 @@ class App(tk.Tk):
         self.tree_tx.pack(fill="both", expand=True)
 
         self._current_customer = None
+        self._task_filter = None  # 最近一次任务查询的条件（就地更新时判断新任务是否该出现在列表里）
 
     def on_search_customer(self):
         name = self.entry_cust.get().strip()
@@ -150,56 +220,77 @@ class App(tk.Tk):
             messagebox.showwarning("提示", "请输入客户姓名或微信备注再查询。")
             return
         with Session() as s:
-            cust = (
-                s.query(Customer)
-                .filter((Customer.name == name) | (Customer.wx_display_name == name))
-                .first()
-            )
+            cust = rows.find_customer(s, name)
             if not cust:
                 messagebox.showinfo("结果", "未找到该客户。")
                 return
             self._current_customer = cust
             self.var_cust_info.set(
                 f"客户ID：{cust.id}\n姓名：{cust.name or ''}\n微信备注：{cust.wx_display_name or ''}"
+                f"\n发送账号：{cust.account or '默认'}"
             )
-            # 刷新余额表
-            for i in self.tree_bal.get_children():
-                self.tree_bal.delete(i)
-            for b in recalc_customer_balances(s, cust.id):
-                self.tree_bal.insert(
-                    "",
-                    "end",
-                    values=(
-                        b["subscription_id"],
-                        "按瓶" if b["type"] == "by_bottle" else "按金额",
-                        b.get("unit_price") if b["type"] == "by_amount" else "",
-                        b.get("bottle_balance") if b["type"] == "by_bottle" else "",
-                        b.get("amount_balance") if b["type"] == "by_amount" else "",
-                    ),
-                )
+            self._fill_balances(s, cust.id)
             # 刷新流水
             for i in self.tree_tx.get_children():
                 self.tree_tx.delete(i)
-            q = (
-                s.query(LedgerTransaction)
-                .filter(LedgerTransaction.customer_id == cust.id)
-                .order_by(desc(LedgerTransaction.ts))
-                .limit(50)
+            for t in rows.ledger_rows(s, cust.id, limit=50):
+                self.tree_tx.insert("", "end", values=self._tx_values(t))
+
+    def _fill_balances(self, s, customer_id: int):
+        for i in self.tree_bal.get_children():
+            self.tree_bal.delete(i)
+        for b in rows.customer_balances(s, customer_id):
+            self.tree_bal.insert(
+                "",
+                "end",
+                values=(
+                    b.subscription_id,
+                    "按瓶" if b.type == "by_bottle" else "按金额",
+                    b.unit_price if b.type == "by_amount" else "",
+                    b.bottle_balance if b.type == "by_bottle" else "",
+                    b.amount_balance if b.type == "by_amount" else "",
+                ),
             )
-            for t in q:
-                self.tree_tx.insert(
-                    "",
-                    "end",
-                    values=(
-                        t.id,
-                        fmt_dt(t.ts),
-                        t.kind,
-                        t.bottle_delta,
-                        str(t.amount_delta),
-                        t.memo or "",
-                        t.subscription_id,
-                    ),
-                )
+
+    @staticmethod
+    def _tx_values(t) -> tuple:
+        return (
+            t.id,
+            fmt_dt(t.ts),
+            t.kind,
+            t.bottle_delta,
+            str(t.amount_delta),
+            t.memo or "",
+            t.subscription_id,
+        )
+
+    # 导出在后台线程进行（流式读写，不阻塞界面），完成后回到主线程提示
+    def _run_export(self, dataset: str, customer=None):
+        path = filedialog.asksaveasfilename(
+            defaultextension=".csv",
+            filetypes=[("CSV", "*.csv"), ("Excel", "*.xlsx"), ("Parquet", "*.parquet")],
+        )
+        if not path:
+            return
+
+        def job():
+            try:
+                n = exporter.export(dataset, path, customer=customer)
+                self.after(0, lambda: messagebox.showinfo("导出完成", f"已导出 {n} 行到：\n{path}"))
+            except Exception as e:
+                err = str(e)
+                self.after(0, lambda: messagebox.showerror("导出失败", err))
+
+        threading.Thread(target=job, name="export", daemon=True).start()
+
+    def on_export_statement(self):
+        if not self._current_customer:
+            messagebox.showwarning("提示", "请先查询并选择客户。")
+            return
+        self._run_export("statement", customer=self._current_customer.id)
+
+    def on_export_ledger(self):
+        self._run_export("ledger")
 
     def on_adjust(self):
         if not self._current_customer:
@@ -219,7 +310,7 @@ class App(tk.Tk):
             messagebox.showwarning("提示", "瓶 Δ 必须为整数。")
             return
         try:
-            amount_delta = Decimal(amount) if amount else Decimal("0.00")
+            amount_delta = Money.of(amount)
         except Exception:
             messagebox.showwarning("提示", "金额 Δ 必须为数字。")
             return
@@ -252,19 +343,32 @@ class App(tk.Tk):
         filt.pack(fill="x")
         ttk.Label(filt, text="状态：").pack(side="left")
         self.combo_status = ttk.Combobox(
-            filt, values=["pending", "sent", "failed", "canceled"], width=10
+            filt, values=["pending", "held", "unconfirmed", "sent", "failed", "canceled"], width=10
         )
         self.combo_status.set("pending")
         self.combo_status.pack(side="left", padx=4)
         ttk.Label(filt, text="客户：").pack(side="left")
         self.entry_task_cust = ttk.Entry(filt, width=20)
         self.entry_task_cust.pack(side="left", padx=4)
+        ttk.Label(filt, text="排序：").pack(side="left")
+        self.combo_task_order = ttk.Combobox(
+            filt, values=list(TASK_ORDERS), width=12, state="readonly"
+        )
+        self.combo_task_order.set("发送时间")
+        self.combo_task_order.pack(side="left", padx=4)
         ttk.Button(filt, text="查询", command=self.on_query_tasks).pack(side="left", padx=4)
 
+        # 积压预估面板
+        cap = ttk.Labelframe(frm, text="积压预估", padding=8)
+        cap.pack(fill="x", pady=(8, 0))
+        self.var_capacity = tk.StringVar(value="点击“刷新预估”计算待发队列的完成时间。")
+        ttk.Label(cap, textvariable=self.var_capacity, justify="left").pack(side="left", anchor="w")
+        ttk.Button(cap, text="刷新预估", command=self.on_refresh_capacity).pack(side="right")
+
         # 任务表
         self.tree_tasks = ttk.Treeview(
             frm,
-            columns=("id", "cust_id", "sub_id", "send_time", "tmpl", "status"),
+            columns=("id", "cust_id", "sub_id", "send_time", "tmpl", "bottles", "status"),
             show="headings",
         )
         self.tree_tasks.heading("id", text="任务ID")
@@ -272,6 +376,7 @@ class App(tk.Tk):
         self.tree_tasks.heading("sub_id", text="订阅ID")
         self.tree_tasks.heading("send_time", text="发送时间")
         self.tree_tasks.heading("tmpl", text="模板键")
+        self.tree_tasks.heading("bottles", text="瓶数")
         self.tree_tasks.heading("status", text="状态")
 
         self.tree_tasks.column("id", width=80, anchor="center")
@@ -279,6 +384,7 @@ class App(tk.Tk):
         self.tree_tasks.column("sub_id", width=90, anchor="center")
         self.tree_tasks.column("send_time", width=180, anchor="center")
         self.tree_tasks.column("tmpl", width=200, anchor="w")
+        self.tree_tasks.column("bottles", width=60, anchor="center")
         self.tree_tasks.column("status", width=100, anchor="center")
         self.tree_tasks.pack(fill="both", expand=True, pady=8)
 
@@ -293,40 +399,40 @@ class App(tk.Tk):
         status = self.combo_status.get()
         name = self.entry_task_cust.get().strip()
         with Session() as s:
-            q = s.query(Task)
-            if status:
-                q = q.filter(Task.status == status)
+            cust_id = None
             if name:
-                cust = (
-                    s.query(Customer)
-                    .filter((Customer.name == name) | (Customer.wx_display_name == name))
-                    .first()
-                )
-                if cust:
-                    q = q.filter(Task.customer_id == cust.id)
-                else:
+                cust = rows.find_customer(s, name)
+                if not cust:
                     self._fill_tasks([])
                     messagebox.showinfo("结果", "未找到该客户。")
                     return
-            tasks = q.order_by(Task.send_time.asc()).limit(300).all()
-            self._fill_tasks(tasks)
+                cust_id = cust.id
+            order = TASK_ORDERS.get(self.combo_task_order.get(), TASK_ORDERS["发送时间"])
+            tasks = rows.task_list(s, status or None, cust_id, order, limit=300)
+        self._task_filter = {"status": status or None, "customer_id": cust_id}
+        self._fill_tasks(tasks)
+
+    def on_refresh_capacity(self):
+        with Session() as s:
+            self.var_capacity.set(describe(estimate_drain(s)))
 
     def _fill_tasks(self, tasks):
         for i in self.tree_tasks.get_children():
             self.tree_tasks.delete(i)
         for t in tasks:
-            self.tree_tasks.insert(
-                "",
-                "end",
-                values=(
-                    t.id,
-                    t.customer_id,
-                    t.subscription_id,
-                    fmt_dt(t.send_time),
-                    t.template_key,
-                    t.status,
-                ),
-            )
+            self.tree_tasks.insert("", "end", iid=str(t.id), values=self._task_values(t))
+
+    @staticmethod
+    def _task_values(t) -> tuple:
+        return (
+            t.id,
+            t.customer_id,
+            t.subscription_id,
+            fmt_dt(t.send_time),
+            t.template_key,
+            "" if t.delivered_bottles is None else t.delivered_bottles,
+            t.status,
+        )
 
     def _get_selected_task_id(self):
         sel = self.tree_tasks.selection()
@@ -361,6 +467,7 @@ class App(tk.Tk):
 
 
 # ---------------------- 编辑任务弹窗 ----------------------
+@profile_handlers
 class EditTaskDialog(tk.Toplevel):
     def __init__(self, master, task_id: int):
         super().__init__(master)
@@ -398,7 +505,19 @@ class EditTaskDialog(tk.Toplevel):
         self.entry_tmpl.insert(0, self.task.template_key or "")
         self.entry_tmpl.pack(side="left", padx=4)
 
-        ttk.Label(frm, text="Payload JSON：").pack(anchor="w")
+        row3 = ttk.Frame(frm)
+        row3.pack(fill="x", pady=6)
+        ttk.Label(row3, text="实送瓶数：").pack(side="left")
+        self.entry_bottles = ttk.Entry(row3, width=8)
+        if self.task.delivered_bottles is not None:
+            self.entry_bottles.insert(0, str(self.task.delivered_bottles))
+        self.entry_bottles.pack(side="left", padx=4)
+        ttk.Label(row3, text="备注：").pack(side="left", padx=(12, 0))
+        self.entry_remark = ttk.Entry(row3, width=36)
+        self.entry_remark.insert(0, self.task.remark or "")
+        self.entry_remark.pack(side="left", padx=4)
+
+        ttk.Label(frm, text="Payload JSON（扩展字段）：").pack(anchor="w")
         self.txt_payload = scrolledtext.ScrolledText(frm, height=12)
         self.txt_payload.pack(fill="both", expand=True)
         self.txt_payload.insert("1.0", self.task.payload_json or "")
@@ -411,29 +530,57 @@ class EditTaskDialog(tk.Toplevel):
     def on_save(self):
         t = self.entry_time.get().strip()
         k = self.entry_tmpl.get().strip()
+        b = self.entry_bottles.get().strip()
+        remark = self.entry_remark.get().strip()
         p = self.txt_payload.get("1.0", "end").strip()
         try:
             dt = datetime.fromisoformat(t)
         except Exception:
             messagebox.showerror("错误", "时间格式应为：YYYY-MM-DD HH:MM:SS")
             return
+        # 续费提醒不扣费，可以不填瓶数；其他任务发送时按瓶数扣费，必须是正整数
+        bottles = None
+        if b or self.task.slot != REMINDER_SLOT:
+            try:
+                bottles = int(b)
+            except ValueError:
+                bottles = 0
+            if bottles <= 0:
+                messagebox.showerror("错误", "实送瓶数必须为正整数。")
+                return
         if p:
             try:
-                json.loads(p)
+                extra = json.loads(p)
             except Exception as e:
                 messagebox.showerror("错误", f"Payload 必须为合法 JSON：{e}")
                 return
+            if not isinstance(extra, dict):
+                messagebox.showerror("错误", "Payload 必须为 JSON 对象（{...}）。")
+                return
+            moved = [k for k in ("delivered_bottles", "remark") if k in extra]
+            if moved:
+                messagebox.showerror("错误", f"{'、'.join(moved)} 请填写在上方的输入框中，不要放在 Payload 里。")
+                return
         with Session() as s:
             task = s.query(Task).get(self.task_id)
             if not task:
                 messagebox.showerror("错误", "未找到该任务。")
                 return
             task.send_time = dt
+            # 配送日与创建任务时一致，取发送时间的日期（自然键的一部分）
+            task.delivery_date = dt.strftime("%Y-%m-%d")
             task.template_key = k or task.template_key
+            task.delivered_bottles = bottles
+            task.remark = remark or None
             task.payload_json = p or None
             task.updated_at = datetime.now()
             s.add(task)
-            s.commit()
+            try:
+                s.commit()
+            except IntegrityError:
+                s.rollback()
+                messagebox.showerror("错误", f"该订阅在 {dt:%Y-%m-%d} 的同一时段已有任务，不能改到这一天。")
+                return
         messagebox.showinfo("成功", "已保存修改。")
         self.destroy()
 
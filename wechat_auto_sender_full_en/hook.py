@@ -1,52 +1,74 @@
 # -*- coding: utf-8 -*-
 """
-hooks.py
+hook.py
 核心流程：渲染模板 -> 校验/计算余额 -> 发送 -> 记账 -> 更新任务状态
 被 scheduler 调用：process_one_task(task_id)
+发送成功后的记账与状态更新交给 journal：先写本地日志（fsync）即确认，数据库写入分组提交；
+发送前在 journal 里记 intent，进程在发送中途退出时，重启后该任务不会被自动重发。
 """
 
 import json
-from decimal import Decimal
 from pathlib import Path
 
-# 轻量日志：优先用 loguru，否则退化到 print
-try:
-    from loguru import logger
-except Exception:  # pragma: no cover
-    class _L:
-        def info(self, *a, **k): print("[INFO]", *a)
-        def warning(self, *a, **k): print("[WARN]", *a)
-        def error(self, *a, **k): print("[ERROR]", *a)
-        def exception(self, *a, **k): print("[EXC]", *a)
-    logger = _L()
-
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-
 from config import TEMPLATE_DIR, DRY_RUN
+
+try:
+    from config import OVERDRAW_POLICY, LOW_BALANCE_TEMPLATE
+except Exception:
+    OVERDRAW_POLICY = "hold"
+    LOW_BALANCE_TEMPLATE = "low_balance_notice"
 from db_utils import (
     session_scope,
     recalc_subscription_balance,
-    add_transaction,
     mark_task_status,
+    record_attempt,
+    attempt_row,
 )
-from models import Task
+import journal
+from models import Task, REMINDER_SLOT
+from money import ZERO
+import clock
+import metrics
+from log_utils import get_logger, log_context, bind_context
+from profiling import profiled
 
-# 懒加载模板环境
-_env = Environment(
-    loader=FileSystemLoader(TEMPLATE_DIR),
-    autoescape=select_autoescape(disabled_extensions=("j2",)),
-)
+logger = get_logger(__name__)
 
-def _render_template(key: str, payload: dict) -> str:
+
+class InsufficientBalance(ValueError):
+    """本次扣费后余额为负（OVERDRAW_POLICY 为 hold / fail 时不发送）"""
+
+# 懒加载模板环境：首次渲染时才导入 jinja2 并构建
+_env = None
+
+def _get_env():
+    global _env
+    if _env is None:
+        from jinja2 import Environment, FileSystemLoader, select_autoescape
+        _env = Environment(
+            loader=FileSystemLoader(TEMPLATE_DIR),
+            autoescape=select_autoescape(disabled_extensions=("j2",)),
+        )
+    return _env
+
+def render_template(key: str, payload: dict) -> str:
     """
     渲染 Jinja2 模板；根据 key 选择对应 .j2 文件
     """
     tpl_path = Path(TEMPLATE_DIR) / f"{key}.j2"
     if not tpl_path.exists():
         raise FileNotFoundError(f"Template not found: {tpl_path}")
-    tpl = _env.get_template(f"{key}.j2")
+    tpl = _get_env().get_template(f"{key}.j2")
     return tpl.render(**payload)
 
+def template_variables(key: str) -> set:
+    """模板引用到的变量名（群发按这些变量的取值去重渲染）"""
+    from jinja2 import meta
+
+    env = _get_env()
+    source = env.loader.get_source(env, f"{key}.j2")[0]
+    return meta.find_undeclared_variables(env.parse(source))
+
 def _payload(task: Task) -> dict:
     if not task.payload_json:
         return {}
@@ -55,114 +77,189 @@ def _payload(task: Task) -> dict:
     except Exception as e:
         raise ValueError(f"Invalid payload_json for task#{task.id}: {e}")
 
+def task_fields(task: Task) -> tuple[int, str]:
+    """(实送瓶数, 备注)"""
+    # delivered_bottles / remark 是列；只有旧写入路径留下的任务才需要回退到 payload_json
+    n, remark = task.delivered_bottles, task.remark
+    if n is None or remark is None:
+        data = _payload(task)
+        n = int(data.get("delivered_bottles", 0) or 0) if n is None else n
+        remark = data.get("remark") if remark is None else remark
+    return n, remark
+
+def _build_reminder_lines(task: Task, balances: dict) -> tuple[list[str], dict]:
+    """续费提醒：预测结果在 payload_json 中，余额取发送时的最新值；不扣费"""
+    sub, cust = task.subscription, task.customer
+    if sub.type == "by_bottle":
+        after = int(balances.get("bottle_balance") or 0)
+        balance_text = f"剩余{after}瓶"
+    else:
+        after = balances.get("amount_balance") or ZERO
+        balance_text = f"余额¥{after:.2f}"
+    lines = render_template(task.template_key, {
+        "customer_name": cust.name or cust.wx_display_name,
+        "balance_text": balance_text,
+        **_payload(task),
+    }).splitlines()
+    return lines, {"type": "reminder", "charge": 0, "after": after}
+
 def _build_lines_for_send(task: Task, balances: dict) -> tuple[list[str], dict]:
     """
-    根据订阅类型生成要发送的文本行，并返回预览信息（after/charge/type）
+    根据订阅类型生成要发送的文本行，并返回预览信息（after/charge/type）。
+    按金额订阅的 charge/after 是 Money，按瓶订阅是整数瓶数
     """
     sub, cust = task.subscription, task.customer
     if not sub:
         raise ValueError("Task has no subscription")
+    if task.slot == REMINDER_SLOT:
+        return _build_reminder_lines(task, balances)
 
-    data = _payload(task)
-    n = int(data.get("delivered_bottles", 0) or 0)
+    n, remark = task_fields(task)
     if n <= 0:
         raise ValueError("delivered_bottles must > 0")
 
     if sub.type == "by_bottle":
         before = int(balances.get("bottle_balance") or 0)
         after = before - n
-        lines = _render_template(task.template_key, {
+        lines = render_template(task.template_key, {
             "customer_name": cust.name or cust.wx_display_name,
             "delivered_bottles": n,
             "balance_bottles_after": after,
-            "remark": data.get("remark") or "",
+            "remark": remark or "",
         }).splitlines()
         preview = {"type": sub.type, "charge": n, "after": after}
 
     elif sub.type == "by_amount":
-        unit = Decimal(str(sub.unit_price or "0"))
+        unit = sub.unit_price or ZERO
         charge = unit * n
-        before_amt = Decimal(str(balances.get("amount_balance") or "0"))
+        before_amt = balances.get("amount_balance") or ZERO
         after_amt = before_amt - charge
-        lines = _render_template(task.template_key, {
+        lines = render_template(task.template_key, {
             "customer_name": cust.name or cust.wx_display_name,
             "delivered_bottles": n,
             "unit_price": f"{unit:.2f}",
             "amount_charge": f"{charge:.2f}",
             "balance_amount_after": f"{after_amt:.2f}",
-            "used_amount": f"{Decimal('0.00'):.2f}",
+            "used_amount": f"{ZERO:.2f}",
             "total_amount": f"{before_amt:.2f}",
         }).splitlines()
-        preview = {"type": sub.type, "charge": float(charge), "after": float(after_amt)}
+        preview = {"type": sub.type, "charge": charge, "after": after_amt}
 
     else:
         raise ValueError(f"Unknown subscription type: {sub.type}")
 
+    # 透支：预检之后余额又有变化，或任务未经调度器预检（直接调用 process_one_task）
+    if preview["after"] < 0:
+        if OVERDRAW_POLICY != "notice":
+            raise InsufficientBalance(f"insufficient balance: after={preview['after']}")
+        lines += render_template(LOW_BALANCE_TEMPLATE, {
+            "customer_name": cust.name or cust.wx_display_name,
+            "subscription_type": sub.type,
+        }).splitlines()
+
     # 简单长度/金额格式校验（可按需扩展）
     if len("\n".join(lines)) > 500:
         raise ValueError("message too long")
 
     return lines, preview
 
-def _record_ledger_after_success(s, task: Task, preview: dict):
+def _ledger_row(task: Task, preview: dict) -> dict:
+    """发送成功后的扣费流水（列值）"""
     sub, cust = task.subscription, task.customer
+    row = {
+        "ts": clock.now(),
+        "subscription_id": sub.id,
+        "customer_id": cust.id,
+        "kind": "delivery",
+        "ref_task_id": task.id,
+    }
     if sub.type == "by_bottle":
-        add_transaction(
-            s,
-            subscription_id=sub.id,
-            customer_id=cust.id,
-            kind="delivery",
-            bottle_delta=-int(preview["charge"]),
-            amount_delta=Decimal("0.00"),
-            ref_task_id=task.id,
-            memo="auto bottle delivery",
-        )
+        row.update(bottle_delta=-int(preview["charge"]), amount_delta=ZERO, memo="auto bottle delivery")
     else:
-        add_transaction(
-            s,
-            subscription_id=sub.id,
-            customer_id=cust.id,
-            kind="delivery",
-            bottle_delta=0,
-            amount_delta=-(Decimal(str(preview["charge"]))),
-            ref_task_id=task.id,
-            memo="auto amount delivery",
-        )
+        row.update(bottle_delta=0, amount_delta=-preview["charge"], memo="auto amount delivery")
+    return row
 
+@profiled("hook.process_one_task")
 def process_one_task(task_id: int):
     """
     调度器调用的唯一入口
     """
-    from sender import send_text_lines  # 延迟导入，便于单元测试与可选依赖
+    import sender  # 延迟导入，便于单元测试与可选依赖
 
-    with session_scope() as s:
+    with log_context(task_id=task_id), session_scope() as s:
         task: Task | None = s.get(Task, task_id)
         if not task:
             logger.warning(f"Task#{task_id} not found.")
+            metrics.inc("tasks_total", outcome="skipped")
             return
         if task.status != "pending":
             logger.info(f"Task#{task_id} already processed: {task.status}")
+            metrics.inc("tasks_total", outcome="skipped")
             return
+        bind_context(customer_id=task.customer_id)
 
-        try:
-            # 取当前余额
-            balances = recalc_subscription_balance(s, task.subscription_id)
-            if not balances:
-                raise ValueError("Subscription not found or no balance info")
+        started_at, t0 = clock.now(), clock.monotonic()
+        intent = False
+        attempt = {"backend": sender.backend_name(), "account": sender.current_sender().name}
+        with metrics.collect_stages() as stages:
+            try:
+                # 取当前余额
+                with metrics.span("balance"):
+                    # 加上已发送、尚未分组提交的扣减
+                    balances = journal.adjust_balances(recalc_subscription_balance(s, task.subscription_id))
+                if not balances:
+                    raise ValueError("Subscription not found or no balance info")
 
-            # 渲染文本，生成预览
-            lines, preview = _build_lines_for_send(task, balances)
-            logger.info(f"Preview Task#{task.id}: {preview}")
+                # 渲染文本，生成预览
+                with metrics.span("render"):
+                    lines, preview = _build_lines_for_send(task, balances)
+                logger.info(f"Preview Task#{task.id}: {preview}")
 
-            # 真实发送（DRY_RUN=True 时仅模拟，不回车）
-            contact = task.customer.wx_display_name or task.customer.name
-            send_text_lines(contact, lines)
+                # 真实发送（DRY_RUN=True 时仅模拟，不回车）
+                contact = task.customer.wx_display_name or task.customer.name
+                metrics.observe(
+                    "send_lag_seconds",
+                    max(0.0, (clock.now() - task.send_time).total_seconds()),
+                )
+                journal.intent(task.id)
+                intent = True
+                with metrics.span("send"):
+                    sender.send_text_lines(
+                        contact, lines, task_id=task.id, mode=sender.message_mode(task.template_key)
+                    )
 
-            # 发送成功后记账 + 更新任务状态
-            _record_ledger_after_success(s, task, preview)
-            mark_task_status(s, task, "sent", "ok", increment_try=True)
-            logger.info(f"Task#{task.id} sent ok.")
+                # 发送成功：流水 + 尝试记录 + 状态写入本地日志即确认，数据库由 journal 分组提交
+                with metrics.span("journal"):
+                    journal.submit(journal.sent_result(
+                        task.id,
+                        ledger=_ledger_row(task, preview) if preview["type"] != "reminder" else None,
+                        attempt=attempt_row(
+                            task, "sent", started_at, (clock.monotonic() - t0) * 1000, stages, **attempt
+                        ),
+                    ))
+                metrics.inc("tasks_total", outcome="sent")
+                logger.info(f"Task#{task.id} sent ok.")
 
-        except Exception as e:
-            logger.exception(e)
-            mark_task_status(s, task, "failed", str(e), increment_try=True)
+            except Exception as e:
+                s.rollback()
+                # 余额不足且策略为 hold：不算失败，等充值后由 preflight.release_held 放回 pending
+                outcome = "held" if isinstance(e, InsufficientBalance) and OVERDRAW_POLICY == "hold" else "failed"
+                if outcome == "held":
+                    logger.warning(f"Task#{task.id} held: {e}")
+                else:
+                    logger.exception(e)
+                record_attempt(s, task, outcome, started_at, (clock.monotonic() - t0) * 1000, stages,
+                               error=e, **attempt)
+                mark_task_status(s, task, outcome, str(e), increment_try=True)
+                committed = False
+                try:
+                    with metrics.span("commit"):
+                        s.commit()
+                    committed = True
+                finally:
+                    # intent 总要处理：失败状态已落库则关闭；没落库（任务仍是 pending）则留给 recover 标记 unconfirmed
+                    if intent and committed:
+                        journal.abort(task.id)
+                    elif intent:
+                        journal.orphan(task.id)
+                metrics.inc("tasks_total", outcome=outcome)
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+importer.py
+批量导入客户 + 订阅 + 期初余额（CSV / XLSX）：
+- 逐行流式读取并校验，按 IMPORT_CHUNK_SIZE 分块，每块一个事务批量插入
+- 按 wx_display_name / 手机号去重（库中已有或文件中重复的行进入拒绝文件）
+- 进度（已处理到第几行、拒绝文件写到哪）与数据写在同一事务里，失败后重跑自动从断点继续
+- 不合格的行写入拒绝文件（原始列 + 行号 + 原因）
+
+CSV 列（表头）：wx_display_name*, name, phone, address, preferred_send_time,
+             type*（by_bottle / by_amount）, unit_price, opening_bottles, opening_amount, note,
+             account（发送账号，须在 config.SENDER_ACCOUNTS 中；空=默认账号）
+
+用法：python importer.py customers.csv [--reject rejects.csv] [--chunk 5000] [--restart]
+"""
+
+import argparse
+import csv
+import os
+import sys
+from datetime import datetime
+from decimal import InvalidOperation
+
+from sqlalchemy import func, insert, select, update
+
+import clock
+from db_utils import session_scope, init_db
+from log_utils import get_logger
+from models import Customer, Subscription, LedgerTransaction, ImportJob
+from money import Money, ZERO
+
+try:
+    from config import IMPORT_CHUNK_SIZE
+except Exception:
+    IMPORT_CHUNK_SIZE = 5000
+
+logger = get_logger(__name__)
+
+COLUMNS = [
+    "wx_display_name", "name", "phone", "address", "preferred_send_time",
+    "type", "unit_price", "opening_bottles", "opening_amount", "note", "account",
+]
+SUB_TYPES = ("by_bottle", "by_amount")
+
+
+class RowError(ValueError):
+    pass
+
+
+# ---------------------- 读取 ----------------------
+def _is_xlsx(path: str) -> bool:
+    return path.lower().endswith((".xlsx", ".xlsm"))
+
+
+def _load_workbook():
+    """openpyxl 是可选依赖（见 requirements.txt），只有读 XLSX 时才需要"""
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise RuntimeError("读取 XLSX 需要 openpyxl：pip install openpyxl")
+    return load_workbook
+
+
+def iter_rows(path: str, sheet: str = None):
+    """逐行产出 (行号, dict)；行号从 2 开始（第 1 行是表头），与表格软件一致"""
+    if _is_xlsx(path):
+        wb = _load_workbook()(path, read_only=True, data_only=True)
+        try:
+            ws = wb[sheet] if sheet else wb.worksheets[0]
+            it = ws.iter_rows(values_only=True)
+            header = [str(h).strip() if h is not None else "" for h in next(it, [])]
+            for i, values in enumerate(it, start=2):
+                yield i, {
+                    h: ("" if v is None else str(v).strip())
+                    for h, v in zip(header, values) if h
+                }
+        finally:
+            wb.close()
+    else:
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            for i, row in enumerate(csv.DictReader(f), start=2):
+                yield i, {(k or "").strip(): (v or "").strip() for k, v in row.items()}
+
+
+# ---------------------- 校验 ----------------------
+def _norm_phone(p: str) -> str:
+    return "".join(ch for ch in p if ch.isdigit())
+
+
+def _money(v: str, field: str):
+    if not v:
+        return None
+    try:
+        return Money.of(v)
+    except (InvalidOperation, ValueError):
+        raise RowError(f"{field} 不是合法数字：{v}")
+
+
+def validate(row: dict) -> dict:
+    """返回规范化后的行；不合格抛 RowError"""
+    wx = row.get("wx_display_name", "")
+    if not wx:
+        raise RowError("缺少 wx_display_name")
+    typ = row.get("type", "")
+    if typ not in SUB_TYPES:
+        raise RowError(f"type 必须为 {' / '.join(SUB_TYPES)}：{typ!r}")
+    unit_price = _money(row.get("unit_price", ""), "unit_price")
+    if typ == "by_amount" and unit_price is None:
+        raise RowError("by_amount 订阅必须填写 unit_price")
+    try:
+        bottles = int(row.get("opening_bottles") or 0)
+    except ValueError:
+        raise RowError(f"opening_bottles 必须为整数：{row.get('opening_bottles')}")
+    amount = _money(row.get("opening_amount", ""), "opening_amount") or ZERO
+    pst = row.get("preferred_send_time", "")
+    if pst:
+        try:
+            datetime.strptime(pst, "%H:%M")
+        except ValueError:
+            raise RowError(f"preferred_send_time 应为 HH:MM：{pst}")
+    account = row.get("account", "")
+    if account:
+        from sender import account_names
+
+        if account not in account_names():
+            raise RowError(f"account 未在 SENDER_ACCOUNTS 中配置：{account}")
+    return {
+        "wx_display_name": wx,
+        "name": row.get("name") or None,
+        "phone": _norm_phone(row.get("phone", "")) or None,
+        "address": row.get("address") or None,
+        "preferred_send_time": pst or None,
+        "type": typ,
+        "unit_price": unit_price,
+        "opening_bottles": bottles,
+        "opening_amount": amount,
+        "note": row.get("note") or None,
+        "account": account or None,
+    }
+
+
+# ---------------------- 写入 ----------------------
+def _load_existing_keys(s):
+    """已有客户的去重键（只取两列，内存与客户数成正比，与导入文件大小无关）"""
+    names, phones = set(), set()
+    for wx, phone in s.execute(select(Customer.wx_display_name, Customer.phone)):
+        names.add(wx)
+        if phone:
+            phones.add(_norm_phone(phone))
+    return names, phones
+
+
+def _next_id(s, model) -> int:
+    return (s.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+def _flush_chunk(s, chunk: list, job_id: int, last_row: int, rejected: int, reject_offset: int):
+    """
+    一个事务：进度 -> 客户 -> 订阅 -> 期初流水。
+    先更新进度行拿到写锁，再预分配主键，之后全部用 Core executemany 批量插入（不逐行取回 id）。
+    """
+    now = clock.now()
+    s.execute(
+        update(ImportJob)
+        .where(ImportJob.id == job_id)
+        .values(
+            last_row=last_row,
+            imported=ImportJob.imported + len(chunk),
+            rejected=rejected,
+            reject_offset=reject_offset,
+            updated_at=now,
+        )
+    )
+    if not chunk:
+        return
+    cust0 = _next_id(s, Customer)
+    sub0 = _next_id(s, Subscription)
+    s.execute(
+        insert(Customer.__table__),
+        [
+            {
+                "id": cust0 + i,
+                "wx_display_name": r["wx_display_name"],
+                "name": r["name"],
+                "phone": r["phone"],
+                "address": r["address"],
+                "preferred_send_time": r["preferred_send_time"],
+                "account": r["account"],
+                "active": 1,
+                "created_at": now,
+            }
+            for i, r in enumerate(chunk)
+        ],
+    )
+    s.execute(
+        insert(Subscription.__table__),
+        [
+            {
+                "id": sub0 + i,
+                "customer_id": cust0 + i,
+                "type": r["type"],
+                "unit_price": r["unit_price"],
+                "status": "active",
+                "start_date": now,
+                "note": r["note"],
+            }
+            for i, r in enumerate(chunk)
+        ],
+    )
+    ledger = [
+        {
+            "customer_id": cust0 + i,
+            "subscription_id": sub0 + i,
+            "ts": now,
+            "kind": "purchase",
+            "bottle_delta": r["opening_bottles"],
+            "amount_delta": r["opening_amount"],
+            "memo": "opening balance (import)",
+        }
+        for i, r in enumerate(chunk)
+        if r["opening_bottles"] or r["opening_amount"]
+    ]
+    if ledger:
+        s.execute(insert(LedgerTransaction.__table__), ledger)
+
+
+def _get_job(s, source: str, restart: bool) -> ImportJob:
+    size = os.path.getsize(source)
+    job = (
+        s.query(ImportJob)
+        .filter(ImportJob.source == source, ImportJob.source_size == size)
+        .order_by(ImportJob.id.desc())
+        .first()
+    )
+    if restart:
+        job = None
+    if job is None:
+        job = ImportJob(source=source, source_size=size, last_row=1, imported=0, rejected=0,
+                        status="running", started_at=clock.now(), updated_at=clock.now())
+        s.add(job)
+        s.flush()
+    return job
+
+
+def import_file(path: str, reject_path: str = None, chunk_size: int = IMPORT_CHUNK_SIZE,
+                sheet: str = None, restart: bool = False) -> dict:
+    source = os.path.abspath(path)
+    reject_path = reject_path or f"{os.path.splitext(path)[0]}.rejects.csv"
+    if _is_xlsx(path):
+        _load_workbook()  # 缺库时在建导入任务、写拒绝文件之前就报错
+    init_db()
+
+    with session_scope() as s:
+        job = _get_job(s, source, restart)
+        job_id, start_after, status = job.id, job.last_row, job.status
+        rejected, reject_offset = job.rejected or 0, job.reject_offset or 0
+        names, phones = _load_existing_keys(s)
+    if status == "done":
+        logger.info(f"{path} 已导入完成（job#{job_id}），如需重导请加 --restart")
+        return {"job_id": job_id, "imported": 0, "rejected": 0, "skipped": True}
+
+    resuming = start_after > 1
+    if resuming:
+        logger.info(f"从第 {start_after + 1} 行继续导入（job#{job_id}）")
+        # 丢掉上次崩溃前、未提交那一块写进拒绝文件的行，避免重复
+        if os.path.exists(reject_path) and os.path.getsize(reject_path) > reject_offset:
+            os.truncate(reject_path, reject_offset)
+
+    t0 = clock.monotonic()
+    imported = 0
+    chunk, last_row = [], start_after
+    with open(reject_path, "a" if resuming else "w", newline="", encoding="utf-8-sig") as rf:
+        rw = csv.writer(rf)
+        if not resuming:
+            rw.writerow(COLUMNS + ["_row", "_reason"])
+
+        for row_no, raw in iter_rows(path, sheet=sheet):
+            if row_no <= start_after:
+                continue
+            last_row = row_no
+            try:
+                r = validate(raw)
+                if r["wx_display_name"] in names:
+                    raise RowError("wx_display_name 已存在")
+                if r["phone"] and r["phone"] in phones:
+                    raise RowError("phone 已存在")
+            except RowError as e:
+                rejected += 1
+                rw.writerow([raw.get(c, "") for c in COLUMNS] + [row_no, str(e)])
+            else:
+                names.add(r["wx_display_name"])
+                if r["phone"]:
+                    phones.add(r["phone"])
+                chunk.append(r)
+
+            if len(chunk) >= chunk_size:
+                rf.flush()
+                with session_scope() as s:
+                    _flush_chunk(s, chunk, job_id, last_row, rejected, rf.tell())
+                imported += len(chunk)
+                chunk = []
+
+        rf.flush()
+        with session_scope() as s:
+            _flush_chunk(s, chunk, job_id, last_row, rejected, rf.tell())
+            s.execute(update(ImportJob).where(ImportJob.id == job_id).values(status="done"))
+        imported += len(chunk)
+
+    elapsed = clock.monotonic() - t0
+    rate = imported / elapsed * 60 if elapsed > 0 else 0
+    logger.info(f"导入完成 job#{job_id}：新增 {imported}，拒绝 {rejected}，用时 {elapsed:.1f}s（{rate:.0f} 行/分钟）")
+    return {"job_id": job_id, "imported": imported, "rejected": rejected,
+            "elapsed": elapsed, "reject_file": reject_path}
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="批量导入客户/订阅/期初余额")
+    ap.add_argument("path", help="CSV 或 XLSX 文件")
+    ap.add_argument("--reject", help="拒绝文件路径（默认 <文件名>.rejects.csv）")
+    ap.add_argument("--chunk", type=int, default=IMPORT_CHUNK_SIZE, help="每个事务的行数")
+    ap.add_argument("--sheet", help="XLSX 工作表名（默认第一个）")
+    ap.add_argument("--restart", action="store_true", help="忽略断点，从头导入")
+    args = ap.parse_args(argv)
+    try:
+        res = import_file(args.path, args.reject, args.chunk, args.sheet, args.restart)
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        return 2
+    if not res.get("skipped"):
+        print(f"✅ 新增 {res['imported']} 行，拒绝 {res['rejected']} 行（见 {res['reject_file']}）")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+"""
+journal.py
+发送结果的本地日志 + 分组提交：
+- 发送成功后，结果（任务状态、扣费流水、尝试记录）先追加到本地日志并 fsync，写完才算确认；
+  数据库写入攒到 COMMIT_BATCH_SIZE 条、或最早一条已等待 COMMIT_MAX_DELAY_SECONDS 秒时在一个事务里提交，
+  调度器每个 tick 结束时也提交一次。早高峰的 fsync 次数和写锁占用（GUI 等的就是这把锁）随之减少
+- 提交成功后压缩日志（写临时文件后原子替换）；进程崩溃留下的未提交结果，在下次启动首次使用本模块时补写
+- 写库是幂等的：只有状态还不是 sent 的任务才写流水，补写与已提交的事务重叠也不会重复记账
+- 结果还在缓冲里的任务在库里仍是 pending：调度器取任务时排除它们，hook/预检算余额时计入未提交的扣减，
+  因此既不会重发，也不会用过期余额
+- 发送前先写一条 intent（fsync），成功由 sent 关闭、失败由 abort 关闭。进程在发送中途崩溃时，
+  重启只需处理日志里没有关闭的 intent：对应任务若仍是 pending，改为 unconfirmed（可能已经发出），
+  不再自动重发，也不扣费，由人工核对后 resolve（不必全表比对任务与流水）
+- 群发收件人（campaigns.send_recipient）同样先写 intent（带 recipient_id），状态提交后关闭；
+  中途崩溃的收件人改为 unconfirmed，核对后用 python campaigns.py retry ID --unconfirmed 重新排队
+多进程分账号发送（WECHAT_ACCOUNTS）时，每个进程使用自己的日志文件。
+首次使用时对同目录的 <日志>.lock 加排他锁并持有到进程退出：同一日志只能有一个进程读写，
+调度器运行时 review/resolve 不碰日志文件，只核对数据库（遗留 intent 由调度器启动时处理）。
+
+用法：
+    python journal.py review
+    python journal.py resolve 123 sent|resend
+"""
+
+import argparse
+import atexit
+import json
+import os
+import sys
+import threading
+from datetime import datetime
+
+from sqlalchemy import func, select, update
+
+import clock
+import metrics
+from db_utils import session_scope
+from log_utils import get_logger
+from models import CampaignRecipient, LedgerTransaction, Task, TaskAttempt, REMINDER_SLOT
+from money import Money
+
+try:
+    from config import COMMIT_BATCH_SIZE, COMMIT_MAX_DELAY_SECONDS, SEND_JOURNAL_PATH
+except Exception:
+    COMMIT_BATCH_SIZE = 20
+    COMMIT_MAX_DELAY_SECONDS = 5
+    SEND_JOURNAL_PATH = "send_journal.jsonl"
+
+logger = get_logger(__name__)
+
+_DT_FIELDS = ("ts", "started_at", "finished_at")
+
+_lock = threading.RLock()
+_buffer = []  # 已写入日志、尚未提交到数据库的结果（与日志行相同的 JSON 结构）
+_oldest = None  # 缓冲中最早一条的 monotonic 时间
+_intents = {}  # 已写 intent、尚未关闭的任务：{task_id 或 ("recipient", id): intent 记录}
+_orphans = {}  # 上次进程遗留、还没标记为 unconfirmed 的 intent
+_fh = None
+_lock_fh = None  # <日志>.lock，持有期间其他进程不能使用同一日志
+
+UNCONFIRMED = "unconfirmed"
+
+
+class JournalBusy(RuntimeError):
+    """同一发送日志正被另一个进程使用（调度器正在运行）"""
+
+
+def journal_path() -> str:
+    only = [x.strip() for x in os.environ.get("WECHAT_ACCOUNTS", "").split(",") if x.strip()]
+    if not only:
+        return SEND_JOURNAL_PATH
+    root, ext = os.path.splitext(SEND_JOURNAL_PATH)
+    return f"{root}.{'_'.join(only)}{ext}"
+
+
+def _encode(d: dict):
+    if d is None:
+        return None
+    out = {}
+    for k, v in d.items():
+        if isinstance(v, datetime):
+            v = v.isoformat()
+        elif isinstance(v, Money):
+            v = v.cents
+        out[k] = v
+    return out
+
+
+def _decode(d: dict) -> dict:
+    out = dict(d)
+    for k in _DT_FIELDS:
+        if isinstance(out.get(k), str):
+            out[k] = datetime.fromisoformat(out[k])
+    if "amount_delta" in out:
+        out["amount_delta"] = Money(out["amount_delta"] or 0)
+    return out
+
+
+def _ref(task_id: int = None, recipient_id: int = None) -> tuple:
+    """(_intents 的键, 日志行里的字段)：任务用 task_id，群发收件人用 recipient_id"""
+    if recipient_id is not None:
+        return ("recipient", recipient_id), {"recipient_id": recipient_id}
+    return task_id, {"task_id": task_id}
+
+
+def _intent_key(rec: dict):
+    return _ref(rec.get("task_id"), rec.get("recipient_id"))[0]
+
+
+def intent(task_id: int = None, recipient_id: int = None):
+    """发送前调用：intent 落盘（fsync）后才能开始发送"""
+    key, ref = _ref(task_id, recipient_id)
+    rec = {"op": "intent", **ref, "ts": clock.now().isoformat()}
+    with _lock:
+        _open()
+        _append(rec)
+        _intents[key] = rec
+
+
+def abort(task_id: int = None, recipient_id: int = None):
+    """
+    关闭 intent：任务发送失败、失败状态已提交后调用；群发收件人无论成败，状态提交后都调用。
+    不 fsync：丢了也只是重启时多一条 intent，对应任务/收件人已不是 pending
+    """
+    key, ref = _ref(task_id, recipient_id)
+    with _lock:
+        if _intents.pop(key, None) is None:
+            return
+        _fh.write(json.dumps({"op": "abort", **ref}) + "\n")
+        _fh.flush()
+
+
+def orphan(task_id: int = None, recipient_id: int = None):
+    """
+    发送结束、但状态没能提交（如数据库被锁）时调用：任务/收件人在库里仍是 pending，可能已经发出。
+    intent 转为遗留 intent，下个 tick 的 recover 把它标记为 unconfirmed；在此之前调度器不会取它
+    """
+    key, _ = _ref(task_id, recipient_id)
+    with _lock:
+        rec = _intents.pop(key, None)
+        if rec is not None:
+            _orphans[key] = rec
+
+
+def sent_result(task_id: int, ledger: dict = None, attempt: dict = None, result_log: str = "ok") -> dict:
+    """一条发送成功的结果：ledger 为 add_transaction 的参数，attempt 为 db_utils.attempt_row 的返回值"""
+    return {
+        "op": "sent",
+        "task_id": task_id,
+        "ts": clock.now().isoformat(),
+        "result_log": result_log,
+        "ledger": _encode(ledger),
+        "attempt": _encode(attempt),
+    }
+
+
+# ---------------------- 日志文件 ----------------------
+def _read(path: str) -> list:
+    if not os.path.exists(path):
+        return []
+    out = []
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                out.append(json.loads(line))
+            except ValueError:
+                # 只可能是崩溃时写了一半的最后一行（它还没有被确认）
+                logger.warning(f"发送日志第 {n} 行不完整，已忽略")
+    return out
+
+
+def _acquire_file_lock(path: str):
+    """对 <日志>.lock 加非阻塞排他锁；已被其他进程持有时抛 JournalBusy。锁随进程退出由系统释放"""
+    global _lock_fh
+    if _lock_fh is not None:
+        return
+    fh = open(f"{path}.lock", "a+")
+    try:
+        if os.name == "nt":
+            import msvcrt
+
+            fh.seek(0)
+            msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fh.close()
+        raise JournalBusy(f"发送日志 {path} 正被另一个进程使用（调度器正在运行？）")
+    _lock_fh = fh
+
+
+def _open():
+    """
+    首次使用：锁定日志，读上次进程遗留的日志——未提交的 sent 结果补写数据库，
+    没有关闭的 intent 对应的任务标记为 unconfirmed——然后把日志重写为只含本进程的内容
+    """
+    global _fh, _oldest
+    if _fh is not None:
+        return
+    path = journal_path()
+    _acquire_file_lock(path)
+    leftover = []
+    for rec in _read(path):
+        op = rec.get("op")
+        if op == "intent":
+            _orphans[_intent_key(rec)] = rec
+        elif op in ("sent", "abort"):
+            _orphans.pop(_intent_key(rec), None)
+            if op == "sent":
+                leftover.append(rec)
+    _fh = open(path, "a", encoding="utf-8")
+    atexit.register(flush)
+    if leftover:
+        logger.warning(f"发送日志中有 {len(leftover)} 条未提交的结果，补写数据库")
+        _buffer[:0] = leftover
+        _oldest = clock.monotonic() - COMMIT_MAX_DELAY_SECONDS
+        flush()
+    _settle()
+
+
+def _settle():
+    """把遗留 intent 对应的任务标记为 unconfirmed；数据库暂时写不进时保留，下次 recover 再试"""
+    if not _orphans:
+        return
+    try:
+        _mark_unconfirmed([k for k in _orphans if not isinstance(k, tuple)])
+        _mark_recipients_unconfirmed([k[1] for k in _orphans if isinstance(k, tuple)])
+    except Exception as e:
+        logger.exception(e)
+        return
+    _orphans.clear()
+    _rewrite()
+
+
+def _mark_unconfirmed(task_ids: list):
+    """上次进程发送中途退出的任务：仍是 pending/held 的改为 unconfirmed，等人工核对"""
+    if not task_ids:
+        return
+    T = Task.__table__
+    with session_scope() as s:
+        n = s.execute(
+            update(T)
+            .where(T.c.id.in_(task_ids), T.c.status.in_(("pending", "held")))
+            .values(
+                status=UNCONFIRMED,
+                result_log="发送中途进程退出，可能已发出：请核对后 python journal.py resolve",
+                updated_at=clock.now(),
+            )
+        ).rowcount
+    metrics.inc("journal_unconfirmed_total", n)
+    if n:
+        logger.warning(f"发送日志中有 {n} 个任务发送中断，已标记为 {UNCONFIRMED}，不会自动重发")
+
+
+def _mark_recipients_unconfirmed(recipient_ids: list):
+    """同上，群发收件人"""
+    if not recipient_ids:
+        return
+    R = CampaignRecipient.__table__
+    with session_scope() as s:
+        n = s.execute(
+            update(R)
+            .where(R.c.id.in_(recipient_ids), R.c.status == "pending")
+            .values(
+                status=UNCONFIRMED,
+                result_log="发送中途进程退出，可能已发出：请核对后 python campaigns.py retry ID --unconfirmed",
+                updated_at=clock.now(),
+            )
+        ).rowcount
+    metrics.inc("campaign_unconfirmed_total", n)
+    if n:
+        logger.warning(f"发送日志中有 {n} 个群发收件人发送中断，已标记为 {UNCONFIRMED}，不会自动重发")
+
+
+def _append(rec: dict):
+    _fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    _fh.flush()
+    os.fsync(_fh.fileno())
+
+
+def _fsync_dir(path: str):
+    """rename 之后同步目录项，断电后新文件名才一定生效（Windows 不支持也不需要）"""
+    if os.name == "nt":
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _rewrite():
+    """
+    压缩日志，只保留还在缓冲里的结果、尚未关闭的 intent（其他分片线程可能正在发送）和未处理的遗留 intent。
+    先写同目录的临时文件并 fsync，再 os.replace 覆盖：任何时刻断电，磁盘上都是完整的旧日志或新日志
+    """
+    global _fh
+    path = journal_path()
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for rec in list(_orphans.values()) + list(_intents.values()) + _buffer:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    _fh.close()  # Windows 上打开着的文件不能被替换
+    try:
+        os.replace(tmp, path)
+    finally:
+        # 替换失败时旧日志原样保留，继续追加
+        _fh = open(path, "a", encoding="utf-8")
+    _fsync_dir(path)
+
+
+def recover() -> int:
+    """打开日志并处理上次遗留的结果与 intent（调度器每个 tick 开始时调用，首次之外几乎无开销）"""
+    with _lock:
+        _open()
+        _settle()
+    return flush()
+
+
+# ---------------------- 提交 ----------------------
+def submit(rec: dict):
+    """结果写入日志（fsync）后返回，即为确认；达到条数/时间阈值时顺带提交"""
+    global _oldest
+    with _lock:
+        _open()
+        _append(rec)
+        _buffer.append(rec)
+        _intents.pop(rec["task_id"], None)
+        if _oldest is None:
+            _oldest = clock.monotonic()
+        due = len(_buffer) >= COMMIT_BATCH_SIZE or clock.monotonic() - _oldest >= COMMIT_MAX_DELAY_SECONDS
+    if due:
+        flush()
+
+
+def _apply(s, batch: list) -> int:
+    """把一批结果写进数据库（幂等），返回实际写入的任务数"""
+    T = Task.__table__
+    ledger, attempts, applied = [], [], 0
+    for rec in batch:
+        n = s.execute(
+            update(T)
+            .where(T.c.id == rec["task_id"], T.c.status != "sent")
+            .values(
+                status="sent",
+                result_log=rec.get("result_log"),
+                try_count=func.coalesce(T.c.try_count, 0) + 1,
+                updated_at=datetime.fromisoformat(rec["ts"]),
+            )
+        ).rowcount
+        if n != 1:
+            continue  # 已经提交过
+        applied += 1
+        if rec.get("ledger"):
+            ledger.append(_decode(rec["ledger"]))
+        if rec.get("attempt"):
+            attempts.append(_decode(rec["attempt"]))
+    if ledger:
+        s.execute(LedgerTransaction.__table__.insert(), ledger)
+    if attempts:
+        s.execute(TaskAttempt.__table__.insert(), attempts)
+    return applied
+
+
+def flush() -> int:
+    """把缓冲中的结果在一个事务里提交，成功后清空日志；失败时保留，下次再提交"""
+    global _oldest
+    with _lock:
+        if not _buffer:
+            return 0
+        batch = list(_buffer)
+        try:
+            with metrics.span("group_commit"), session_scope() as s:
+                n = _apply(s, batch)
+        except Exception as e:
+            logger.exception(e)
+            metrics.inc("group_commit_errors_total")
+            return 0
+        del _buffer[: len(batch)]
+        _oldest = None
+        if _fh is not None:
+            _rewrite()
+    metrics.observe("group_commit_size", len(batch))
+    if n != len(batch):
+        logger.info(f"分组提交：{len(batch)} 条结果中 {len(batch) - n} 条此前已提交")
+    return n
+
+
+# ---------------------- 给调度器/余额计算的视图 ----------------------
+def pending_task_ids() -> set:
+    """调度器不能取的任务：结果还在缓冲里的、intent 还没关闭的，以及遗留 intent 还没处理完的"""
+    with _lock:
+        open_ = {k for k in list(_intents) + list(_orphans) if not isinstance(k, tuple)}
+        return {r["task_id"] for r in _buffer} | open_
+
+
+def pending_recipient_ids() -> set:
+    """调度器不能取的群发收件人：intent 还没关闭的，以及遗留 intent 还没处理完的"""
+    with _lock:
+        return {k[1] for k in list(_intents) + list(_orphans) if isinstance(k, tuple)}
+
+
+def pending_deltas() -> dict:
+    """未提交的扣减：{subscription_id: (瓶数变化, 金额变化的分)}"""
+    out = {}
+    with _lock:
+        for r in _buffer:
+            lg = r.get("ledger")
+            if not lg:
+                continue
+            b, c = out.get(lg["subscription_id"], (0, 0))
+            out[lg["subscription_id"]] = (b + (lg.get("bottle_delta") or 0), c + (lg.get("amount_delta") or 0))
+    return out
+
+
+def adjust_balances(balances: dict) -> dict:
+    """recalc_subscription_balance 的结果加上未提交的扣减"""
+    if balances:
+        b, c = pending_deltas().get(balances["subscription_id"], (0, 0))
+        if b or c:
+            balances["bottle_balance"] += b
+            balances["amount_balance"] += Money(c)
+    return balances
+
+
+# ---------------------- 人工核对 ----------------------
+def unconfirmed(s) -> list:
+    return s.execute(select(Task).where(Task.status == UNCONFIRMED).order_by(Task.id)).scalars().all()
+
+
+def resolve(s, task_id: int, sent: bool) -> Task:
+    """
+    核对结果：sent=True 表示客户确实收到了，补记扣费流水并标记 sent；
+    否则放回 pending 由调度器重新发送
+    """
+    import hook
+    from db_utils import mark_task_status
+    from money import ZERO
+
+    task = s.get(Task, task_id)
+    if task is None or task.status != UNCONFIRMED:
+        raise ValueError(f"Task#{task_id} 不是 {UNCONFIRMED} 状态")
+    if not sent:
+        mark_task_status(s, task, "pending", "人工核对：未发出，重新排队", increment_try=False)
+        return task
+    if task.slot != REMINDER_SLOT:
+        n, _ = hook.task_fields(task)
+        sub = task.subscription
+        charge = n if sub.type == "by_bottle" else (sub.unit_price or ZERO) * n
+        s.add(LedgerTransaction(**hook._ledger_row(task, {"charge": charge})))
+    mark_task_status(s, task, "sent", "人工核对：已发出", increment_try=False)
+    return task
+
+
+def main(argv=None) -> int:
+    from db_utils import init_db
+
+    ap = argparse.ArgumentParser(description="发送日志：中断任务的人工核对")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("review", help=f"列出 {UNCONFIRMED} 任务")
+    p = sub.add_parser("resolve", help="核对结果：sent=已发出（补记扣费），resend=未发出（重新排队）")
+    p.add_argument("task_id", type=int)
+    p.add_argument("result", choices=["sent", "resend"])
+    args = ap.parse_args(argv)
+
+    init_db()
+    try:
+        recover()
+    except JournalBusy as e:
+        # 日志归调度器所有：它启动时已把遗留 intent 标记为 unconfirmed，这里只核对数据库
+        print(f"⚠ {e}：不处理日志，只核对数据库中的 {UNCONFIRMED} 任务")
+    with session_scope() as s:
+        if args.cmd == "review":
+            rows = unconfirmed(s)
+            for t in rows:
+                print(f"Task#{t.id}  客户#{t.customer_id}  {t.send_time:%Y-%m-%d %H:%M}  {t.template_key}  {t.updated_at:%H:%M:%S}")
+            print(f"{len(rows)} 个任务待核对")
+            return 0
+        try:
+            t = resolve(s, args.task_id, args.result == "sent")
+        except ValueError as e:
+            print(f"❌ {e}")
+            return 1
+        print(f"Task#{t.id} -> {t.status}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
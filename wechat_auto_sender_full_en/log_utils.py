@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+log_utils.py
+统一日志配置：
+- 所有模块用 get_logger(__name__)，记录先进内存队列，由后台线程写出（发送路径不等磁盘）
+- 文件 LOG_PATH：每行一条 JSON，带 task_id / customer_id / shard / stage / duration_ms；
+  异常堆栈由 QueueHandler 入队前拼进 msg（入队时 exc_info 已清空）
+- 按大小或按时间轮转，旧文件 gzip 压缩，保留 LOG_BACKUP_COUNT 份
+- query_logs() 按任务/客户/阶段过滤（含已压缩的历史文件）
+- 导入时不开文件、不起线程：第一条日志到来时才真正初始化
+"""
+
+import atexit
+import contextvars
+import glob
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    from config import (
+        LOG_PATH,
+        LOG_FILE_LEVEL,
+        LOG_CONSOLE_LEVEL,
+        LOG_MAX_BYTES,
+        LOG_ROTATE_WHEN_SECONDS,
+        LOG_BACKUP_COUNT,
+    )
+except Exception:
+    LOG_PATH = "wechat_run.log"
+    LOG_FILE_LEVEL = "DEBUG"
+    LOG_CONSOLE_LEVEL = "INFO"
+    LOG_MAX_BYTES = 20 * 1024 * 1024
+    LOG_ROTATE_WHEN_SECONDS = 24 * 3600
+    LOG_BACKUP_COUNT = 14
+
+ROOT = "wechat"
+
+# 结构化字段：通过 log_context() 设置，对其中所有日志生效
+FIELDS = ("task_id", "customer_id", "shard", "campaign_recipient", "stage", "duration_ms")
+_context = contextvars.ContextVar("wechat_log_context", default={})
+
+
+@contextmanager
+def log_context(**fields):
+    """在 with 块内的所有日志自动带上这些字段（如 task_id、customer_id）"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def bind_context(**fields):
+    """在当前 log_context 内追加字段（随外层 with 结束一起失效）"""
+    _context.set({**_context.get(), **fields})
+
+
+class _ContextFilter(logging.Filter):
+    def filter(self, record):
+        for k, v in _context.get().items():
+            if not hasattr(record, k):
+                setattr(record, k, v)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        doc = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for k in FIELDS:
+            v = getattr(record, k, None)
+            if v is not None:
+                doc[k] = v
+        return json.dumps(doc, ensure_ascii=False, default=str)
+
+
+class SizeTimeRotatingHandler(logging.handlers.BaseRotatingHandler):
+    """文件超过 max_bytes 或距上次轮转超过 interval 秒时轮转，旧文件压缩为 .gz"""
+
+    def __init__(self, filename, max_bytes, interval, backup_count):
+        super().__init__(filename, "a", encoding="utf-8", delay=True)
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backup_count = backup_count
+        self.rollover_at = time.time() + interval
+
+    def shouldRollover(self, record):
+        if self.interval and time.time() >= self.rollover_at:
+            return True
+        if self.max_bytes and os.path.exists(self.baseFilename):
+            return os.path.getsize(self.baseFilename) >= self.max_bytes
+        return False
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+            dst = f"{self.baseFilename}.{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.gz"
+            with open(self.baseFilename, "rb") as src, gzip.open(dst, "wb") as out:
+                shutil.copyfileobj(src, out)
+            os.remove(self.baseFilename)
+        for old in rotated_files(self.baseFilename)[:-self.backup_count or None]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+        self.rollover_at = time.time() + self.interval
+
+
+def rotated_files(path: str = LOG_PATH) -> list:
+    """已轮转的压缩日志，按时间从旧到新"""
+    return sorted(glob.glob(f"{glob.escape(path)}.*.gz"))
+
+
+_setup_lock = threading.Lock()
+_listener = None
+_queue_handler = None
+
+
+class _LazySetupHandler(logging.Handler):
+    """占位 handler：收到第一条日志时完成真正的初始化，再把这条日志转交出去"""
+
+    def emit(self, record):
+        setup_logging().handle(record)
+
+
+_lazy_handler = _LazySetupHandler()
+
+
+def _level() -> int:
+    return min(logging.getLevelName(LOG_FILE_LEVEL), logging.getLevelName(LOG_CONSOLE_LEVEL))
+
+
+def setup_logging() -> logging.Handler:
+    """幂等：给 "wechat" 根 logger 挂上队列 handler，并启动后台写出线程"""
+    global _listener, _queue_handler
+    with _setup_lock:
+        if _listener is not None:
+            return _queue_handler
+        log_dir = os.path.dirname(os.path.abspath(LOG_PATH))
+        os.makedirs(log_dir, exist_ok=True)
+
+        file_h = SizeTimeRotatingHandler(
+            LOG_PATH, LOG_MAX_BYTES, LOG_ROTATE_WHEN_SECONDS, LOG_BACKUP_COUNT
+        )
+        file_h.setLevel(LOG_FILE_LEVEL)
+        file_h.setFormatter(JsonFormatter())
+
+        console_h = logging.StreamHandler(sys.stderr)
+        console_h.setLevel(LOG_CONSOLE_LEVEL)
+        console_h.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+        q = queue.SimpleQueue()
+        qh = logging.handlers.QueueHandler(q)
+        qh.addFilter(_ContextFilter())
+
+        root = logging.getLogger(ROOT)
+        root.setLevel(_level())
+        root.removeHandler(_lazy_handler)
+        root.addHandler(qh)
+        root.propagate = False
+
+        _listener = logging.handlers.QueueListener(q, file_h, console_h, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+        _queue_handler = qh
+        return qh
+
+
+def get_logger(name: str) -> logging.Logger:
+    root = logging.getLogger(ROOT)
+    if _listener is None and _lazy_handler not in root.handlers:
+        root.setLevel(_level())
+        root.addHandler(_lazy_handler)
+        root.propagate = False
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+def query_logs(task_id=None, customer_id=None, stage=None, level=None, since: datetime = None, path: str = LOG_PATH):
+    """按条件过滤 JSON 日志（先历史压缩文件，后当前文件），逐条 yield dict"""
+    since_s = since.isoformat() if since else None
+    files = rotated_files(path) + ([path] if os.path.exists(path) else [])
+    for f in files:
+        opener = gzip.open if f.endswith(".gz") else open
+        with opener(f, "rt", encoding="utf-8") as fh:
+            for line in fh:
+                try:
+                    doc = json.loads(line)
+                except ValueError:
+                    continue
+                if task_id is not None and doc.get("task_id") != task_id:
+                    continue
+                if customer_id is not None and doc.get("customer_id") != customer_id:
+                    continue
+                if stage is not None and doc.get("stage") != stage:
+                    continue
+                if level is not None and doc.get("level") != level:
+                    continue
+                if since_s and doc.get("ts", "") < since_s:
+                    continue
+                yield doc
+
+
+if __name__ == "__main__":
+    # 用法：python log_utils.py <task_id>
+    if len(sys.argv) < 2:
+        print("usage: python log_utils.py <task_id>")
+        sys.exit(1)
+    for d in query_logs(task_id=int(sys.argv[1])):
+        print(json.dumps(d, ensure_ascii=False))
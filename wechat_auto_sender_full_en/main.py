@@ -1,4 +1,123 @@
-from scheduler import start_scheduler
-from db_utils import init_db
-if __name__=='__main__':
-    init_db(); start_scheduler(); input('Running... Press Enter to exit')
+# -*- coding: utf-8 -*-
+"""
+命令行入口：
+- run（默认）：前台常驻，按 SCAN_INTERVAL_SECONDS 轮询（另有台账汇总、余额预测等定时任务）
+- drain：连续执行 tick，把到期任务按节奏发完后退出（夜间静默时段直接退出）
+- once：只执行一个 tick
+- stats：从数据库读取队列深度、最大延迟与吞吐，不启动调度、不导入发送相关模块
+Ctrl+C / SIGTERM（Windows 上还有 Ctrl+Break）：正在发送的任务照常完成并提交，之后退出；再按一次强制中断。
+--headless：不导入 pyautogui、不找微信窗口，发送动作为空操作。任务照常记为已发送并扣费，只用于测试库。
+
+用法：
+    python main.py [run|drain|once|stats] [--headless]
+"""
+
+import argparse
+import signal
+import sys
+import threading
+
+_stopped = threading.Event()
+
+
+def _on_signal(signum, _frame):
+    import scheduler
+
+    print(f"\n收到信号 {signum}：处理完当前任务后退出（再按一次强制中断）", flush=True)
+    scheduler.request_stop()
+    _stopped.set()
+    # 第二次信号按默认方式处理
+    signal.signal(signum, signal.SIG_DFL if signum != signal.SIGINT else signal.default_int_handler)
+
+
+def _install_signal_handlers():
+    for name in ("SIGINT", "SIGTERM", "SIGBREAK"):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), _on_signal)
+
+
+def cmd_run() -> int:
+    import scheduler
+
+    sched = scheduler.start_scheduler()
+    print("调度器已启动，Ctrl+C 退出", flush=True)
+    while not _stopped.wait(1):
+        pass
+    # 等正在执行的 tick 收尾（分片在当前任务完成后停下，worker 提交 journal 后返回）
+    sched.shutdown(wait=True)
+    return 0
+
+
+def cmd_drain() -> int:
+    import scheduler
+
+    scheduler.get_processor()
+    total = 0
+    while not scheduler.stopping():
+        n = scheduler.worker()
+        if not n:
+            break
+        total += n
+    print(f"本次共派发 {total} 条任务", flush=True)
+    return 0
+
+
+def cmd_once() -> int:
+    import scheduler
+
+    scheduler.get_processor()
+    print(f"本 tick 派发 {scheduler.worker()} 条任务", flush=True)
+    return 0
+
+
+def _fmt_seconds(sec: float) -> str:
+    m, s = divmod(int(sec), 60)
+    h, m = divmod(m, 60)
+    return f"{h}:{m:02d}:{s:02d}"
+
+
+def cmd_stats(window_minutes: int) -> int:
+    from db_utils import queue_stats, session_scope
+
+    with session_scope() as s:
+        st = queue_stats(s, window_minutes=window_minutes)
+    print(f"到期未发：{st['due']}    最早一条已延迟：{_fmt_seconds(st['oldest_lag'])}")
+    print(
+        f"最近 {window_minutes} 分钟发送成功：{st['sent_in_window']}（约 {st['per_hour']:.0f} 条/小时）"
+        + (f"，按此速度约 {_fmt_seconds(st['due'] / st['per_hour'] * 3600)} 发完" if st["due"] and st["per_hour"] else "")
+    )
+    print("各状态任务数：" + "，".join(f"{k} {v}" for k, v in sorted(st["by_status"].items())))
+    if st["next_send_time"]:
+        print(f"下一条待发：{st['next_send_time']:%Y-%m-%d %H:%M:%S}")
+    return 0
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="微信自动发送：调度器命令行")
+    ap.add_argument("cmd", nargs="?", choices=["run", "drain", "once", "stats"], default="run")
+    ap.add_argument("--headless", action="store_true", help="无界面，发送动作为空操作（只用于测试库）")
+    ap.add_argument("--window", type=int, default=60, help="stats：吞吐统计的时间窗（分钟）")
+    args = ap.parse_args(argv)
+
+    from db_utils import init_db
+
+    init_db()
+    if args.cmd == "stats":
+        return cmd_stats(args.window)
+
+    if args.headless:
+        import sender
+
+        sender.use_headless()
+    _install_signal_handlers()
+    import journal
+
+    try:
+        return {"run": cmd_run, "drain": cmd_drain, "once": cmd_once}[args.cmd]()
+    except journal.JournalBusy as e:
+        print(f"❌ {e}", flush=True)
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
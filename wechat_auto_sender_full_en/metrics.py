@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+metrics.py
+轻量指标采集：阶段耗时 span、滚动直方图、计数器、gauge。
+导出到 Prometheus 文本文件（METRICS_PROM_PATH）和本地 metrics 表，
+便于对比配置调整前后的耗时、发现容量瓶颈。
+textfile 每个 tick 覆盖写；metrics 表最多每 METRICS_DB_INTERVAL_SECONDS 秒写一次、只写有变化的指标，
+超过 METRICS_RETENTION_DAYS 天的行由调度器的定时清理删除（prune）。
+"""
+
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import timedelta
+
+try:
+    from config import METRICS_ENABLED, METRICS_PROM_PATH, METRICS_WINDOW
+except Exception:
+    METRICS_ENABLED = True
+    METRICS_PROM_PATH = "metrics.prom"
+    METRICS_WINDOW = 1024
+
+try:
+    from config import METRICS_DB_INTERVAL_SECONDS, METRICS_RETENTION_DAYS
+except Exception:
+    METRICS_DB_INTERVAL_SECONDS = 300
+    METRICS_RETENTION_DAYS = 14
+
+import clock
+from log_utils import get_logger
+
+logger = get_logger(__name__)
+
+PREFIX = "wechat_"
+
+# 直方图桶（秒），覆盖从毫秒级粘贴到小时级的发送延迟
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+_lock = threading.Lock()
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def _escape(v) -> str:
+    """Prometheus 文本格式的标签值转义：反斜杠、双引号、换行"""
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(labels: tuple, extra: tuple = ()) -> str:
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+class Histogram:
+    """累计桶（给 Prometheus） + 最近 N 个样本的滚动窗口（算分位数）"""
+
+    def __init__(self, window: int = METRICS_WINDOW):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, v: float):
+        self.count += 1
+        self.sum += v
+        self.recent.append(v)
+        for i, b in enumerate(BUCKETS):
+            if v <= b:
+                self.buckets[i] += 1
+
+    def quantile(self, q: float):
+        if not self.recent:
+            return None
+        data = sorted(self.recent)
+        idx = min(len(data) - 1, max(0, int(round(q * (len(data) - 1)))))
+        return data[idx]
+
+
+_stage_local = threading.local()
+
+_counters: dict = {}
+_gauges: dict = {}
+_histograms: dict = {}
+
+# metrics 表：上次写入的时间（monotonic）与各序列上次写入的值
+_db_flushed_at = None
+_db_last: dict = {}
+
+
+def inc(name: str, n: float = 1, **labels):
+    if not METRICS_ENABLED:
+        return
+    k = _key(name, labels)
+    with _lock:
+        _counters[k] = _counters.get(k, 0) + n
+
+
+def set_gauge(name: str, value: float, **labels):
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, value: float, **labels):
+    if not METRICS_ENABLED:
+        return
+    k = _key(name, labels)
+    with _lock:
+        h = _histograms.get(k)
+        if h is None:
+            h = _histograms[k] = Histogram()
+        h.observe(value)
+
+
+@contextmanager
+def span(stage: str):
+    """计时一个处理阶段，结果记入 stage_seconds{stage=...}，并写一条 DEBUG 结构化日志"""
+    stages = getattr(_stage_local, "stages", None)
+    if not METRICS_ENABLED and stages is None:
+        yield
+        return
+    t0 = clock.monotonic()
+    try:
+        yield
+    finally:
+        dt = clock.monotonic() - t0
+        if stages is not None:
+            stages[stage] = round(stages.get(stage, 0.0) + dt * 1000, 2)
+        if METRICS_ENABLED:
+            observe("stage_seconds", dt, stage=stage)
+            logger.debug("stage done", extra={"stage": stage, "duration_ms": round(dt * 1000, 2)})
+
+
+@contextmanager
+def collect_stages():
+    """
+    收集当前线程内各 span 的耗时（毫秒，同名阶段累加），yield 出的 dict 随 span 结束逐步填充。
+    用于把一次发送尝试的分阶段耗时写进 task_attempts；不受 METRICS_ENABLED 影响。
+    """
+    prev = getattr(_stage_local, "stages", None)
+    stages = _stage_local.stages = {}
+    try:
+        yield stages
+    finally:
+        _stage_local.stages = prev
+
+
+def snapshot() -> dict:
+    """当前所有指标的只读副本（供 GUI/报告使用）"""
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "histograms": {
+                k: {
+                    "count": h.count,
+                    "sum": h.sum,
+                    "p50": h.quantile(0.5),
+                    "p95": h.quantile(0.95),
+                    "p99": h.quantile(0.99),
+                }
+                for k, h in _histograms.items()
+            },
+        }
+
+
+def render_prometheus() -> str:
+    lines = []
+
+    def typed(name: str, kind: str, seen: set):
+        # 同名不同标签的序列共用一行 # TYPE，且必须在该指标的第一条样本之前
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+    seen = set()
+    with _lock:
+        for (name, labels), v in sorted(_counters.items()):
+            typed(name, "counter", seen)
+            lines.append(f"{PREFIX}{name}{_fmt_labels(labels)} {v}")
+        for (name, labels), v in sorted(_gauges.items()):
+            typed(name, "gauge", seen)
+            lines.append(f"{PREFIX}{name}{_fmt_labels(labels)} {v}")
+        for (name, labels), h in sorted(_histograms.items()):
+            typed(name, "histogram", seen)
+            for b, c in zip(BUCKETS, h.buckets):
+                lines.append(f"{PREFIX}{name}_bucket{_fmt_labels(labels, (('le', b),))} {c}")
+            lines.append(f"{PREFIX}{name}_bucket{_fmt_labels(labels, (('le', '+Inf'),))} {h.count}")
+            lines.append(f"{PREFIX}{name}_sum{_fmt_labels(labels)} {h.sum:.6f}")
+            lines.append(f"{PREFIX}{name}_count{_fmt_labels(labels)} {h.count}")
+    return "\n".join(lines) + "\n"
+
+
+def export_prometheus(path: str = None):
+    """原子写入 Prometheus textfile（node_exporter textfile collector 可直接读取）"""
+    path = path or METRICS_PROM_PATH
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(render_prometheus())
+    os.replace(tmp, path)
+
+
+def flush_to_db(s) -> dict:
+    """
+    把当前快照写入 metrics 表：计数器/gauge 各一行，直方图写 count/sum/p50/p95/p99。
+    只写与上次写入相比有变化的序列（读取时按“最近一次的值”理解）。
+    返回本次写入的 {(name, labels): value}；调用方提交成功后再交给 mark_flushed，
+    否则提交失败的序列会被当成已写入，下次不再补写。
+    """
+    from models import MetricSample
+
+    ts = clock.now()
+    snap = snapshot()
+    rows = []
+    for (name, labels), v in snap["counters"].items():
+        rows.append((name, labels, v))
+    for (name, labels), v in snap["gauges"].items():
+        rows.append((name, labels, v))
+    for (name, labels), h in snap["histograms"].items():
+        for stat in ("count", "sum", "p50", "p95", "p99"):
+            if h[stat] is not None:
+                rows.append((f"{name}_{stat}", labels, h[stat]))
+    written = {}
+    for name, labels, v in rows:
+        k = (name, labels)
+        if _db_last.get(k) == v:
+            continue
+        s.add(MetricSample(ts=ts, name=name, labels=_fmt_labels(labels), value=float(v)))
+        written[k] = v
+    return written
+
+
+def mark_flushed(written: dict):
+    """flush_to_db 的写入已提交：记下各序列的值"""
+    _db_last.update(written)
+
+
+def prune(s, days: float = METRICS_RETENTION_DAYS) -> int:
+    """删除 metrics 表中超过 days 天的行"""
+    from sqlalchemy import delete
+
+    from models import MetricSample
+
+    before = clock.now() - timedelta(days=days)
+    n = s.execute(delete(MetricSample).where(MetricSample.ts < before)).rowcount
+    if n:
+        logger.info(f"metrics: 清理 {n} 行（{days} 天前）")
+    return n
+
+
+def export():
+    """调度器每个 tick 结束时调用：文件每次都写，表按 METRICS_DB_INTERVAL_SECONDS 限频；失败不影响主流程"""
+    global _db_flushed_at
+    if not METRICS_ENABLED:
+        return
+    try:
+        export_prometheus()
+    except Exception as e:
+        logger.warning(f"metrics textfile export failed: {e}")
+    now = clock.monotonic()
+    if _db_flushed_at is not None and now - _db_flushed_at < METRICS_DB_INTERVAL_SECONDS:
+        return
+    _db_flushed_at = now
+    try:
+        from db_utils import session_scope
+
+        with session_scope() as s:
+            written = flush_to_db(s)
+        mark_flushed(written)
+    except Exception as e:
+        logger.warning(f"metrics table export failed: {e}")
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+migrations.py
+轻量的数据迁移：create_all 只会建新表，已有表的数据/语义变化在这里按版本号顺序执行一次。
+- schema_migrations 记录已执行的版本；每个迁移与它的版本记录在同一事务中提交
+- 由 db_utils.init_db() 调用；直接运行本文件可查看/执行待迁移项
+
+用法：python migrations.py [--status]
+"""
+
+import sys
+
+from sqlalchemy import inspect, select, text
+
+import clock
+from log_utils import get_logger
+from models import DEFAULT_SLOT, SchemaMigration
+
+logger = get_logger(__name__)
+
+
+def _is_integer_column(conn, table: str, column: str) -> bool:
+    for col in inspect(conn).get_columns(table):
+        if col["name"] == column:
+            return "INT" in str(col["type"]).upper()
+    return True  # 表或列不存在：无需迁移
+
+
+def _m001_money_to_cents(conn):
+    """
+    金额列从 Numeric(元，SQLite 中按 REAL 存) 改为整数分。
+    只转换声明类型仍为 NUMERIC 的旧列（新建的表已是 INTEGER，数据本来就是分）。
+    SQLite 不便修改列类型；NUMERIC 亲和性下写入的整数按 INTEGER 存储，SUM 结果为精确整数。
+    """
+    for table, column in (
+        ("subscriptions", "unit_price"),
+        ("ledger_transactions", "amount_delta"),
+        ("daily_rollups", "amount_sum"),
+    ):
+        if _is_integer_column(conn, table, column):
+            continue
+        n = conn.execute(
+            text(
+                f"UPDATE {table} SET {column} = CAST(ROUND({column} * 100) AS INTEGER) "
+                f"WHERE {column} IS NOT NULL"
+            )
+        ).rowcount
+        logger.info(f"迁移 {table}.{column} -> 分：{n} 行")
+
+
+def _m002_customer_account(conn):
+    """customers 增加发送账号列（多账号分片发送）"""
+    if any(c["name"] == "account" for c in inspect(conn).get_columns("customers")):
+        return
+    conn.execute(text("ALTER TABLE customers ADD COLUMN account VARCHAR"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_customers_account ON customers (account)"))
+
+
+def _label_legacy_tasks(conn):
+    """
+    给建自然键之前写入的任务（slot 都是 main）分配 slot，使 (subscription_id, delivery_date, slot) 唯一：
+    - 同一订阅、send_time 与 template_key 完全相同的才是重复：id 较大的改为 dup-<id>，由 dedupe.py 报告
+    - 其余同订阅同日的多条是正常的多次配送：每组保留一条 main（优先 pending，其次 id 最小，
+      这样重跑生成脚本仍会更新那条待发任务），其他改为 legacy-<id>，在 dedupe.py 中列为“同日多时段”
+    """
+    n = conn.execute(text(
+        "UPDATE tasks SET slot = 'dup-' || id WHERE id IN ("
+        " SELECT t.id FROM tasks t JOIN tasks f"
+        " ON f.subscription_id = t.subscription_id AND f.send_time = t.send_time"
+        " AND f.template_key = t.template_key AND f.slot = :main AND t.slot = :main AND f.id < t.id)"
+    ), {"main": DEFAULT_SLOT}).rowcount
+    if n:
+        logger.warning(f"发现 {n} 条重复任务，已标记为 slot=dup-<id>，请运行 python dedupe.py 查看")
+    n = conn.execute(text(
+        "UPDATE tasks SET slot = 'legacy-' || id WHERE id IN ("
+        " SELECT t.id FROM tasks t JOIN tasks k"
+        " ON k.subscription_id = t.subscription_id AND k.delivery_date = t.delivery_date"
+        " AND k.slot = :main AND t.slot = :main AND k.id != t.id"
+        " WHERE (k.status IS 'pending') > (t.status IS 'pending')"
+        " OR ((k.status IS 'pending') = (t.status IS 'pending') AND k.id < t.id))"
+    ), {"main": DEFAULT_SLOT}).rowcount
+    if n:
+        logger.info(f"同订阅同日的旧任务 {n} 条改为 slot=legacy-<id>（不是重复，只为满足自然键）")
+
+
+def _m003_task_natural_key(conn):
+    """
+    tasks 增加自然键 (subscription_id, delivery_date, slot) 并建唯一索引。
+    旧任务的 delivery_date 取 send_time 的日期，slot 按 _label_legacy_tasks 分配。
+    """
+    cols = {c["name"] for c in inspect(conn).get_columns("tasks")}
+    if "delivery_date" not in cols:
+        conn.execute(text("ALTER TABLE tasks ADD COLUMN delivery_date VARCHAR"))
+    if "slot" not in cols:
+        conn.execute(text("ALTER TABLE tasks ADD COLUMN slot VARCHAR NOT NULL DEFAULT 'main'"))
+    conn.execute(text("UPDATE tasks SET delivery_date = date(send_time) WHERE delivery_date IS NULL"))
+    _label_legacy_tasks(conn)
+    conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_tasks_natural_key "
+        "ON tasks (subscription_id, delivery_date, slot)"
+    ))
+
+
+def _m004_task_payload_columns(conn):
+    """
+    payload_json 中的 delivered_bottles / remark 提升为列，用 SQLite JSON1 在库内回填，
+    并从 JSON 中移除这两个键（剩余为空则置 NULL）；非法 JSON 的行保持原样。
+    """
+    cols = {c["name"] for c in inspect(conn).get_columns("tasks")}
+    if "delivered_bottles" not in cols:
+        conn.execute(text("ALTER TABLE tasks ADD COLUMN delivered_bottles INTEGER"))
+    if "remark" not in cols:
+        conn.execute(text("ALTER TABLE tasks ADD COLUMN remark TEXT"))
+    n = conn.execute(text(
+        "UPDATE tasks SET"
+        " delivered_bottles = COALESCE(delivered_bottles,"
+        "   CAST(json_extract(payload_json, '$.delivered_bottles') AS INTEGER)),"
+        " remark = COALESCE(remark, json_extract(payload_json, '$.remark')),"
+        " payload_json = NULLIF(json_remove(payload_json, '$.delivered_bottles', '$.remark'), '{}')"
+        " WHERE payload_json IS NOT NULL AND json_valid(payload_json)"
+    )).rowcount
+    logger.info(f"回填任务 delivered_bottles/remark：{n} 行")
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_tasks_status_delivery_date ON tasks (status, delivery_date)"
+    ))
+
+
+_FEED_INSERT = (
+    "INSERT INTO change_feed (ts, kind, entity_id, customer_id, subscription_id, status) "
+    "VALUES (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'), {})"
+)
+
+
+def _m005_change_feed_triggers(conn):
+    """
+    change_feed 触发器：任务新增、状态或列表显示的列变化、删除，以及台账新增时各写一行。
+    放在库里而不是各写入路径里，批量 UPDATE / executemany / upsert 都不会漏。
+    """
+    task_cols = ("status", "send_time", "template_key", "delivered_bottles", "customer_id", "subscription_id")
+    changed = " OR ".join(f"OLD.{c} IS NOT NEW.{c}" for c in task_cols)
+    for sql in (
+        "CREATE TRIGGER IF NOT EXISTS tr_feed_task_insert AFTER INSERT ON tasks BEGIN "
+        + _FEED_INSERT.format("'task', NEW.id, NEW.customer_id, NEW.subscription_id, NEW.status") + "; END",
+        f"CREATE TRIGGER IF NOT EXISTS tr_feed_task_update AFTER UPDATE ON tasks WHEN {changed} BEGIN "
+        + _FEED_INSERT.format("'task', NEW.id, NEW.customer_id, NEW.subscription_id, NEW.status") + "; END",
+        "CREATE TRIGGER IF NOT EXISTS tr_feed_task_delete AFTER DELETE ON tasks BEGIN "
+        + _FEED_INSERT.format("'task', OLD.id, OLD.customer_id, OLD.subscription_id, 'deleted'") + "; END",
+        "CREATE TRIGGER IF NOT EXISTS tr_feed_ledger_insert AFTER INSERT ON ledger_transactions BEGIN "
+        + _FEED_INSERT.format("'ledger', NEW.id, NEW.customer_id, NEW.subscription_id, NULL") + "; END",
+    ):
+        conn.execute(text(sql))
+
+
+def _rebuild_tasks_table(conn):
+    """
+    按当前模型重建 tasks 表（SQLite 不能修改列约束）：建新表、复制、删旧表、改名，
+    再建回索引与 change_feed 触发器。其他表对 tasks.id 的外键按表名引用，不受影响
+    """
+    from sqlalchemy.schema import CreateTable
+
+    from models import Task
+
+    T = Task.__table__
+    old = {c["name"] for c in inspect(conn).get_columns("tasks")}
+    cols = ", ".join(c.name for c in T.columns if c.name in old)
+    ddl = str(CreateTable(T).compile(dialect=conn.dialect)).replace("CREATE TABLE tasks", "CREATE TABLE tasks_new", 1)
+    conn.exec_driver_sql(ddl)
+    conn.exec_driver_sql(f"INSERT INTO tasks_new ({cols}) SELECT {cols} FROM tasks")
+    conn.exec_driver_sql("DROP TABLE tasks")
+    conn.exec_driver_sql("ALTER TABLE tasks_new RENAME TO tasks")
+    for idx in T.indexes:
+        idx.create(conn)
+    _m005_change_feed_triggers(conn)
+
+
+def _m006_task_natural_key_repair(conn):
+    """
+    修正 003 的旧版本：它把同订阅同日的所有旧任务都当成重复（slot=dup-<id>），其实大多是正常的多次配送。
+    迁移分配的 dup-<id> / legacy-<id> 先恢复为 main，再按 _label_legacy_tasks 重新分配（重复执行结果相同）；
+    delivery_date 回填后改为 NOT NULL。
+    """
+    conn.execute(text("DROP INDEX IF EXISTS ux_tasks_natural_key"))
+    conn.execute(
+        text("UPDATE tasks SET slot = :main WHERE slot LIKE 'dup-%' OR slot LIKE 'legacy-%'"), {"main": DEFAULT_SLOT}
+    )
+    _label_legacy_tasks(conn)
+    conn.execute(text("UPDATE tasks SET delivery_date = date(send_time) WHERE delivery_date IS NULL"))
+    col = next(c for c in inspect(conn).get_columns("tasks") if c["name"] == "delivery_date")
+    if col["nullable"]:
+        _rebuild_tasks_table(conn)
+    else:
+        conn.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_tasks_natural_key "
+            "ON tasks (subscription_id, delivery_date, slot)"
+        ))
+
+
+MIGRATIONS = [
+    (1, "money_to_cents", _m001_money_to_cents),
+    (2, "customer_account", _m002_customer_account),
+    (3, "task_natural_key", _m003_task_natural_key),
+    (4, "task_payload_columns", _m004_task_payload_columns),
+    (5, "change_feed_triggers", _m005_change_feed_triggers),
+    (6, "task_natural_key_repair", _m006_task_natural_key_repair),
+]
+
+
+def applied_versions(conn) -> set:
+    return set(conn.execute(select(SchemaMigration.version)).scalars())
+
+
+def upgrade(engine) -> list:
+    """执行所有未执行的迁移，返回本次执行的版本号列表（表需已由 create_all 建好）"""
+    done = []
+    with engine.begin() as conn:
+        have = applied_versions(conn)
+    for version, name, fn in MIGRATIONS:
+        if version in have:
+            continue
+        with engine.begin() as conn:
+            # 并发启动时另一个进程可能已经执行过
+            if version in applied_versions(conn):
+                continue
+            fn(conn)
+            conn.execute(
+                SchemaMigration.__table__.insert().values(
+                    version=version, name=name, applied_at=clock.now()
+                )
+            )
+        logger.info(f"已执行迁移 {version:03d}_{name}")
+        done.append(version)
+    return done
+
+
+if __name__ == "__main__":
+    from db_utils import _engine, init_db
+
+    if "--status" in sys.argv:
+        from models import Base
+
+        Base.metadata.create_all(_engine)
+        with _engine.connect() as conn:
+            have = applied_versions(conn)
+        for version, name, _ in MIGRATIONS:
+            print(f"{'✔' if version in have else '·'} {version:03d}_{name}")
+    else:
+        init_db()
+        print("✅ 数据库已是最新版本")
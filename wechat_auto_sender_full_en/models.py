@@ -1,10 +1,20 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Numeric
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Float, Index
 from sqlalchemy.orm import declarative_base, relationship
 
+from money import MoneyType, ZERO
+
 Base = declarative_base()
 
+DEFAULT_SLOT = "main"
+REMINDER_SLOT = "reminder"  # 续费提醒任务（forecast.py 生成；只发消息，不扣费）
+
+def _delivery_date_default(ctx):
+    """未显式给出配送日期时取 send_time 的日期（send_time 也用默认值时为当天），保证自然键完整"""
+    send_time = ctx.get_current_parameters().get("send_time") or datetime.now()
+    return send_time.strftime("%Y-%m-%d")
+
 class Customer(Base):
     __tablename__ = "customers"
     id = Column(Integer, primary_key=True)
@@ -13,6 +23,7 @@ class Customer(Base):
     phone = Column(String, nullable=True)
     address = Column(String, nullable=True)
     preferred_send_time = Column(String, nullable=True)
+    account = Column(String, nullable=True, index=True)  # 发送账号（config.SENDER_ACCOUNTS），空=默认账号
     active = Column(Integer, default=1)
     created_at = Column(DateTime, default=datetime.now)
 
@@ -24,7 +35,7 @@ class Subscription(Base):
     id = Column(Integer, primary_key=True)
     customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
     type = Column(String, nullable=False)  # 'by_bottle' or 'by_amount'
-    unit_price = Column(Numeric(10, 2), nullable=True)
+    unit_price = Column(MoneyType, nullable=True)  # 整数分
     status = Column(String, default="active")
     start_date = Column(DateTime, nullable=True)
     end_date = Column(DateTime, nullable=True)
@@ -42,7 +53,7 @@ class LedgerTransaction(Base):
     ts = Column(DateTime, default=datetime.now, nullable=False)
     kind = Column(String, nullable=False)  # purchase/delivery/refund/manual_adjust
     bottle_delta = Column(Integer, default=0)
-    amount_delta = Column(Numeric(10, 2), default=0)
+    amount_delta = Column(MoneyType, default=ZERO)  # 整数分
     ref_task_id = Column(Integer, ForeignKey("tasks.id"), nullable=True)
     memo = Column(Text, nullable=True)
 
@@ -54,8 +65,13 @@ class Task(Base):
     customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
     subscription_id = Column(Integer, ForeignKey("subscriptions.id"), nullable=True)
     send_time = Column(DateTime, nullable=False, default=datetime.now)
+    # 自然键 (subscription_id, delivery_date, slot)：同一订阅同一天同一时段只能有一条任务
+    delivery_date = Column(String, nullable=False, default=_delivery_date_default)  # YYYY-MM-DD
+    slot = Column(String, nullable=False, default=DEFAULT_SLOT)
     template_key = Column(String, nullable=False)
-    payload_json = Column(Text, nullable=True)
+    delivered_bottles = Column(Integer, nullable=True)  # 本次实送瓶数
+    remark = Column(Text, nullable=True)
+    payload_json = Column(Text, nullable=True)  # 仅存放上面两列以外的扩展字段
     status = Column(String, default="pending")
     result_log = Column(Text, nullable=True)
     try_count = Column(Integer, default=0)
@@ -64,3 +80,153 @@ class Task(Base):
 
     customer = relationship("Customer", back_populates="tasks")
     subscription = relationship("Subscription", back_populates="tasks")
+
+    __table_args__ = (
+        Index("ux_tasks_natural_key", "subscription_id", "delivery_date", "slot", unique=True),
+        Index("ix_tasks_status_delivery_date", "status", "delivery_date"),
+    )
+
+class MetricSample(Base):
+    __tablename__ = "metrics"
+    id = Column(Integer, primary_key=True)
+    ts = Column(DateTime, default=datetime.now, nullable=False, index=True)
+    name = Column(String, nullable=False, index=True)
+    labels = Column(String, nullable=True)
+    value = Column(Float, nullable=True)
+
+class AuditImage(Base):
+    __tablename__ = "audit_images"
+    id = Column(Integer, primary_key=True)
+    task_id = Column(Integer, ForeignKey("tasks.id"), nullable=True, index=True)
+    contact = Column(String, nullable=True)
+    ts = Column(DateTime, default=datetime.now, nullable=False)
+    day = Column(String, nullable=False, index=True)  # YYYY-MM-DD，对应 AUDIT_DIR 下的分区目录
+    path = Column(String, nullable=False)
+    phash = Column(String, nullable=True)
+    size_bytes = Column(Integer, nullable=True)
+
+class ImportJob(Base):
+    """批量导入进度（断点续传）：last_row 与数据在同一事务中更新"""
+    __tablename__ = "import_jobs"
+    id = Column(Integer, primary_key=True)
+    source = Column(String, nullable=False, index=True)
+    source_size = Column(Integer, nullable=True)
+    last_row = Column(Integer, default=1)
+    imported = Column(Integer, default=0)
+    rejected = Column(Integer, default=0)
+    reject_offset = Column(Integer, default=0)  # 拒绝文件已提交部分的字节数
+    status = Column(String, default="running")  # running / done
+    started_at = Column(DateTime, default=datetime.now)
+    updated_at = Column(DateTime, default=datetime.now)
+
+class DailyRollup(Base):
+    """按 日期 × 订阅 × 流水类型 的日汇总（由 rollups.py 根据台账高水位增量维护）"""
+    __tablename__ = "daily_rollups"
+    id = Column(Integer, primary_key=True)
+    day = Column(String, nullable=False)  # YYYY-MM-DD
+    subscription_id = Column(Integer, nullable=False, default=0)  # 0 = 未关联订阅
+    sub_type = Column(String, nullable=True)  # by_bottle / by_amount（冗余，便于按类型汇总）
+    kind = Column(String, nullable=False)
+    tx_count = Column(Integer, default=0)
+    bottle_sum = Column(Integer, default=0)
+    amount_sum = Column(MoneyType, default=ZERO)  # 整数分
+
+    __table_args__ = (
+        Index("ux_daily_rollups_key", "day", "subscription_id", "kind", unique=True),
+    )
+
+class RollupState(Base):
+    """汇总表的高水位：已计入汇总的最大台账流水 id"""
+    __tablename__ = "rollup_state"
+    name = Column(String, primary_key=True)
+    last_ledger_id = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.now)
+
+class TaskAttempt(Base):
+    """任务的每一次处理尝试；与任务状态变更在同一事务中写入（见 db_utils.record_attempt）"""
+    __tablename__ = "task_attempts"
+    id = Column(Integer, primary_key=True)
+    task_id = Column(Integer, ForeignKey("tasks.id"), nullable=False)
+    attempt_no = Column(Integer, nullable=False)  # 第几次尝试（= 本次之前的 try_count + 1）
+    started_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime, nullable=False)
+    duration_ms = Column(Float, nullable=True)
+    stages_json = Column(Text, nullable=True)  # 分阶段耗时（毫秒），如 {"balance": 1.2, "send": 5210.4}
+    outcome = Column(String, nullable=False)  # sent / failed / held
+    error_class = Column(String, nullable=True)
+    error_message = Column(Text, nullable=True)
+    worker_id = Column(String, nullable=True)  # 主机:进程:线程
+    backend = Column(String, nullable=True)  # pyautogui / pyautogui-dryrun / headless
+    account = Column(String, nullable=True)  # 发送账号
+
+    __table_args__ = (
+        Index("ix_task_attempts_task", "task_id", "attempt_no"),
+        Index("ix_task_attempts_started_at", "started_at"),
+    )
+
+class Campaign(Base):
+    """群发活动：模板 + 客户筛选条件 + 公共变量；收件人按变量组合（variant）去重渲染，见 campaigns.py"""
+    __tablename__ = "campaigns"
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    template_key = Column(String, nullable=False)
+    segment_json = Column(Text, nullable=True)  # 筛选条件，如 {"sub_type": "by_bottle", "account": "shop2"}
+    variables_json = Column(Text, nullable=True)  # 所有收件人共用的模板变量
+    status = Column(String, default="draft")  # draft / running / paused / done / canceled
+    created_at = Column(DateTime, default=datetime.now)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.now)
+
+class CampaignRecipient(Base):
+    __tablename__ = "campaign_recipients"
+    id = Column(Integer, primary_key=True)
+    campaign_id = Column(Integer, ForeignKey("campaigns.id"), nullable=False)
+    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
+    overrides_json = Column(Text, nullable=True)  # 该客户单独覆盖的模板变量
+    variant_key = Column(String, nullable=True)  # 渲染结果所在的 campaign_variants 行
+    status = Column(String, default="pending")  # pending / sent / failed / skipped / unconfirmed
+    try_count = Column(Integer, default=0)
+    result_log = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (
+        Index("ux_campaign_recipients", "campaign_id", "customer_id", unique=True),
+        Index("ix_campaign_recipients_status", "campaign_id", "status"),
+    )
+
+class CampaignVariant(Base):
+    """一个活动中一种变量组合的渲染结果（只渲染一次）"""
+    __tablename__ = "campaign_variants"
+    id = Column(Integer, primary_key=True)
+    campaign_id = Column(Integer, ForeignKey("campaigns.id"), nullable=False)
+    variant_key = Column(String, nullable=False)
+    text = Column(Text, nullable=False)
+    recipients = Column(Integer, default=0)
+
+    __table_args__ = (
+        Index("ux_campaign_variants", "campaign_id", "variant_key", unique=True),
+    )
+
+class ChangeFeed(Base):
+    """
+    变更流水：任务新增/状态或显示列变化/删除、台账新增各一行，由 SQLite 触发器写入（见 migrations 005），
+    所有写入路径（hook、journal 分组提交、预检、GUI、导入）都覆盖。id 单调递增，GUI 按 id 增量轮询，见 changefeed.py
+    """
+    __tablename__ = "change_feed"
+    id = Column(Integer, primary_key=True)
+    ts = Column(DateTime, nullable=False)
+    kind = Column(String, nullable=False)  # task / ledger
+    entity_id = Column(Integer, nullable=False)  # tasks.id / ledger_transactions.id
+    customer_id = Column(Integer, nullable=True)
+    subscription_id = Column(Integer, nullable=True)
+    status = Column(String, nullable=True)  # kind=task：变更后的状态，删除时为 deleted
+
+    __table_args__ = {"sqlite_autoincrement": True}  # 删除旧行后 id 也不复用
+
+class SchemaMigration(Base):
+    """已执行的数据迁移（见 migrations.py）"""
+    __tablename__ = "schema_migrations"
+    version = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    applied_at = Column(DateTime, default=datetime.now)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+money.py
+金额统一以“分”（整数）存储与计算：
+- Money：不可变的金额值，内部只有整数分；与 Decimal/字符串/数字互转只发生在边界（输入、显示）
+- MoneyType：SQLAlchemy 列类型，库里存 INTEGER 分，读出即 Money；
+  SUM()/COALESCE() 等聚合沿用列类型，结果同样是 Money，求和在 SQL 里按整数精确完成
+- 与 int/Decimal 比较按“元”精确比较（Money.of(5) == 5，Money('5.56') != Decimal('5.555')），
+  哈希也按元计算，与相等的 int/Decimal 哈希一致
+"""
+
+from decimal import Decimal, ROUND_HALF_UP
+
+from sqlalchemy import Integer
+from sqlalchemy.types import TypeDecorator
+
+_CENT = Decimal("0.01")
+
+
+class Money:
+    __slots__ = ("cents",)
+
+    def __init__(self, cents: int = 0):
+        object.__setattr__(self, "cents", int(cents))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Money is immutable")
+
+    @classmethod
+    def of(cls, value) -> "Money":
+        """
+        以“元”为单位构造：Money / Decimal / str / int / float / None（None 与空串视为 0）。
+        NaN / Infinity 抛 ValueError；无法解析的字符串抛 decimal.InvalidOperation
+        """
+        if isinstance(value, Money):
+            return value
+        if value is None or value == "":
+            return cls(0)
+        d = value if isinstance(value, Decimal) else Decimal(str(value))
+        if not d.is_finite():
+            raise ValueError(f"金额必须是有限数字：{value}")
+        return cls(int((d * 100).to_integral_value(rounding=ROUND_HALF_UP)))
+
+    @property
+    def yuan(self) -> Decimal:
+        return (Decimal(self.cents) / 100).quantize(_CENT)
+
+    # ---- 显示 ----
+    def __str__(self):
+        sign = "-" if self.cents < 0 else ""
+        whole, frac = divmod(abs(self.cents), 100)
+        return f"{sign}{whole}.{frac:02d}"
+
+    def __repr__(self):
+        return f"Money('{self}')"
+
+    def __format__(self, spec):
+        return format(self.yuan, spec) if spec else str(self)
+
+    def __float__(self):
+        return self.cents / 100
+
+    # ---- 运算（只在 Money 之间加减；乘以整数数量）----
+    def __add__(self, other):
+        if isinstance(other, Money):
+            return Money(self.cents + other.cents)
+        if other == 0:  # 支持 sum()
+            return self
+        return NotImplemented
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if isinstance(other, Money):
+            return Money(self.cents - other.cents)
+        return NotImplemented
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+    def __abs__(self):
+        return Money(abs(self.cents))
+
+    def __mul__(self, n):
+        if isinstance(n, int) and not isinstance(n, bool):
+            return Money(self.cents * n)
+        return NotImplemented
+
+    __rmul__ = __mul__
+
+    # ---- 比较 ----
+    def _cmp_cents(self, other):
+        """other 折算成分：int/Decimal 不取整（int 与 Decimal 之间的比较是精确的）"""
+        if isinstance(other, Money):
+            return other.cents
+        if isinstance(other, (int, Decimal)) and not isinstance(other, bool):
+            return other * 100
+        return None
+
+    def __eq__(self, other):
+        c = self._cmp_cents(other)
+        return NotImplemented if c is None else self.cents == c
+
+    def __lt__(self, other):
+        c = self._cmp_cents(other)
+        return NotImplemented if c is None else self.cents < c
+
+    def __le__(self, other):
+        c = self._cmp_cents(other)
+        return NotImplemented if c is None else self.cents <= c
+
+    def __gt__(self, other):
+        c = self._cmp_cents(other)
+        return NotImplemented if c is None else self.cents > c
+
+    def __ge__(self, other):
+        c = self._cmp_cents(other)
+        return NotImplemented if c is None else self.cents >= c
+
+    def __hash__(self):
+        # 与相等的 int/Decimal 一致：hash(Money.of(5)) == hash(5) == hash(Decimal("5.00"))
+        return hash(self.yuan)
+
+    def __bool__(self):
+        return self.cents != 0
+
+
+ZERO = Money(0)
+
+
+class MoneyType(TypeDecorator):
+    """
+    INTEGER 分 <-> Money。写入时接受 Money 或以“元”表示的 Decimal/str/float。
+    裸 int 单位不明（元还是分），除 0 以外一律拒绝（TypeError）：整数金额请用 Money(分) 或 Money.of(元)
+    """
+
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, int) and not isinstance(value, Money) and value != 0:
+            raise TypeError(f"MoneyType 不接受裸 int（{value}）：请用 Money(分) 或 Money.of(元)")
+        return Money.of(value).cents
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return Money(int(round(value)))
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+preflight.py
+发送前的余额预检，每个 tick 一次、批量进行，不碰界面：
+- 一次 GROUP BY 取本批任务涉及订阅的当前余额，按 send_time 顺序逐条预扣，
+  同一订阅的多条任务累计计算
+- 会透支的任务按 OVERDRAW_POLICY 处理，不占用发送节奏：
+  hold=置为 held；fail=置为 failed；notice=照常发送（hook 在消息末尾附加余额不足提醒）
+- release_held：余额补足后把 held 任务放回 pending：先按 send_time 预扣已排队的 pending 任务，
+  held 任务只能用剩下的余额放回
+"""
+
+from sqlalchemy import func, select, update
+
+import clock
+
+from hook import OVERDRAW_POLICY, task_fields
+from log_utils import get_logger
+from models import LedgerTransaction, Subscription, Task
+from rows import TASK_COLUMNS, TaskRow
+from money import Money, ZERO
+import journal
+import metrics
+
+logger = get_logger(__name__)
+
+
+def balances(s, sub_ids) -> dict:
+    """{subscription_id: {"type", "unit_price", "bottles", "amount"}}，两条查询取完"""
+    sub_ids = {x for x in sub_ids if x is not None}
+    if not sub_ids:
+        return {}
+    out = {
+        sid: {"type": typ, "unit_price": price or ZERO, "bottles": 0, "amount": ZERO}
+        for sid, typ, price in s.execute(
+            select(Subscription.id, Subscription.type, Subscription.unit_price).where(Subscription.id.in_(sub_ids))
+        )
+    }
+    LT = LedgerTransaction
+    pending = journal.pending_deltas()  # 已发送、尚未分组提交的扣减
+    for sid, bottles, amount in s.execute(
+        select(
+            LT.subscription_id,
+            func.coalesce(func.sum(LT.bottle_delta), 0),
+            func.coalesce(func.sum(LT.amount_delta), 0),
+        )
+        .where(LT.subscription_id.in_(sub_ids))
+        .group_by(LT.subscription_id)
+    ):
+        if sid in out:
+            out[sid]["bottles"] = int(bottles or 0)
+            out[sid]["amount"] = amount or ZERO
+    for sid, (b, c) in pending.items():
+        if sid in out:
+            out[sid]["bottles"] += b
+            out[sid]["amount"] += Money(c)
+    return out
+
+
+def project(s, tasks, bal: dict = None) -> list:
+    """
+    按 send_time 顺序预扣：[(task, 是否可扣费)]。
+    无法判断的任务（无订阅、瓶数非法、payload 损坏）视为可扣费，交给 hook 按原流程报错。
+    bal 传入时在其上继续预扣（会被修改），否则现查。
+    """
+    tasks = sorted(tasks, key=lambda t: (t.send_time, t.id))
+    if bal is None:
+        bal = balances(s, (t.subscription_id for t in tasks))
+    out = []
+    for t in tasks:
+        b = bal.get(t.subscription_id)
+        try:
+            n = task_fields(t)[0]
+        except ValueError:
+            n = 0
+        if b is None or n <= 0:
+            out.append((t, True))
+            continue
+        if b["type"] == "by_bottle":
+            ok = b["bottles"] - n >= 0
+            if ok:
+                b["bottles"] -= n
+        elif b["type"] == "by_amount":
+            charge = b["unit_price"] * n
+            ok = b["amount"] - charge >= ZERO
+            if ok:
+                b["amount"] -= charge
+        else:
+            ok = True
+        out.append((t, ok))
+    return out
+
+
+def run(s, tasks, policy: str = None) -> set:
+    """
+    对本 tick 取到的到期任务（rows.TaskRow 或 Task）做预检，返回不再发送的任务 id。
+    状态用一条 UPDATE 写入 s，随会话提交。
+    """
+    policy = policy or OVERDRAW_POLICY
+    blocked = set()
+    for t, ok in project(s, tasks):
+        if ok:
+            continue
+        metrics.inc("preflight_overdraw_total", policy=policy)
+        if policy == "notice":
+            continue
+        blocked.add(t.id)
+    if blocked:
+        s.execute(
+            update(Task)
+            .where(Task.id.in_(blocked), Task.status == "pending")
+            .values(
+                status="held" if policy == "hold" else "failed",
+                result_log="insufficient balance (preflight)",
+                updated_at=clock.now(),
+            )
+        )
+        logger.info(f"Preflight: {len(blocked)} task(s) would overdraw -> {policy}")
+    return blocked
+
+
+def _task_rows(s, *where) -> list:
+    return [TaskRow._make(r) for r in s.execute(select(*TASK_COLUMNS).where(*where))]
+
+
+def release_held(s) -> int:
+    """
+    余额已足够的 held 任务放回 pending，返回放回条数。
+    同订阅下已在排队的 pending 任务先按 send_time 预扣（与 run 同一套累计规则），
+    held 任务只用剩下的余额；否则放回的任务会和排队任务抢同一笔余额，下个 tick 又被拦回 held。
+    """
+    held = _task_rows(s, Task.status == "held")
+    if not held:
+        return 0
+    sub_ids = {t.subscription_id for t in held if t.subscription_id is not None}
+    bal = balances(s, sub_ids)
+    if sub_ids:
+        # 已发送、结果还在 journal 缓冲里的任务，扣减已计入 balances 的 pending_deltas
+        inflight = journal.pending_task_ids()
+        queued = [
+            t for t in _task_rows(s, Task.status == "pending", Task.subscription_id.in_(sub_ids))
+            if t.id not in inflight
+        ]
+        project(s, queued, bal)
+    ids = [t.id for t, ok in project(s, held, bal) if ok]
+    if not ids:
+        return 0
+    n = s.execute(
+        update(Task)
+        .where(Task.id.in_(ids), Task.status == "held")
+        .values(status="pending", result_log="released (balance ok)", updated_at=clock.now())
+    ).rowcount
+    if n:
+        logger.info(f"Preflight: released {n} held task(s)")
+    return n
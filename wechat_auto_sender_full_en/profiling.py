@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+profiling.py
+可选的性能剖析钩子（默认关闭）：
+- 环境变量 WECHAT_PROFILE=1 或 config.PROFILE_ENABLED=True 时启用
+- 每次调用用 cProfile 记录，同时后台线程采样调用栈
+- 仅保留耗时超过 PROFILE_THRESHOLD_MS 的调用：输出 .pstats 和 .collapsed
+  （collapsed 为 flamegraph.pl / speedscope 可直接读取的折叠栈格式）
+- 目录内文件数超过 PROFILE_KEEP 时删除最旧的
+关闭时装饰器直接返回原函数，没有额外开销。
+"""
+
+import cProfile
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+try:
+    from config import (
+        PROFILE_ENABLED,
+        PROFILE_DIR,
+        PROFILE_THRESHOLD_MS,
+        PROFILE_KEEP,
+        PROFILE_SAMPLE_INTERVAL,
+    )
+except Exception:
+    PROFILE_ENABLED = False
+    PROFILE_DIR = "profiles"
+    PROFILE_THRESHOLD_MS = 500
+    PROFILE_KEEP = 200
+    PROFILE_SAMPLE_INTERVAL = 0.005
+
+ENABLED = PROFILE_ENABLED or os.environ.get("WECHAT_PROFILE", "") not in ("", "0")
+
+# 嵌套调用（worker -> process_one_task）时只由最外层负责剖析
+_local = threading.local()
+
+
+class _StackSampler(threading.Thread):
+    """定时抓取目标线程的调用栈，累计成折叠栈计数"""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+
+
+def _rotate(directory: str, keep: int):
+    files = sorted(
+        (os.path.join(directory, f) for f in os.listdir(directory)),
+        key=os.path.getmtime,
+    )
+    for f in files[:-keep] if keep > 0 else []:
+        try:
+            os.remove(f)
+        except OSError:
+            pass
+
+
+def _dump(name: str, prof: cProfile.Profile, stacks: Counter, elapsed_ms: float):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    base = os.path.join(PROFILE_DIR, f"{ts}_{name}_{int(elapsed_ms)}ms")
+    prof.dump_stats(f"{base}.pstats")
+    with open(f"{base}.collapsed", "w", encoding="utf-8") as f:
+        for stack, n in stacks.most_common():
+            f.write(f"{stack} {n}\n")
+    # 每次调用产生 2 个文件
+    _rotate(PROFILE_DIR, PROFILE_KEEP * 2)
+
+
+def profiled(name: str = None):
+    """装饰器：启用时剖析被装饰函数；未启用时原样返回"""
+
+    def deco(fn):
+        if not ENABLED:
+            return fn
+        label = name or f"{fn.__module__}.{fn.__qualname__}"
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if getattr(_local, "active", False):
+                return fn(*args, **kwargs)
+            prof = cProfile.Profile()
+            sampler = _StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL)
+            t0 = time.perf_counter()
+            _local.active = True
+            # enable() 可能失败（如已有其他剖析器在运行）：放在 try 内，保证 active 标记一定复位
+            try:
+                sampler.start()
+                prof.enable()
+                return fn(*args, **kwargs)
+            finally:
+                _local.active = False
+                prof.disable()
+                elapsed_ms = (time.perf_counter() - t0) * 1000
+                if sampler.ident is not None:
+                    sampler.stop()
+                if elapsed_ms >= PROFILE_THRESHOLD_MS:
+                    try:
+                        _dump(label, prof, sampler.stacks, elapsed_ms)
+                    except Exception:
+                        pass
+
+        return wrapper
+
+    return deco
+
+
+def profile_handlers(cls, prefix: str = "on_"):
+    """给类中所有以 prefix 开头的方法（GUI 事件处理函数）套上 profiled"""
+    if not ENABLED:
+        return cls
+    for attr, fn in list(vars(cls).items()):
+        if attr.startswith(prefix) and callable(fn):
+            setattr(cls, attr, profiled(f"{cls.__name__}.{attr}")(fn))
+    return cls
@@ -6,42 +6,53 @@ from sqlalchemy.orm import sessionmaker
 
 from config import DB_URL
 from models import Base, Customer, Subscription, Task
-from db_utils import add_transaction
+from db_utils import add_transaction, init_db, upsert_tasks
 
 engine = create_engine(DB_URL, future=True)
-Base.metadata.create_all(engine)
+init_db(engine)
 Session = sessionmaker(bind=engine, future=True)
 
 s = Session()
 
-# 创建客户
-zhangsan = Customer(wx_display_name="张三", name="张三")
-lisi = Customer(wx_display_name="李四", name="李四")
-s.add_all([zhangsan, lisi]); s.commit()
-
-# 创建套餐：张三按瓶、李四按金额
-sub1 = Subscription(customer_id=zhangsan.id, type='by_bottle', unit_price=None, status='active')
-sub2 = Subscription(customer_id=lisi.id, type='by_amount', unit_price=Decimal('5.50'), status='active')
-s.add_all([sub1, sub2]); s.commit()
+# 创建客户（已存在则复用，脚本可重复运行）
+zhangsan = s.query(Customer).filter(Customer.wx_display_name == "张三").first()
+lisi = s.query(Customer).filter(Customer.wx_display_name == "李四").first()
+if not zhangsan:
+    zhangsan = Customer(wx_display_name="张三", name="张三")
+    s.add(zhangsan)
+if not lisi:
+    lisi = Customer(wx_display_name="李四", name="李四")
+    s.add(lisi)
+s.commit()
 
-# 充值/进账
-add_transaction(s, subscription_id=sub1.id, customer_id=zhangsan.id,
-                kind='purchase', bottle_delta=30, amount_delta=0, memo='首购30瓶')
-add_transaction(s, subscription_id=sub2.id, customer_id=lisi.id,
-                kind='purchase', bottle_delta=0, amount_delta=Decimal('100.00'), memo='充值¥100')
+# 创建套餐：张三按瓶、李四按金额；新建套餐时充值/进账
+sub1 = s.query(Subscription).filter(Subscription.customer_id == zhangsan.id, Subscription.type == 'by_bottle').first()
+if not sub1:
+    sub1 = Subscription(customer_id=zhangsan.id, type='by_bottle', unit_price=None, status='active')
+    s.add(sub1); s.flush()
+    add_transaction(s, subscription_id=sub1.id, customer_id=zhangsan.id,
+                    kind='purchase', bottle_delta=30, amount_delta=0, memo='首购30瓶')
+sub2 = s.query(Subscription).filter(Subscription.customer_id == lisi.id, Subscription.type == 'by_amount').first()
+if not sub2:
+    sub2 = Subscription(customer_id=lisi.id, type='by_amount', unit_price=Decimal('5.50'), status='active')
+    s.add(sub2); s.flush()
+    add_transaction(s, subscription_id=sub2.id, customer_id=lisi.id,
+                    kind='purchase', bottle_delta=0, amount_delta=Decimal('100.00'), memo='充值¥100')
 s.commit()
 
-# 生成两条即将到时的发送任务
+# 生成两条即将到时的发送任务（按 订阅+日期+时段 幂等，重跑只会更新仍待发的任务）
 now = datetime.now()
-t1 = Task(customer_id=zhangsan.id, subscription_id=sub1.id,
-          send_time=now + timedelta(seconds=15),
-          template_key='confirm_by_bottle',
-          payload_json='{"delivered_bottles": 2, "remark": "早上到家～"}')
-t2 = Task(customer_id=lisi.id, subscription_id=sub2.id,
-          send_time=now + timedelta(seconds=25),
-          template_key='confirm_by_amount',
-          payload_json='{"delivered_bottles": 3}')
-s.add_all([t1, t2]); s.commit()
+upsert_tasks(s, [
+    dict(customer_id=zhangsan.id, subscription_id=sub1.id,
+         send_time=now + timedelta(seconds=15),
+         template_key='confirm_by_bottle',
+         delivered_bottles=2, remark="早上到家～"),
+    dict(customer_id=lisi.id, subscription_id=sub2.id,
+         send_time=now + timedelta(seconds=25),
+         template_key='confirm_by_amount',
+         delivered_bottles=3),
+])
+s.commit()
 
 print("Seeded demo data. Now run: python main.py (or Start_Scheduler.bat)")
 s.close()
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+rollups.py
+台账日汇总与对账：
+- daily_rollups：按 日期 × 订阅 × 流水类型 汇总笔数/瓶数/金额，冗余订阅类型便于按类型统计
+- 增量维护：rollup_state 记录已汇总的最大流水 id（高水位），每次只聚合新流水并累加进汇总表
+- rebuild_day：按需重算某一天（只算到当前高水位，与后续增量不重复）
+- reconcile：每条 sent 配送任务必须恰好对应一条 delivery 流水（ref_task_id；续费提醒任务不扣费，不参与）
+- summary：看板/月结报表直接读汇总表，按日或按月、按订阅类型与流水类型合计
+- planned：待发任务的计划配送量（delivered_bottles 列上的 SQL 聚合，按配送日 × 订阅类型）
+
+用法：
+    python rollups.py refresh
+    python rollups.py rebuild 2026-10-19
+    python rollups.py check [--since 2026-10-01] [--until 2026-10-31]
+    python rollups.py report --since 2026-10-01 --until 2026-10-31 [--by month]
+    python rollups.py plan [--since 2026-10-20] [--until 2026-10-26]
+"""
+
+import argparse
+import sys
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, literal, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+import clock
+from log_utils import get_logger
+from models import DailyRollup, LedgerTransaction, RollupState, Subscription, Task, REMINDER_SLOT
+from money import ZERO
+
+logger = get_logger(__name__)
+
+_STATE = "ledger"
+_KEY = ["day", "subscription_id", "kind"]
+
+
+def _aggregate(where, day_expr=None):
+    """台账 -> 汇总行的 GROUP BY 查询（纯 SQL 聚合，不把流水拉进 Python）"""
+    LT = LedgerTransaction
+    day = day_expr if day_expr is not None else func.date(LT.ts)
+    sub_id = func.coalesce(LT.subscription_id, 0)
+    return (
+        select(
+            day.label("day"),
+            sub_id.label("subscription_id"),
+            func.max(Subscription.type).label("sub_type"),
+            LT.kind.label("kind"),
+            func.count().label("tx_count"),
+            func.coalesce(func.sum(LT.bottle_delta), 0).label("bottle_sum"),
+            func.coalesce(func.sum(LT.amount_delta), 0).label("amount_sum"),
+        )
+        .outerjoin(Subscription, Subscription.id == LT.subscription_id)
+        .where(*where)
+        .group_by(day, sub_id, LT.kind)
+    )
+
+
+def _state(s) -> RollupState:
+    st = s.get(RollupState, _STATE)
+    if st is None:
+        st = RollupState(name=_STATE, last_ledger_id=0, updated_at=clock.now())
+        s.add(st)
+        s.flush()
+    return st
+
+
+def refresh(s) -> int:
+    """
+    把高水位之后的新流水累加进汇总表，返回本次计入的流水条数。
+    先用条件 UPDATE 推进高水位（拿到写锁并防止两个进程重复计入），再在同一事务里合并汇总。
+    """
+    LT = LedgerTransaction
+    hwm = _state(s).last_ledger_id or 0
+    top = s.execute(select(func.max(LT.id))).scalar() or 0
+    if top <= hwm:
+        return 0
+    moved = s.execute(
+        update(RollupState)
+        .where(RollupState.name == _STATE, RollupState.last_ledger_id == hwm)
+        .values(last_ledger_id=top, updated_at=clock.now())
+    ).rowcount
+    if moved != 1:
+        logger.info("rollups: 高水位已被其他进程推进，本次跳过")
+        return 0
+
+    rows = [r._asdict() for r in s.execute(_aggregate([LT.id > hwm, LT.id <= top]))]
+    if rows:
+        t = DailyRollup.__table__
+        stmt = sqlite_insert(t)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=_KEY,
+            set_={
+                "sub_type": func.coalesce(stmt.excluded.sub_type, t.c.sub_type),
+                "tx_count": t.c.tx_count + stmt.excluded.tx_count,
+                "bottle_sum": t.c.bottle_sum + stmt.excluded.bottle_sum,
+                "amount_sum": t.c.amount_sum + stmt.excluded.amount_sum,
+            },
+        )
+        s.execute(stmt, rows)
+    n = top - hwm
+    logger.info(f"rollups: 计入流水 #{hwm + 1}..#{top}，更新 {len(rows)} 个汇总键")
+    return n
+
+
+def rebuild_day(s, day: str) -> int:
+    """从台账重算某一天（YYYY-MM-DD）的汇总，返回汇总行数；只计入高水位以内的流水"""
+    LT = LedgerTransaction
+    start = datetime.strptime(day, "%Y-%m-%d")
+    hwm = _state(s).last_ledger_id or 0
+    s.execute(delete(DailyRollup).where(DailyRollup.day == day))
+    rows = [
+        r._asdict()
+        for r in s.execute(
+            _aggregate(
+                [LT.ts >= start, LT.ts < start + timedelta(days=1), LT.id <= hwm],
+                day_expr=literal(day),
+            )
+        )
+    ]
+    if rows:
+        s.execute(DailyRollup.__table__.insert(), rows)
+    logger.info(f"rollups: 重建 {day}，{len(rows)} 个汇总键")
+    return len(rows)
+
+
+def reconcile(s, since: datetime = None, until: datetime = None) -> dict:
+    """
+    对账：sent 任务 ↔ delivery 流水 一一对应。
+    返回 missing（已发送但无扣费流水）、duplicated（[(task_id, 流水条数)]）、
+    orphan（[(流水 id, task_id, 任务状态)]：关联的任务不是 sent）
+    """
+    LT = LedgerTransaction
+    per_task = (
+        select(LT.ref_task_id.label("task_id"), func.count().label("n"))
+        .where(LT.kind == "delivery", LT.ref_task_id.isnot(None))
+        .group_by(LT.ref_task_id)
+        .subquery()
+    )
+    q = (
+        select(Task.id, func.coalesce(per_task.c.n, 0))
+        .outerjoin(per_task, per_task.c.task_id == Task.id)
+        .where(Task.status == "sent", Task.slot != REMINDER_SLOT)
+    )
+    if since:
+        q = q.where(Task.updated_at >= since)
+    if until:
+        q = q.where(Task.updated_at < until)
+    missing, duplicated = [], []
+    for tid, n in s.execute(q.where(func.coalesce(per_task.c.n, 0) != 1)):
+        (missing.append(tid) if n == 0 else duplicated.append((tid, n)))
+
+    oq = (
+        select(LT.id, LT.ref_task_id, Task.status)
+        .outerjoin(Task, Task.id == LT.ref_task_id)
+        .where(LT.kind == "delivery", (Task.id.is_(None)) | (Task.status != "sent"))
+    )
+    if since:
+        oq = oq.where(LT.ts >= since)
+    if until:
+        oq = oq.where(LT.ts < until)
+    orphan = [tuple(r) for r in s.execute(oq)]
+    return {"missing": missing, "duplicated": duplicated, "orphan": orphan,
+            "ok": not (missing or duplicated or orphan)}
+
+
+def summary(s, since: str = None, until: str = None, by: str = "day"):
+    """
+    读汇总表：[(期间, 订阅类型, 流水类型, 笔数, 瓶数合计, 金额合计)]。
+    since/until 为 YYYY-MM-DD（含）；by="month" 时按 YYYY-MM 合并。
+    """
+    R = DailyRollup
+    period = func.substr(R.day, 1, 7) if by == "month" else R.day
+    q = (
+        select(
+            period, R.sub_type, R.kind,
+            func.sum(R.tx_count), func.sum(R.bottle_sum), func.sum(R.amount_sum),
+        )
+        .group_by(period, R.sub_type, R.kind)
+        .order_by(period, R.sub_type, R.kind)
+    )
+    if since:
+        q = q.where(R.day >= since)
+    if until:
+        q = q.where(R.day <= until)
+    return [tuple(r) for r in s.execute(q)]
+
+
+def planned(s, since: str = None, until: str = None, status: str = "pending"):
+    """计划配送量：[(配送日, 订阅类型, 任务数, 瓶数合计)]；since/until 为 YYYY-MM-DD（含）"""
+    q = (
+        select(
+            Task.delivery_date, Subscription.type,
+            func.count(), func.coalesce(func.sum(Task.delivered_bottles), 0),
+        )
+        .outerjoin(Subscription, Subscription.id == Task.subscription_id)
+        .where(Task.status == status, Task.slot != REMINDER_SLOT)
+        .group_by(Task.delivery_date, Subscription.type)
+        .order_by(Task.delivery_date, Subscription.type)
+    )
+    if since:
+        q = q.where(Task.delivery_date >= since)
+    if until:
+        q = q.where(Task.delivery_date <= until)
+    return [tuple(r) for r in s.execute(q)]
+
+
+def _print_reconcile(res: dict):
+    if res["ok"]:
+        print("✅ 对账一致：每条已发送任务恰好对应一条 delivery 流水")
+        return
+    if res["missing"]:
+        print(f"❌ {len(res['missing'])} 条已发送任务没有扣费流水：{res['missing'][:20]}")
+    if res["duplicated"]:
+        print(f"❌ {len(res['duplicated'])} 条任务有多条扣费流水：{res['duplicated'][:20]}")
+    if res["orphan"]:
+        print(f"❌ {len(res['orphan'])} 条扣费流水关联的任务不是 sent：{res['orphan'][:20]}")
+
+
+def main(argv=None) -> int:
+    from db_utils import init_db, session_scope
+
+    ap = argparse.ArgumentParser(description="台账日汇总与对账")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("refresh", help="增量汇总新流水")
+    p = sub.add_parser("rebuild", help="重算某一天")
+    p.add_argument("day", help="YYYY-MM-DD")
+    p = sub.add_parser("check", help="对账：sent 任务 ↔ delivery 流水")
+    p.add_argument("--since")
+    p.add_argument("--until")
+    p = sub.add_parser("report", help="从汇总表输出日/月报")
+    p.add_argument("--since")
+    p.add_argument("--until")
+    p.add_argument("--by", choices=["day", "month"], default="day")
+    p = sub.add_parser("plan", help="待发任务的计划配送量")
+    p.add_argument("--since")
+    p.add_argument("--until")
+    args = ap.parse_args(argv)
+
+    init_db()
+    with session_scope() as s:
+        if args.cmd == "refresh":
+            print(f"计入 {refresh(s)} 条新流水")
+        elif args.cmd == "rebuild":
+            print(f"重建 {args.day}：{rebuild_day(s, args.day)} 个汇总键")
+        elif args.cmd == "check":
+            since = datetime.fromisoformat(args.since) if args.since else None
+            until = datetime.fromisoformat(args.until) + timedelta(days=1) if args.until else None
+            res = reconcile(s, since, until)
+            _print_reconcile(res)
+            return 0 if res["ok"] else 1
+        elif args.cmd == "plan":
+            print("配送日      订阅类型    任务数    瓶数")
+            for day, typ, n, bottles in planned(s, args.since, args.until):
+                print(f"{day or '-':<10}  {typ or '-':<10} {n:>6} {bottles:>7}")
+        else:
+            refresh(s)
+            print("期间        订阅类型    流水类型         笔数      瓶数        金额")
+            for period, typ, kind, n, b, a in summary(s, args.since, args.until, args.by):
+                print(f"{period:<10}  {typ or '-':<10}  {kind:<14} {n:>6} {b:>9} {a or ZERO:>11.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
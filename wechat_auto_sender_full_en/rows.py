@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+rows.py
+只读路径用的轻量行对象与按列查询：
+- 行对象是 NamedTuple（无实例 __dict__），按列 SELECT 直接构造，不进 identity map、不做变更跟踪、不带关系代理
+- due_tasks（db_utils.fetch_due_tasks）：调度器每个 tick 的到期任务扫描
+- task_list / find_customer / customer_balances / ledger_rows：GUI 的任务队列页与客户页
+- tasks_by_ids / ledger_by_ids：GUI 按变更流水（changefeed.py）就地更新时只取变了的行
+需要修改数据的地方（hook、编辑任务弹窗、手工调整等）仍然按 id 取 ORM 对象；preflight 只读行对象、用一条 UPDATE 改状态。
+"""
+
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+from sqlalchemy import func, select
+
+from models import Customer, LedgerTransaction, Subscription, Task
+from money import Money, ZERO
+
+
+class TaskRow(NamedTuple):
+    """hook.task_fields / preflight.project 可以直接用（与 Task 的同名属性一致）"""
+    id: int
+    customer_id: int
+    subscription_id: Optional[int]
+    send_time: datetime
+    template_key: str
+    delivered_bottles: Optional[int]
+    remark: Optional[str]
+    payload_json: Optional[str]
+    status: str
+
+
+class CustomerRow(NamedTuple):
+    id: int
+    name: Optional[str]
+    wx_display_name: str
+    account: Optional[str]
+
+
+class BalanceRow(NamedTuple):
+    subscription_id: int
+    type: str
+    unit_price: Optional[Money]
+    bottle_balance: int
+    amount_balance: Money
+
+
+class LedgerRow(NamedTuple):
+    id: int
+    ts: datetime
+    kind: str
+    bottle_delta: int
+    amount_delta: Money
+    memo: Optional[str]
+    subscription_id: Optional[int]
+
+
+def _columns(entity, row_cls) -> list:
+    return [getattr(entity, f) for f in row_cls._fields]
+
+
+TASK_COLUMNS = _columns(Task, TaskRow)
+
+
+def _rows(s, q, row_cls) -> list:
+    return [row_cls._make(r) for r in s.execute(q)]
+
+
+def due_tasks(s, now: datetime, limit: int, account: str = None, include_unassigned: bool = False) -> list:
+    q = select(*TASK_COLUMNS).where(Task.status == "pending", Task.send_time <= now)
+    if account is not None:
+        cond = Customer.account == account
+        if include_unassigned:
+            cond = cond | Customer.account.is_(None)
+        q = q.join(Customer, Customer.id == Task.customer_id).where(cond)
+    return _rows(s, q.order_by(Task.send_time.asc()).limit(limit), TaskRow)
+
+
+def task_list(s, status: str = None, customer_id: int = None, order=None, limit: int = 300) -> list:
+    q = select(*TASK_COLUMNS)
+    if status:
+        q = q.where(Task.status == status)
+    if customer_id is not None:
+        q = q.where(Task.customer_id == customer_id)
+    return _rows(s, q.order_by(*(order or (Task.send_time.asc(),))).limit(limit), TaskRow)
+
+
+def tasks_by_ids(s, ids) -> list:
+    return _rows(s, select(*TASK_COLUMNS).where(Task.id.in_(list(ids))), TaskRow)
+
+
+def find_customer(s, name: str) -> Optional[CustomerRow]:
+    """按姓名或微信备注精确查找"""
+    r = s.execute(
+        select(*_columns(Customer, CustomerRow))
+        .where((Customer.name == name) | (Customer.wx_display_name == name))
+        .limit(1)
+    ).first()
+    return CustomerRow._make(r) if r else None
+
+
+def customer_balances(s, customer_id: int) -> list:
+    """客户名下各订阅的余额：一条 GROUP BY（不再逐个订阅 SUM）"""
+    LT = LedgerTransaction
+    q = (
+        select(
+            Subscription.id, Subscription.type, Subscription.unit_price,
+            func.coalesce(func.sum(LT.bottle_delta), 0),
+            func.coalesce(func.sum(LT.amount_delta), 0),
+        )
+        .outerjoin(LT, LT.subscription_id == Subscription.id)
+        .where(Subscription.customer_id == customer_id)
+        .group_by(Subscription.id)
+        .order_by(Subscription.id)
+    )
+    return [
+        BalanceRow(sid, typ, price, int(b or 0), a or ZERO)
+        for sid, typ, price, b, a in s.execute(q)
+    ]
+
+
+def ledger_rows(s, customer_id: int, limit: int = 50) -> list:
+    """客户最近的流水（新→旧）"""
+    q = (
+        select(*_columns(LedgerTransaction, LedgerRow))
+        .where(LedgerTransaction.customer_id == customer_id)
+        .order_by(LedgerTransaction.ts.desc())
+        .limit(limit)
+    )
+    return _rows(s, q, LedgerRow)
+
+
+def ledger_by_ids(s, ids) -> list:
+    """指定流水（旧→新）"""
+    q = (
+        select(*_columns(LedgerTransaction, LedgerRow))
+        .where(LedgerTransaction.id.in_(list(ids)))
+        .order_by(LedgerTransaction.ts, LedgerTransaction.id)
+    )
+    return _rows(s, q, LedgerRow)
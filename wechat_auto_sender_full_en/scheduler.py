@@ -1,21 +1,24 @@
 # -*- coding: utf-8 -*-
 """
 Scheduler — 读取 config.py 的参数进行轮询调度
-优先调用 hooks.process_one_task(task_id) 真正执行任务；
-若没有 hooks.py，则做占位处理（把任务标记为 sent，便于先跑通）。
+任务处理函数由 config.TASK_PROCESSOR 在处理器注册表中显式选择：
+- "hook"：hook.process_one_task(task_id)，真正渲染/发送/记账
+- "placeholder"：仅把任务标记为 sent，便于先跑通
+配置了未知名称或处理器导入失败时直接报错，不再静默退化。
+
+多账号（config.SENDER_ACCOUNTS 多于一个）时，每个 tick 按客户的发送账号分片取任务，
+各分片在自己的线程里按本账号的节奏串行发送，分片之间并行；全部完成后本 tick 才结束。
+本进程只处理 sender.served_accounts() 中的账号，多个桌面各跑一个进程时互不重叠。
+取到任务后先做一次批量余额预检（preflight.py），会透支的任务按 OVERDRAW_POLICY 处理，不占发送名额。
+发送成功的结果经 journal 分组提交：每个 tick 开始时补写遗留结果（发送中断的任务标记为 unconfirmed），结束时提交缓冲。
+群发活动（campaigns.py）的消息在同一分片里排在配送确认之后（或按 CAMPAIGN_INTERLEAVE 穿插），确认优先。
+request_stop() 之后各分片处理完手上这一条就停，worker 提交结果后返回（main.py 的信号处理用它优雅退出）。
 """
 
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
-import time
-
-try:
-    # 可选：更好看的日志
-    from loguru import logger
-except Exception:
-    import logging as logger
-    logger.basicConfig(level=20)
-
-from apscheduler.schedulers.background import BackgroundScheduler
+import importlib
+import threading
 
 from config import (
     TIMEZONE,
@@ -24,19 +27,85 @@ from config import (
     NIGHT_SILENT,
     NIGHT_START,
     NIGHT_END,
+    TASK_PROCESSOR,
 )
-from db_utils import session_scope, fetch_due_tasks, mark_task_status
 
-
-# --- 可选动作：若存在 hooks.py，则使用里面的真正处理函数 ---
-_PROCESSOR = None
 try:
-    from hooks import process_one_task as _PROCESSOR  # type: ignore
-    logger.info("Scheduler: using hooks.process_one_task()")
+    from config import ROLLUP_INTERVAL_SECONDS
 except Exception:
-    logger.warning(
-        "Scheduler: hooks.process_one_task 未找到，将使用占位处理（仅标记 sent）。"
-    )
+    ROLLUP_INTERVAL_SECONDS = 300
+try:
+    from config import OVERDRAW_POLICY
+except Exception:
+    OVERDRAW_POLICY = "hold"
+try:
+    from config import FORECAST_AT
+except Exception:
+    FORECAST_AT = None
+try:
+    from config import SEND_PLAN_AT
+except Exception:
+    SEND_PLAN_AT = None
+import clock
+from log_utils import get_logger, log_context
+from db_utils import session_scope, fetch_due_tasks, count_due_tasks, mark_task_status
+import journal
+import metrics
+import preflight
+from profiling import profiled
+
+logger = get_logger(__name__)
+
+
+# --- 处理器注册表：名称 -> "模块:函数"（首次使用时才导入） ---
+PROCESSORS = {
+    "hook": "hook:process_one_task",
+    "placeholder": "scheduler:_placeholder_process",
+}
+_processor = None
+
+
+class ProcessorConfigError(RuntimeError):
+    pass
+
+
+def register_processor(name: str, target):
+    """注册处理器；target 可以是 "模块:函数" 字符串或可调用对象（签名 fn(task_id)）"""
+    PROCESSORS[name] = target
+
+
+def get_processor(name: str = None):
+    """解析并缓存处理器；配置错误时抛出 ProcessorConfigError"""
+    global _processor
+    if name is None and _processor is not None:
+        return _processor
+    key = name or TASK_PROCESSOR
+    target = PROCESSORS.get(key)
+    if target is None:
+        raise ProcessorConfigError(
+            f"未知的 TASK_PROCESSOR={key!r}，可选：{', '.join(sorted(PROCESSORS))}"
+        )
+    if isinstance(target, str):
+        mod_name, _, fn_name = target.partition(":")
+        try:
+            fn = getattr(importlib.import_module(mod_name), fn_name)
+        except Exception as e:
+            raise ProcessorConfigError(f"无法加载处理器 {key!r} -> {target}: {e}") from e
+    else:
+        fn = target
+    if not callable(fn):
+        raise ProcessorConfigError(f"处理器 {key!r} 不可调用：{fn!r}")
+    if name is None:
+        _processor = fn
+        logger.info(f"Scheduler: using processor {key!r}")
+    return fn
+
+
+def use_processor(name: str):
+    """显式切换当前处理器（模拟/命令行工具用）"""
+    global _processor
+    _processor = get_processor(name)
+    logger.info(f"Scheduler: using processor {name!r}")
 
 
 def _night_silent_now(now: datetime) -> bool:
@@ -51,41 +120,197 @@ def _night_silent_now(now: datetime) -> bool:
         return h >= NIGHT_START or h < NIGHT_END
 
 
-def _placeholder_handle(task, s):
-    """没有 hooks 时的占位处理：仅把任务标记为 sent"""
-    mark_task_status(s, task, "sent", result_log="placeholder sent", increment_try=True)
-    logger.info(f"[PLACEHOLDER] Marked task #{task.id} as sent.")
-
-
-def worker():
-    """定时扫描并处理到期任务"""
-    now = datetime.now()
-    if _night_silent_now(now):
-        logger.info("Night-silent window. Skip this tick.")
-        return
+def _placeholder_process(task_id: int):
+    """占位处理：仅把任务标记为 sent"""
+    from models import Task
 
     with session_scope() as s:
-        due = fetch_due_tasks(s, now=now, limit=20)
-        if not due:
+        task = s.get(Task, task_id)
+        if not task or task.status != "pending":
             return
+        mark_task_status(s, task, "sent", result_log="placeholder sent", increment_try=True)
+    logger.info(f"[PLACEHOLDER] Marked task #{task_id} as sent.")
+
+
+# --- 发送账号分片 ---
+_pool = None
+_stop = threading.Event()
+
+
+def request_stop():
+    """请求停止：正在发送的任务照常完成，之后不再开始新任务"""
+    _stop.set()
+
+
+def stopping() -> bool:
+    return _stop.is_set()
+
 
-        logger.info(f"Found {len(due)} due tasks.")
-        for t in due:
+def _shard_interval(account: str) -> float:
+    import sender
+
+    opts = sender.SENDER_ACCOUNTS.get(account) or {}
+    return float(opts.get("min_interval", GLOBAL_MIN_INTERVAL))
+
+
+def _run_shard(account: str, jobs: list, started=None):
+    """一个分片：绑定该账号的发送器，按该账号的最小间隔串行处理 [(处理函数, id)]；started 为 tick 开始的时刻"""
+    import sender
+
+    sender.bind_sender(account)
+    gap = _shard_interval(account)
+    # 模拟回放时每个分片一条虚拟时间线，并行分片的休眠重叠而不是相加（见 clock.timeline）
+    with log_context(shard=account), clock.timeline(started):
+        for i, (fn, item_id) in enumerate(jobs):
+            if _stop.is_set():
+                logger.info(f"Stop requested, shard {account} leaves {len(jobs) - i} job(s) for later.")
+                break
             try:
-                if _PROCESSOR:
-                    # 真正处理（会做模板渲染、余额校验、发送/记账等）
-                    _PROCESSOR(t.id)
-                else:
-                    # 占位处理
-                    _placeholder_handle(t, s)
+                fn(item_id)
             except Exception as e:
                 logger.exception(e)
             finally:
-                # 为了更“像人”，每条任务留出全局最小间隔
-                time.sleep(float(GLOBAL_MIN_INTERVAL))
+                metrics.inc("shard_tasks_total", shard=account)
+                # 为了更“像人”，每条任务留出最小间隔（按账号计）
+                with metrics.span("pacing_sleep"):
+                    clock.sleep(gap)
+
+
+def _get_pool(n: int) -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None or _pool._max_workers < n:
+        _pool = ThreadPoolExecutor(max_workers=n, thread_name_prefix="shard")
+    return _pool
+
+
+@profiled("scheduler.worker")
+def worker() -> int:
+    """定时扫描并处理到期任务，返回本 tick 派发的任务数（夜间静默/没有可发任务/已请求停止时为 0）"""
+    import campaigns
+    import sender
+
+    now = clock.now()
+    if _stop.is_set():
+        return 0
+    if _night_silent_now(now):
+        logger.info("Night-silent window. Skip this tick.")
+        return 0
+
+    process = get_processor()
+    default = sender.account_names()[0]
+    accounts = sender.served_accounts()
+    journal.recover()
+
+    with session_scope() as s:
+        if OVERDRAW_POLICY == "hold":
+            with metrics.span("release_held"):
+                preflight.release_held(s)
+        with metrics.span("fetch_due_tasks"):
+            if len(sender.account_names()) == 1:
+                due = {default: fetch_due_tasks(s, now=now, limit=20)}
+            else:
+                due = {
+                    acc: fetch_due_tasks(
+                        s, now=now, limit=20, account=acc, include_unassigned=(acc == default)
+                    )
+                    for acc in accounts
+                }
+        # 余额预检：同一订阅的多条任务累计预扣，会透支的不进入发送队列
+        with metrics.span("preflight"):
+            blocked = preflight.run(s, [t for tasks in due.values() for t in tasks])
+        # 已发送、结果还在 journal 缓冲里的任务库里仍是 pending，不能再发
+        blocked |= journal.pending_task_ids()
+        batches = {acc: [(process, t.id) for t in tasks if t.id not in blocked] for acc, tasks in due.items()}
+        # 群发：只用确认任务剩下的发送名额；账号过滤与确认任务一致（单账号时不过滤）
+        if campaigns.has_running(s):
+            single = len(sender.account_names()) == 1
+            inflight = journal.pending_recipient_ids()
+            with metrics.span("fetch_campaign"):
+                for acc in ([default] if single else accounts):
+                    jobs = batches.get(acc, [])
+                    rids = campaigns.fetch_due(
+                        s, campaigns.quota(len(jobs)), account=None if single else acc,
+                        include_unassigned=(acc == default), exclude=inflight,
+                    )
+                    batches[acc] = campaigns.interleave(jobs, [(campaigns.send_recipient, r) for r in rids])
+        depth = count_due_tasks(s, now=now)
+    batches = {acc: jobs for acc, jobs in batches.items() if jobs}
+    metrics.set_gauge("queue_depth", depth)
+    if not batches:
+        metrics.export()
+        return 0
+
+    logger.info(f"Found {sum(map(len, batches.values()))} due jobs.")
+    if len(batches) == 1:
+        (acc, jobs), = batches.items()
+        _run_shard(acc, jobs)
+    else:
+        started = clock.now()
+        futures = [
+            _get_pool(len(accounts)).submit(_run_shard, acc, jobs, started)
+            for acc, jobs in batches.items()
+        ]
+        wait(futures)
+
+    journal.flush()
+    metrics.export()
+    return sum(map(len, batches.values()))
+
+
+def refresh_rollups():
+    """增量更新台账日汇总（独立于发送 tick，失败只记日志）"""
+    import rollups
+
+    try:
+        with session_scope() as s:
+            rollups.refresh(s)
+    except Exception as e:
+        logger.exception(e)
+
+
+def housekeeping():
+    """清理过期的变更流水与 metrics 表（各自独立，失败只记日志）"""
+    import changefeed
+
+    for prune in (changefeed.prune, metrics.prune):
+        try:
+            with session_scope() as s:
+                prune(s)
+        except Exception as e:
+            logger.exception(e)
+
+
+def run_forecast():
+    """每日余额预测，生成续费提醒任务（失败只记日志）"""
+    import forecast
+
+    try:
+        with session_scope() as s:
+            forecast.generate(s)
+    except Exception as e:
+        logger.exception(e)
+
+
+def run_send_plan():
+    """为次日的待发任务排定发送时间（失败只记日志）"""
+    import sendplan
+
+    try:
+        with session_scope() as s:
+            sendplan.run(s)
+    except Exception as e:
+        logger.exception(e)
 
 
 def start_scheduler():
+    from apscheduler.schedulers.background import BackgroundScheduler
+    import sender
+
+    # 启动前先解析处理器与发送账号，配置错误立即暴露
+    get_processor()
+    # 锁定发送日志并处理遗留结果：同一日志已有调度器在运行时这里就抛 JournalBusy
+    journal.recover()
+    logger.info(f"Sender accounts: {', '.join(sender.served_accounts())}")
     logger.info(
         f"Scheduler starting... tz={TIMEZONE}, interval={SCAN_INTERVAL_SECONDS}s, "
         f"night_silent={'ON' if NIGHT_SILENT else 'OFF'}"
@@ -100,6 +325,45 @@ def start_scheduler():
         max_instances=1,
         coalesce=True,
     )
+    if ROLLUP_INTERVAL_SECONDS:
+        sched.add_job(
+            refresh_rollups,
+            "interval",
+            seconds=int(ROLLUP_INTERVAL_SECONDS),
+            id="ledger_rollups",
+            max_instances=1,
+            coalesce=True,
+        )
+    sched.add_job(
+        housekeeping,
+        "interval",
+        hours=1,
+        id="housekeeping",
+        max_instances=1,
+        coalesce=True,
+    )
+    if FORECAST_AT:
+        hour, minute = (int(x) for x in FORECAST_AT.split(":"))
+        sched.add_job(
+            run_forecast,
+            "cron",
+            hour=hour,
+            minute=minute,
+            id="balance_forecast",
+            max_instances=1,
+            coalesce=True,
+        )
+    if SEND_PLAN_AT:
+        hour, minute = (int(x) for x in SEND_PLAN_AT.split(":"))
+        sched.add_job(
+            run_send_plan,
+            "cron",
+            hour=hour,
+            minute=minute,
+            id="send_plan",
+            max_instances=1,
+            coalesce=True,
+        )
     sched.start()
     logger.info("Scheduler started.")
     return sched
@@ -3,24 +3,26 @@
 sender.py
 封装实际“把文本发到微信”的动作。
 DRY_RUN=True 时只粘贴不回车，便于安全演练。
+多行消息可以逐行发送（per_line），也可以合成一条消息只回车一次（paste / shift_enter），按模板配置，见 message_mode()。
+pyautogui / pyperclip / pygetwindow 在首次发送时才导入，导入本模块没有任何界面操作。
+
+多账号：每个账号一个 WeChatSender（各自的微信窗口、输入框位置、节奏），见 config.SENDER_ACCOUNTS。
+同一桌面只有一套键盘鼠标，所有界面操作在 _ui_lock 内进行；各账号的安全间隔等待在锁外，
+因此同一桌面上的多个账号可以在不同线程里交错发送（加速比受界面操作占比限制）。
+要随账号数线性扩展，把账号分到不同的桌面（Windows 会话/虚拟机），每个桌面运行一个进程，
+用环境变量 WECHAT_ACCOUNTS=账号1,账号2 指定该进程负责哪些账号。
 """
 
-import time
+import os
 import random
-from datetime import datetime
+import threading
 
-import pyautogui as gui
-import pyperclip
+import audit
+import clock
+import metrics
+from log_utils import get_logger
 
-try:
-    from loguru import logger
-except Exception:  # pragma: no cover
-    class _L:
-        def info(self, *a, **k): print("[INFO]", *a)
-        def warning(self, *a, **k): print("[WARN]", *a)
-        def error(self, *a, **k): print("[ERROR]", *a)
-        def exception(self, *a, **k): print("[EXC]", *a)
-    logger = _L()
+logger = get_logger(__name__)
 
 # 可从 config 读取的选项（给默认值，兼容你的极简 config.py）
 try:
@@ -32,93 +34,297 @@ except Exception:
     JITTER_SECONDS = (0.8, 2.2)
     INPUT_BOX_POS = (1275, 850)
 
+try:
+    from config import SCREENSHOT_ON_SEND
+except Exception:
+    SCREENSHOT_ON_SEND = False
+
+try:
+    from config import SENDER_ACCOUNTS
+except Exception:
+    SENDER_ACCOUNTS = {"default": {}}
+
+try:
+    from config import MESSAGE_MODE, TEMPLATE_MESSAGE_MODES
+except Exception:
+    MESSAGE_MODE = "per_line"
+    TEMPLATE_MESSAGE_MODES = {}
+
+MESSAGE_MODES = ("per_line", "paste", "shift_enter")
+
+# 界面自动化库（懒加载）
+gui = None
+pyperclip = None
+_headless = False
+
+# 键鼠互斥：同一时刻只有一个账号在操作界面；_ui_owner 记录最后操作界面的账号
+_ui_lock = threading.RLock()
+_ui_owner = None
+
+class _NoopUI:
+    """无显示环境的替身：界面操作全部为空操作，但保留所有停顿（用于模拟/测试）"""
+    def hotkey(self, *a, **k): pass
+    def press(self, *a, **k): pass
+    def click(self, *a, **k): pass
+    def copy(self, *a, **k): pass
+    def screenshot(self, *a, **k): return None
+
+def use_headless(enabled: bool = True):
+    """切换到无界面模式：不导入 pyautogui/pyperclip，也不去找微信窗口"""
+    global gui, pyperclip, _headless
+    _headless = enabled
+    if enabled:
+        gui = pyperclip = _NoopUI()
+    else:
+        gui = pyperclip = None
+
+def _load_ui():
+    global gui, pyperclip
+    if gui is None:
+        import pyautogui
+        import pyperclip as _clip
+        gui, pyperclip = pyautogui, _clip
+
 def _jitter(a=0.8, b=2.2):
-    time.sleep(random.uniform(a, b))
+    clock.sleep(random.uniform(a, b))
 
 def _human_pause(sec: float):
-    time.sleep(sec + random.uniform(0, 0.6))
+    clock.sleep(sec + random.uniform(0, 0.6))
+
+def message_mode(template_key: str = None) -> str:
+    """模板的发送方式：TEMPLATE_MESSAGE_MODES 单独指定的优先，否则 MESSAGE_MODE；无法识别的值按 per_line"""
+    mode = TEMPLATE_MESSAGE_MODES.get(template_key, MESSAGE_MODE) if template_key else MESSAGE_MODE
+    if mode not in MESSAGE_MODES:
+        logger.warning(f"未知的消息发送方式 {mode!r}，按 per_line 发送")
+        return "per_line"
+    return mode
+
+def _find_windows():
+    """所有微信窗口（排除浏览器里的“微信”标签），按屏幕位置排序，window_index 据此选择"""
+    import pygetwindow as gw
+    candidates = gw.getWindowsWithTitle("微信") + gw.getWindowsWithTitle("WeChat")
+    # 过滤掉浏览器窗口
+    filtered = [w for w in candidates if not any(b in w.title for b in ["Chrome", "Edge", "Firefox", "Safari"])]
+    return sorted(filtered, key=lambda w: (getattr(w, "left", 0), getattr(w, "top", 0)))
+
 
-def _focus_wechat():
+class WeChatSender:
     """
-    激活微信窗口，排除浏览器里的“微信”标签。
+    一个微信账号（一个微信窗口）的发送器。
+    window_index：多开时按窗口位置（从左到右）选第几个；单账号为 0。
+    input_box_pos / safe_gap：不填则用全局 INPUT_BOX_POS / SAFE_GAP_PER_MSG。
+    maximize：单账号时最大化保证坐标稳定；多开并排摆放时应设为 False。
     """
-    try:
-        import pygetwindow as gw
-        candidates = gw.getWindowsWithTitle("微信") + gw.getWindowsWithTitle("WeChat")
-        # 过滤掉浏览器窗口
-        filtered = [w for w in candidates if not any(b in w.title for b in ["Chrome", "Edge", "Firefox", "Safari"])]
-        if filtered:
-            wx = filtered[0]
-            try:
-                wx.restore()
-                wx.activate()
-            except Exception:
-                wx.minimize()
-                wx.restore()
-            time.sleep(0.5)
-            logger.info(f"已切换到微信窗口: {wx.title}")
+
+    def __init__(self, name: str = "default", window_index: int = 0, input_box_pos=None,
+                 safe_gap: float = None, maximize: bool = True, **_):
+        self.name = name
+        self.window_index = window_index
+        self.input_box_pos = tuple(input_box_pos) if input_box_pos else None
+        self.safe_gap = safe_gap
+        self.maximize = maximize
+        # 最近一次激活的微信窗口区域 (left, top, width, height)，截图只截这一块
+        self._wx_region = None
+        self._wx_maximized = False
+
+    def _input_box(self):
+        return self.input_box_pos or INPUT_BOX_POS
+
+    def _gap(self) -> float:
+        return float(SAFE_GAP_PER_MSG if self.safe_gap is None else self.safe_gap)
+
+    def _focus_wechat(self):
+        """
+        激活本账号的微信窗口。
+        """
+        global _ui_owner
+        _ui_owner = self.name
+        if _headless:
+            clock.sleep(0.5)
             return True
-        else:
-            logger.error("未找到合适的微信窗口，请确认已打开微信客户端")
+        try:
+            windows = _find_windows()
+            if len(windows) > self.window_index:
+                wx = windows[self.window_index]
+                try:
+                    wx.restore()
+                    wx.activate()
+                except Exception:
+                    wx.minimize()
+                    wx.restore()
+                if self.maximize and not self._wx_maximized:
+                    # 首次激活时最大化一次，保证 INPUT_BOX_POS 坐标稳定
+                    try:
+                        wx.maximize()
+                        self._wx_maximized = True
+                    except Exception:
+                        pass
+                clock.sleep(0.5)
+                try:
+                    self._wx_region = (wx.left, wx.top, wx.width, wx.height)
+                except Exception:
+                    self._wx_region = None
+                logger.info(f"[{self.name}] 已切换到微信窗口: {wx.title}")
+                return True
+            else:
+                logger.error(f"[{self.name}] 未找到第 {self.window_index + 1} 个微信窗口，请确认已打开微信客户端")
+                return False
+        except Exception as e:
+            logger.error(f"[{self.name}] 激活微信窗口失败: {e}")
             return False
-    except Exception as e:
-        logger.error(f"激活微信窗口失败: {e}")
-        return False
-
-def _open_search():
-    gui.hotkey("ctrl", "f")  # 微信搜索
-    _jitter(*JITTER_SECONDS)
-
-def _paste_text(t: str):
-    pyperclip.copy(t)
-    _jitter(0.2, 0.5)
-    gui.hotkey("ctrl", "v")
-
-def _find_and_open_contact(name: str):
-    _open_search()
-    _paste_text(name)
-    _jitter(0.5, 0.8)   # 等待搜索结果刷新
-    gui.press("enter")
-    # _jitter(0.3, 0.5)   # 给微信反应时间
-    # gui.press("enter")  # 再按一次，确保进入聊天
-    _human_pause(0.6)
-    # 👇 点击输入框位置（可在 config.py 中配置 INPUT_BOX_POS）
-    gui.click(*INPUT_BOX_POS)
-    _human_pause(0.3)
-
-def send_text_lines(contact_name: str, lines: list[str]):
-    """
-    把多行文本发送给联系人（或单聊窗口）。
-    DRY_RUN=True: 只粘贴不回车；False: 每行回车发送。
-    """
-    logger.info(f"Sending to '{contact_name}' ({len(lines)} lines), DRY_RUN={DRY_RUN}")
 
-    _focus_wechat()
-    _find_and_open_contact(contact_name)
+    def _open_search(self):
+        gui.hotkey("ctrl", "f")  # 微信搜索
+        _jitter(*JITTER_SECONDS)
+
+    def _paste_text(self, t: str):
+        pyperclip.copy(t)
+        _jitter(0.2, 0.5)
+        gui.hotkey("ctrl", "v")
 
-    for line in lines:
-        if not line.strip():
-            continue
-        _paste_text(line)
-        _jitter(0.4, 0.9)
+    def _find_and_open_contact(self, name: str):
+        self._open_search()
+        self._paste_text(name)
+        _jitter(0.5, 0.8)   # 等待搜索结果刷新
+        gui.press("enter")
+        # _jitter(0.3, 0.5)   # 给微信反应时间
+        # gui.press("enter")  # 再按一次，确保进入聊天
+        _human_pause(0.6)
+        # 👇 点击输入框位置（可在 config.py 中配置 INPUT_BOX_POS）
+        gui.click(*self._input_box())
+        _human_pause(0.3)
 
-        # 可选截图留存
+    def _capture_for_audit(self, contact_name: str, task_id: int = None):
+        """只截微信窗口区域并交给 audit 后台线程，编码/写盘/去重都不在发送路径上"""
         try:
-            from config import SCREENSHOT_ON_SEND
-            if SCREENSHOT_ON_SEND:
-                ts = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-                gui.screenshot(f"{AUDIT_DIR}/send_{ts}.png")
-        except Exception:
-            pass
+            img = gui.screenshot(region=self._wx_region) if self._wx_region else gui.screenshot()
+            audit.submit(img, task_id=task_id, contact=contact_name)
+        except Exception as e:
+            logger.warning(f"截图失败: {e}")
+
+    def _send_composed(self, contact_name: str, lines: list[str], mode: str, task_id: int = None) -> bool:
+        """
+        所有行合成一条消息，只回车一次：paste=一次粘贴多行文本；shift_enter=逐行粘贴、Shift+Enter 换行。
+        合成过程中出错时清空输入框并返回 False，由调用方退回逐行发送（此时还没有回车，不会发出半条消息）。
+        调用方必须从切换窗口、打开联系人起一直持有 _ui_lock，直到这里回车，中间不能让其他账号用键鼠。
+        """
+        try:
+            with metrics.span("compose"):
+                if mode == "paste":
+                    self._paste_text("\n".join(lines))
+                else:
+                    for i, line in enumerate(lines):
+                        if i:
+                            gui.hotkey("shift", "enter")
+                        self._paste_text(line)
+                _jitter(0.4, 0.9)
+        except Exception as e:
+            logger.warning(f"[{self.name}] 合成消息失败，改为逐行发送: {e}")
+            try:
+                gui.hotkey("ctrl", "a")
+                gui.press("backspace")
+            except Exception:
+                pass
+            return False
+
+        if SCREENSHOT_ON_SEND:
+            self._capture_for_audit(contact_name, task_id)
 
         if not DRY_RUN:
             gui.press("enter")
-        _human_pause(float(SAFE_GAP_PER_MSG))
-
-import pygetwindow as gw
-windows = gw.getWindowsWithTitle("微信")
-if windows:
-    wx = windows[0]
-    wx.activate()
-    wx.maximize()
-    time.sleep(0.5)
\ No newline at end of file
+        return True
+
+    def send_text_lines(self, contact_name: str, lines: list[str], task_id: int = None, mode: str = "per_line"):
+        """
+        把多行文本发送给联系人（或单聊窗口）。
+        DRY_RUN=True: 只粘贴不回车；False: 回车发送。
+        mode：per_line 每行单独发送；paste / shift_enter 合成一条消息（见 _send_composed），失败时退回逐行。
+        task_id 仅用于审计截图的索引。
+        """
+        lines = [line for line in lines if line.strip()]
+        logger.info(
+            f"[{self.name}] Sending to '{contact_name}' ({len(lines)} lines, {mode}), DRY_RUN={DRY_RUN}"
+        )
+        _load_ui()
+
+        composed = mode != "per_line" and len(lines) > 1
+        with _ui_lock:
+            with metrics.span("focus_wechat"):
+                self._focus_wechat()
+            with metrics.span("find_and_open_contact"):
+                self._find_and_open_contact(contact_name)
+            # 合成消息在同一次持锁内发完：打开联系人和回车之间其他账号不能切走窗口
+            sent = composed and self._send_composed(contact_name, lines, mode, task_id)
+
+        if sent:
+            with metrics.span("pacing_sleep"):
+                _human_pause(self._gap())
+            return
+        if composed:
+            metrics.inc("compose_fallback_total")
+
+        for line in lines:
+            with _ui_lock:
+                if _ui_owner != self.name:
+                    # 间隔期间其他账号用过键鼠：切回本账号窗口，聊天仍停留在该联系人
+                    with metrics.span("focus_wechat"):
+                        self._focus_wechat()
+                        gui.click(*self._input_box())
+                with metrics.span("paste"):
+                    self._paste_text(line)
+                    _jitter(0.4, 0.9)
+
+                # 可选截图留存（异步编码，见 audit.py）
+                if SCREENSHOT_ON_SEND:
+                    self._capture_for_audit(contact_name, task_id)
+
+                if not DRY_RUN:
+                    gui.press("enter")
+            with metrics.span("pacing_sleep"):
+                _human_pause(self._gap())
+
+
+# ---------------------- 账号注册与线程绑定 ----------------------
+_senders = {}
+_local = threading.local()
+
+def account_names() -> list:
+    """已配置的账号名；第一个是默认账号（customers.account 为空的客户走它）"""
+    return list(SENDER_ACCOUNTS) or ["default"]
+
+def served_accounts() -> list:
+    """本进程负责发送的账号：环境变量 WECHAT_ACCOUNTS（逗号分隔）限定，未设置则全部"""
+    names = account_names()
+    only = [x.strip() for x in os.environ.get("WECHAT_ACCOUNTS", "").split(",") if x.strip()]
+    if not only:
+        return names
+    unknown = [x for x in only if x not in names]
+    if unknown:
+        raise KeyError(f"WECHAT_ACCOUNTS 中的账号未配置：{', '.join(unknown)}")
+    return [x for x in names if x in only]
+
+def get_sender(name: str = None) -> WeChatSender:
+    name = name or account_names()[0]
+    if name not in _senders:
+        opts = SENDER_ACCOUNTS.get(name)
+        if opts is None:
+            raise KeyError(f"未配置的发送账号：{name!r}（见 config.SENDER_ACCOUNTS）")
+        _senders[name] = WeChatSender(name=name, **opts)
+    return _senders[name]
+
+def bind_sender(name: str = None):
+    """让当前线程后续的 send_text_lines 使用指定账号（分片工作线程调用）"""
+    _local.sender = get_sender(name)
+
+def current_sender() -> WeChatSender:
+    return getattr(_local, "sender", None) or get_sender()
+
+def backend_name() -> str:
+    """发送后端（写入 task_attempts.backend）"""
+    if _headless:
+        return "headless"
+    return "pyautogui-dryrun" if DRY_RUN else "pyautogui"
+
+def send_text_lines(contact_name: str, lines: list[str], task_id: int = None, mode: str = "per_line"):
+    """用当前线程绑定的账号发送（未绑定时用默认账号）"""
+    current_sender().send_text_lines(contact_name, lines, task_id=task_id, mode=mode)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+sendplan.py
+按发送能力与客户的 preferred_send_time 排定某一天的发送时间，避免同一分钟扎堆后再串行拖一个小时：
+- 每个发送账号一条时间线，切成 SEND_PLAN_SLOT_MINUTES 分钟的时段；每个时段最多排满
+  SEND_PLAN_SLOT_LOAD × 时段长度 的发送耗时（单条耗时同 capacity.py：理论模型 × 近期实测修正）
+- 任务依次放进最早还有余量的时段，时段内按耗时错开；迟到（发送时间 - 目标时间）尽量小：
+  先排设置了 preferred_send_time 的客户（按期望时间先后，最早可提前 SEND_PLAN_EARLY_MINUTES 分钟），
+  再排没有设置的（按原发送时间先后，不提前，只往后顺延到有余量的时段，原来扎堆在同一分钟的任务因此被摊开）。
+  排过一次的结果再排一次不会变化
+- 除非单条任务本身就超过时段容量，任何时段都不超过上限；夜间静默时段不排
+- 结果用一条 executemany UPDATE 只写回发送时间有变化的 pending 任务，并报告排期前后的总迟到与最大迟到
+  （实际还要加上最多一个 SCAN_INTERVAL_SECONDS 的轮询延迟）
+
+用法：
+    python sendplan.py [--date 2026-10-20] [--dry-run]
+"""
+
+import argparse
+import sys
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import bindparam, select, update
+
+import clock
+from capacity import _skip_night, model_task_seconds, observed_scale
+from log_utils import get_logger
+from models import Customer, Task
+
+try:
+    from config import SEND_PLAN_SLOT_MINUTES, SEND_PLAN_SLOT_LOAD, SEND_PLAN_EARLY_MINUTES
+except Exception:
+    SEND_PLAN_SLOT_MINUTES = 5
+    SEND_PLAN_SLOT_LOAD = 0.8
+    SEND_PLAN_EARLY_MINUTES = 20
+
+logger = get_logger(__name__)
+
+
+def _preferred(day: date, hhmm: str):
+    try:
+        h, m = (int(x) for x in hhmm.split(":"))
+        return datetime(day.year, day.month, day.day, h, m)
+    except (AttributeError, ValueError):
+        return None
+
+
+def load_tasks(s, day: date) -> list:
+    """该配送日的待发任务：[(task_id, 账号, 当前 send_time, 期望时间或 None, 模板)]"""
+    q = (
+        select(Task.id, Customer.account, Task.send_time, Customer.preferred_send_time, Task.template_key)
+        .join(Customer, Customer.id == Task.customer_id)
+        .where(Task.status == "pending", Task.delivery_date == day.isoformat())
+        .order_by(Task.send_time, Task.id)
+    )
+    return [(tid, acc, st, _preferred(day, pst), key) for tid, acc, st, pst, key in s.execute(q)]
+
+
+def _lag(tasks: list, costs: dict, times: dict) -> tuple:
+    """按给定发送时间在各账号时间线上串行推演：(总迟到秒数, 最大迟到秒数)"""
+    lanes, total, worst = {}, 0.0, 0.0
+    for tid, lane, st, pref, key in sorted(tasks, key=lambda x: (times[x[0]], x[0])):
+        start = _skip_night(max(lanes.get(lane, times[tid]), times[tid]))
+        lanes[lane] = start + timedelta(seconds=costs[key])
+        late = max(0.0, (start - (pref or st)).total_seconds())
+        total += late
+        worst = max(worst, late)
+    return total, worst
+
+
+def plan(s, day: date, slot_minutes: float = SEND_PLAN_SLOT_MINUTES, slot_load: float = SEND_PLAN_SLOT_LOAD,
+         early_minutes: float = SEND_PLAN_EARLY_MINUTES, now: datetime = None) -> dict:
+    """
+    计算排期（不写库）。返回 times（task_id -> 新 send_time）、changed（其中时间有变化的）、moved（要改的任务数）、
+    before/after（总迟到分钟、最大迟到分钟）、peak（每个账号单个时段最多排几条）
+    """
+    from sender import account_names
+
+    now = now or clock.now()
+    accounts = account_names()
+    scale = observed_scale(s) or 1.0
+    rows = [r for r in load_tasks(s, day) if (r[1] or accounts[0]) in accounts]
+    tasks = [(tid, acc or accounts[0], st, pref, key) for tid, acc, st, pref, key in rows]
+    costs = {key: model_task_seconds(key) * scale for *_, key in tasks}
+
+    slot = timedelta(minutes=slot_minutes)
+    budget = slot.total_seconds() * slot_load
+    origin = datetime(day.year, day.month, day.day)
+    used = {}  # (账号, 时段序号) -> 已排的发送秒数
+    count = {}
+
+    def index(t: datetime) -> int:
+        return int((t - origin) // slot)
+
+    def take(lane: str, i: int, cost: float, earliest: datetime) -> datetime:
+        # 时段内按已排耗时错开，但不早于任务自己的最早时间（重跑时已排好的任务保持原位）
+        k = (lane, i)
+        at = max(origin + slot * i + timedelta(seconds=used.get(k, 0.0)), earliest)
+        used[k] = used.get(k, 0.0) + cost
+        count[k] = count.get(k, 0) + 1
+        return at
+
+    times = {}
+    # 先排有期望时间的（可提前 early_minutes），再排没有的（以原发送时间为准，不提前）
+    for tid, lane, st, pref, key in sorted(tasks, key=lambda t: (t[3] is None, t[3] or t[2], t[0])):
+        earliest = max(pref - timedelta(minutes=early_minutes) if pref is not None else st, now)
+        i = index(earliest)
+        cost = costs[key]
+        while True:
+            start = origin + slot * i
+            resume = _skip_night(start)
+            if resume != start:
+                i = max(i + 1, index(resume))
+                continue
+            u = used.get((lane, i), 0.0)
+            # 单条就超过时段容量时只能独占一个空时段
+            if u + cost <= budget or (cost > budget and not u):
+                break
+            i += 1
+        times[tid] = take(lane, i, cost, earliest)
+
+    before = _lag(tasks, costs, {t[0]: t[2] for t in tasks})
+    after = _lag(tasks, costs, times)
+    changed = {t[0]: times[t[0]] for t in tasks if times[t[0]] != t[2]}
+    peak = {}
+    for (lane, _), n in count.items():
+        peak[lane] = max(peak.get(lane, 0), n)
+    return {
+        "day": day,
+        "tasks": len(tasks),
+        "times": times,
+        "changed": changed,
+        "moved": len(changed),
+        "before": (before[0] / 60, before[1] / 60),
+        "after": (after[0] / 60, after[1] / 60),
+        "peak": peak,
+        "per_task_seconds": costs,
+    }
+
+
+def apply(s, res: dict) -> int:
+    """把时间有变化的任务写回（仍为 pending 的；一条 executemany UPDATE），返回更新行数"""
+    T = Task.__table__
+    now = clock.now()
+    rows = [{"tid": tid, "st": t, "now": now} for tid, t in res["changed"].items()]
+    if not rows:
+        return 0
+    stmt = (
+        update(T)
+        .where(T.c.id == bindparam("tid"), T.c.status == "pending")
+        .values(send_time=bindparam("st"), updated_at=bindparam("now"))
+    )
+    return s.connection().execute(stmt, rows).rowcount
+
+
+def run(s, day: date = None, dry_run: bool = False) -> dict:
+    day = day or clock.now().date() + timedelta(days=1)
+    res = plan(s, day)
+    if not dry_run:
+        apply(s, res)
+    logger.info(
+        f"sendplan {day}: {res['tasks']} 条任务，调整 {res['moved']} 条；"
+        f"最大迟到 {res['before'][1]:.0f} -> {res['after'][1]:.0f} 分钟"
+    )
+    return res
+
+
+def main(argv=None) -> int:
+    from db_utils import init_db, session_scope
+
+    ap = argparse.ArgumentParser(description="按发送能力与客户期望时间排定发送时间")
+    ap.add_argument("--date", help="配送日 YYYY-MM-DD，默认明天")
+    ap.add_argument("--dry-run", action="store_true", help="只计算，不写库")
+    args = ap.parse_args(argv)
+
+    init_db()
+    day = date.fromisoformat(args.date) if args.date else None
+    with session_scope() as s:
+        res = run(s, day, dry_run=args.dry_run)
+    print(f"{res['day']}：{res['tasks']} 条待发任务，{'需调整' if args.dry_run else '已调整'} {res['moved']} 条发送时间")
+    print(f"总迟到：{res['before'][0]:.0f} -> {res['after'][0]:.0f} 分钟")
+    print(f"最大迟到：{res['before'][1]:.0f} -> {res['after'][1]:.0f} 分钟（另加最多一个轮询间隔）")
+    for lane, n in sorted(res["peak"].items()):
+        print(f"账号 {lane}：单个 {SEND_PLAN_SLOT_MINUTES} 分钟时段最多 {n} 条")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
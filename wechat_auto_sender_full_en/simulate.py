@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+simulate.py
+虚拟时钟回放：把数据库复制到临时目录，用 VirtualClock + 无界面发送器跑完整的调度流程，
+几秒内回放一整天，用来评估 NIGHT_SILENT / GLOBAL_MIN_INTERVAL / SAFE_GAP_PER_MSG / JITTER_SECONDS 的改动。
+
+报告内容：每条任务的发送延迟（相对 send_time）、队列深度随时间变化、每小时发送量。
+多账号时各分片线程共用同一个 tick 起点、各走各的虚拟时间线，tick 结束时全局时钟推进到最晚的那条；
+同一台机器上的 UI 锁串行化不在模拟范围内。
+
+用法示例：
+    python simulate.py --start "2026-10-20 06:00" --hours 24
+    python simulate.py --min-interval 2 --safe-gap 2.5 --jitter 0.5 1.5 --csv sim_tasks.csv
+"""
+
+import argparse
+import csv
+import os
+import random
+import shutil
+import sys
+import tempfile
+from collections import Counter
+from datetime import datetime, timedelta
+
+import config
+import clock
+
+
+def _sqlite_path(url: str):
+    prefix = "sqlite:///"
+    return url[len(prefix):] if url.startswith(prefix) else None
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    data = sorted(values)
+    return data[min(len(data) - 1, int(round(q * (len(data) - 1))))]
+
+
+def apply_overrides(args):
+    """把命令行参数覆盖到各模块已导入的配置常量上（只影响本进程）"""
+    import scheduler
+    import sender
+
+    if args.night_silent is not None:
+        scheduler.NIGHT_SILENT = args.night_silent == "on"
+    if args.min_interval is not None:
+        scheduler.GLOBAL_MIN_INTERVAL = args.min_interval
+    if args.safe_gap is not None:
+        sender.SAFE_GAP_PER_MSG = args.safe_gap
+    if args.jitter is not None:
+        sender.JITTER_SECONDS = tuple(args.jitter)
+    if args.message_mode is not None:
+        sender.MESSAGE_MODE = args.message_mode
+        sender.TEMPLATE_MESSAGE_MODES = {}
+    sender.SCREENSHOT_ON_SEND = False
+
+
+def run(start: datetime, end: datetime, scan_interval: float):
+    """按 APScheduler interval + coalesce 的语义推进虚拟时间，返回队列深度采样"""
+    import scheduler
+    from db_utils import session_scope, count_due_tasks
+    from models import Task
+
+    vc = clock.get_clock()
+    depth_samples = []
+    next_tick = start
+    while next_tick < end:
+        vc.advance_to(next_tick)
+        with session_scope() as s:
+            depth = count_due_tasks(s, now=vc.now())
+        depth_samples.append((vc.now(), depth))
+
+        scheduler.worker()
+
+        # 错过的 tick 合并（coalesce），下一次在当前时间之后的第一个网格点
+        now = vc.now()
+        next_tick += timedelta(seconds=scan_interval)
+        while next_tick < now:
+            next_tick += timedelta(seconds=scan_interval)
+
+        if depth == 0:
+            # 空闲：直接跳到下一条待发任务所在的网格点，省去空转
+            with session_scope() as s:
+                nxt = (
+                    s.query(Task.send_time)
+                    .filter(Task.status == "pending", Task.send_time > now)
+                    .order_by(Task.send_time.asc())
+                    .first()
+                )
+            if nxt is None:
+                break
+            while next_tick < nxt[0]:
+                next_tick += timedelta(seconds=scan_interval)
+    return depth_samples
+
+
+def build_report(start: datetime, end: datetime, depth_samples):
+    from db_utils import session_scope
+    from models import Task
+
+    rows = []
+    with session_scope() as s:
+        q = (
+            s.query(Task.id, Task.customer_id, Task.send_time, Task.updated_at, Task.status)
+            .filter(Task.send_time < end)
+            .filter((Task.updated_at >= start) | (Task.status == "pending"))
+            .order_by(Task.send_time.asc())
+        )
+        for tid, cid, send_time, updated_at, status in q:
+            done = status in ("sent", "failed") and updated_at and updated_at >= start
+            lag = (updated_at - send_time).total_seconds() if done else None
+            rows.append({
+                "task_id": tid,
+                "customer_id": cid,
+                "send_time": send_time,
+                "done_at": updated_at if done else None,
+                "status": status,
+                "lag_seconds": lag,
+            })
+
+    lags = [r["lag_seconds"] for r in rows if r["status"] == "sent" and r["lag_seconds"] is not None]
+    per_hour = Counter(r["done_at"].strftime("%Y-%m-%d %H:00") for r in rows if r["status"] == "sent")
+    depth_per_hour = {}
+    for ts, d in depth_samples:
+        k = ts.strftime("%Y-%m-%d %H:00")
+        depth_per_hour[k] = max(depth_per_hour.get(k, 0), d)
+    return {
+        "tasks": rows,
+        "sent": sum(1 for r in rows if r["status"] == "sent"),
+        "failed": sum(1 for r in rows if r["status"] == "failed"),
+        "still_pending": sum(1 for r in rows if r["status"] == "pending"),
+        "lag_p50": _percentile(lags, 0.5),
+        "lag_p95": _percentile(lags, 0.95),
+        "lag_max": max(lags) if lags else None,
+        "peak_depth": max((d for _, d in depth_samples), default=0),
+        "sent_per_hour": dict(sorted(per_hour.items())),
+        "peak_depth_per_hour": depth_per_hour,
+    }
+
+
+def print_report(rep: dict):
+    def fmt(v):
+        return "-" if v is None else f"{v:.1f}s"
+
+    print("=== 模拟结果 ===")
+    print(f"已发送 {rep['sent']}，失败 {rep['failed']}，结束时仍待发 {rep['still_pending']}")
+    print(f"发送延迟 p50={fmt(rep['lag_p50'])} p95={fmt(rep['lag_p95'])} max={fmt(rep['lag_max'])}")
+    print(f"队列峰值深度：{rep['peak_depth']}")
+    print("\n小时            发送量  峰值队列")
+    hours = sorted(set(rep["sent_per_hour"]) | set(rep["peak_depth_per_hour"]))
+    for h in hours:
+        print(f"{h}  {rep['sent_per_hour'].get(h, 0):>6}  {rep['peak_depth_per_hour'].get(h, 0):>8}")
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="虚拟时钟回放调度流程")
+    ap.add_argument("--db", help="源数据库文件（默认取 config.DB_URL），只读，模拟在副本上进行")
+    ap.add_argument("--start", help="虚拟起始时间 YYYY-MM-DD HH:MM（默认最早一条待发任务的时间）")
+    ap.add_argument("--hours", type=float, default=24)
+    ap.add_argument("--speed", type=float, default=0, help="倍速；0=不真实等待（最快）")
+    ap.add_argument("--seed", type=int, default=1, help="随机种子（抖动可复现）")
+    ap.add_argument("--scan-interval", type=float, default=config.SCAN_INTERVAL_SECONDS)
+    ap.add_argument("--night-silent", choices=["on", "off"])
+    ap.add_argument("--min-interval", type=float, help="覆盖 GLOBAL_MIN_INTERVAL")
+    ap.add_argument("--safe-gap", type=float, help="覆盖 SAFE_GAP_PER_MSG")
+    ap.add_argument("--jitter", type=float, nargs=2, metavar=("LO", "HI"), help="覆盖 JITTER_SECONDS")
+    ap.add_argument("--message-mode", choices=["per_line", "paste", "shift_enter"],
+                    help="覆盖 MESSAGE_MODE（所有模板统一使用）")
+    ap.add_argument("--csv", help="把逐条任务结果写入 CSV")
+    args = ap.parse_args(argv)
+
+    src = args.db or _sqlite_path(config.DB_URL)
+    if not src or not os.path.exists(src):
+        print(f"找不到源数据库：{src}")
+        return 2
+
+    workdir = tempfile.mkdtemp(prefix="wechat_sim_")
+    sim_db = os.path.join(workdir, "sim.db")
+    shutil.copyfile(src, sim_db)
+
+    # 日志/指标写到临时目录，不污染生产文件
+    import log_utils
+    import metrics
+
+    log_utils.LOG_PATH = os.path.join(workdir, "sim.log")
+    metrics.METRICS_PROM_PATH = os.path.join(workdir, "metrics.prom")
+
+    # 发送日志必须在第一次使用前改到临时目录：否则会补写/清空生产的 send_journal.jsonl
+    import journal
+
+    production_journal = os.path.abspath(journal.journal_path())
+    journal.SEND_JOURNAL_PATH = os.path.join(workdir, "send_journal.jsonl")
+    if journal._fh is not None or os.path.abspath(journal.journal_path()) == production_journal:
+        print(f"发送日志未能改到临时目录（{journal.journal_path()}），为保护生产数据拒绝模拟")
+        return 2
+
+    import db_utils
+
+    db_utils.configure(f"sqlite:///{sim_db}")
+    db_utils.init_db()
+
+    if args.start:
+        start = datetime.fromisoformat(args.start)
+    else:
+        from models import Task
+
+        with db_utils.session_scope() as s:
+            first = (
+                s.query(Task.send_time)
+                .filter(Task.status == "pending")
+                .order_by(Task.send_time.asc())
+                .first()
+            )
+        start = first[0] if first else datetime.now()
+    end = start + timedelta(hours=args.hours)
+
+    random.seed(args.seed)
+    clock.set_clock(clock.VirtualClock(start, speed=args.speed))
+
+    import scheduler
+    import sender
+
+    sender.use_headless()
+    apply_overrides(args)
+    scheduler.use_processor("hook")
+
+    print(f"模拟 {start:%Y-%m-%d %H:%M} ~ {end:%Y-%m-%d %H:%M}（工作目录 {workdir}）")
+    depth_samples = run(start, end, args.scan_interval)
+    rep = build_report(start, end, depth_samples)
+    print_report(rep)
+
+    if args.csv:
+        with open(args.csv, "w", newline="", encoding="utf-8-sig") as f:
+            w = csv.DictWriter(f, fieldnames=list(rep["tasks"][0]) if rep["tasks"] else ["task_id"])
+            w.writeheader()
+            w.writerows(rep["tasks"])
+        print(f"\n逐条结果已写入 {args.csv}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
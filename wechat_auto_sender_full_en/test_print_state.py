@@ -3,9 +3,10 @@ from sqlalchemy import create_engine, func
 from sqlalchemy.orm import sessionmaker
 from config import DB_URL
 from models import Base, Customer, Subscription, LedgerTransaction, Task
+from db_utils import init_db
 
 engine = create_engine(DB_URL, future=True)
-Base.metadata.create_all(engine)
+init_db(engine)
 Session = sessionmaker(bind=engine, future=True)
 
 with Session() as s:
@@ -3,8 +3,9 @@
 from sqlalchemy import create_engine
 from config import DB_URL
 from models import Base
+from db_utils import init_db
 
 engine = create_engine(DB_URL, future=True)
 Base.metadata.drop_all(bind=engine)
-Base.metadata.create_all(bind=engine)
+init_db(engine)
 print("✅ Database schema reset done.")
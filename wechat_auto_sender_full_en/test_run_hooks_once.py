@@ -4,10 +4,11 @@ from sqlalchemy.orm import sessionmaker
 from datetime import datetime
 from config import DB_URL
 from models import Base, Task
-from hooks import process_one_task
+from db_utils import init_db
+from hook import process_one_task
 
 engine = create_engine(DB_URL, future=True)
-Base.metadata.create_all(engine)
+init_db(engine)
 Session = sessionmaker(bind=engine, future=True)
 
 with Session() as s:
@@ -6,10 +6,10 @@ from sqlalchemy.orm import sessionmaker
 
 from config import DB_URL
 from models import Base, Customer, Subscription, Task
-from db_utils import add_transaction
+from db_utils import add_transaction, init_db, upsert_tasks
 
 engine = create_engine(DB_URL, future=True)
-Base.metadata.create_all(engine)
+init_db(engine)
 Session = sessionmaker(bind=engine, future=True)
 
 with Session() as s:
@@ -33,10 +33,12 @@ with Session() as s:
 
     # 加两条任务（即将到时）
     now = datetime.now()
-    t1 = Task(customer_id=zhang.id, subscription_id=sub_bottle.id, send_time=now + timedelta(seconds=10),
-              template_key="confirm_by_bottle", payload_json='{"delivered_bottles": 2, "remark":"测试"}')
-    t2 = Task(customer_id=li.id, subscription_id=sub_amount.id, send_time=now + timedelta(seconds=15),
-              template_key="confirm_by_amount", payload_json='{"delivered_bottles": 3}')
-    s.add_all([t1, t2]); s.commit()
+    upsert_tasks(s, [
+        dict(customer_id=zhang.id, subscription_id=sub_bottle.id, send_time=now + timedelta(seconds=10),
+             template_key="confirm_by_bottle", delivered_bottles=2, remark="测试"),
+        dict(customer_id=li.id, subscription_id=sub_amount.id, send_time=now + timedelta(seconds=15),
+             template_key="confirm_by_amount", delivered_bottles=3),
+    ])
+    s.commit()
 
 print("✅ Seeded demo customers/subscriptions/tasks.")